@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+Time nfprepare run once per frame against one batched @list call made by
+nifsUtils.runIrafTaskOnFrames.
+
+Run it in a directory of raw NIFS frames, giving the shift image and bad pixel
+mask of the observation (Eg: from a baseline calibration directory):
+
+    python benchmarkIrafBatching.py sN20100410S0362.fits rgnN20100410S0362_sflat_bpm.pl N20100401S0182 N20100401S0183 ...
+
+Outputs are prepared frames, nN*.fits; they are removed before each run.
+"""
+import os, sys, time
+from pyraf import iraf
+from nifty.pipeline.nifsIraf import startIrafSession
+from nifty.pipeline.nifsUtils import runIrafTaskOnFrames
+
+def removeOutputs(frames):
+    for frame in frames:
+        if os.path.exists('n'+frame+'.fits'):
+            os.remove('n'+frame+'.fits')
+
+def main(shiftImage, badPixelMask, frames):
+    log = os.getcwd()+'/benchmark.log'
+    startIrafSession(log)
+    parameters = dict(rawpath='.', shiftimage=shiftImage, bpm=badPixelMask, fl_vardq='yes', fl_corr='no', fl_nonl='no', logfile=log)
+
+    removeOutputs(frames)
+    start = time.time()
+    for frame in frames:
+        iraf.nfprepare(frame, **parameters)
+    perFrame = time.time() - start
+
+    removeOutputs(frames)
+    start = time.time()
+    runIrafTaskOnFrames(iraf.nfprepare, frames, "", "n", True, **parameters)
+    batched = time.time() - start
+
+    print "{} frames: {:.1f} s one call per frame, {:.1f} s batched ({:.2f}x)".format(len(frames), perFrame, batched, perFrame / batched)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print __doc__
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2], [frame.replace('.fits', '') for frame in sys.argv[3:]])
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Compare a cube made by nifsNative.makeNativeCubes with one made by
+nstransform + nifcube.
+
+Run it in an observation directory reduced to step 4 with cubeMethod = 'iraf'
+(it needs the fbrsn and tfbrsn frames and database/):
+
+    python compareNativeCube.py N20100401S0182
+
+Both cubes are made in a temporary directory. The two grids are not the same
+resampling, so the check is on what later steps use: the wavelength axis, and
+the spectrum summed over the field, which must agree within 5% per plane.
+"""
+import os, sys, time, shutil, tempfile
+import numpy as np
+import astropy.io.fits
+from pyraf import iraf, iraffunctions
+from nifty.pipeline.nifsIraf import startIrafSession
+from nifty.pipeline.nifsNative import makeNativeCubes
+
+def getWavelengths(header, length):
+    return header['CRVAL3'] + (np.arange(length) + 1 - header.get('CRPIX3', 1.)) * header['CD3_3']
+
+def main(frame):
+    observationDirectory = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='cubeTest')
+    for name in ('fbrsn'+frame+'.fits', 'tfbrsn'+frame+'.fits'):
+        os.symlink(os.path.join(observationDirectory, name), os.path.join(directory, name))
+    shutil.copytree(os.path.join(observationDirectory, 'database'), os.path.join(directory, 'database'))
+    os.chdir(directory)
+    iraffunctions.chdir(directory)
+    startIrafSession(directory+'/test.log')
+
+    start = time.time()
+    iraf.nifcube('tfbrsn'+frame, outprefix='irafc', logfile=directory+'/test.log')
+    irafTime = time.time() - start
+    start = time.time()
+    makeNativeCubes([frame], True)
+    nativeTime = time.time() - start
+
+    with astropy.io.fits.open('irafctfbrsn'+frame+'.fits') as irafCube:
+        with astropy.io.fits.open('ctfbrsn'+frame+'.fits') as nativeCube:
+            irafData = irafCube['SCI'].data
+            nativeData = nativeCube['SCI'].data
+            irafWavelengths = getWavelengths(irafCube['SCI'].header, irafData.shape[0])
+            nativeWavelengths = getWavelengths(nativeCube['SCI'].header, nativeData.shape[0])
+            irafSpectrum = np.nansum(irafData, axis=(1, 2))
+            nativeSpectrum = np.nansum(nativeData, axis=(1, 2))
+            print "nifcube: {} {:.2f} to {:.2f} A; native: {} {:.2f} to {:.2f} A".format(irafData.shape, irafWavelengths[0], irafWavelengths[-1], \
+                  nativeData.shape, nativeWavelengths[0], nativeWavelengths[-1])
+
+    os.chdir(observationDirectory)
+    shutil.rmtree(directory)
+
+    failed = False
+    step = abs(nativeWavelengths[1] - nativeWavelengths[0])
+    if abs(irafWavelengths[0] - nativeWavelengths[0]) > step or abs(irafWavelengths[-1] - nativeWavelengths[-1]) > step:
+        print "The wavelength axes differ by more than a pixel."
+        failed = True
+    irafSpectrum = np.interp(nativeWavelengths, irafWavelengths, irafSpectrum)
+    used = np.abs(irafSpectrum) > 0.1 * np.median(np.abs(irafSpectrum))
+    ratio = nativeSpectrum[used] / irafSpectrum[used]
+    # The field sums are compared after scaling, as the two cubes have different spaxel sizes.
+    ratio /= np.median(ratio)
+    difference = np.percentile(np.abs(ratio - 1.), 95)
+    print "95th percentile difference of the summed spectra: {:.2%}".format(difference)
+    if difference > 0.05:
+        failed = True
+    print "nifcube {:.1f} s (without nstransform), native {:.1f} s".format(irafTime, nativeTime)
+    if failed:
+        sys.exit(1)
+    print "The native cube matches nifcube."
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print __doc__
+        sys.exit(1)
+    main(sys.argv[1])
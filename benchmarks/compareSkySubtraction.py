@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Compare nifsNative.subtractSky with iraf.gemarith, as called by
+nifsReduce.skySubtractObj, on small synthetic MEF frames, and time both.
+
+Run it anywhere with IRAF and the gemini package:
+
+    python compareSkySubtraction.py [number of frames]
+
+SCI, VAR and DQ of every output must match; the times are printed.
+"""
+import os, sys, time, shutil, tempfile
+import numpy as np
+import astropy.io.fits
+from pyraf import iraf, iraffunctions
+from nifty.pipeline.nifsIraf import loadIrafPackages
+from nifty.pipeline.nifsNative import subtractSky
+
+def makeFrame(filename, random, shape=(64, 128)):
+    """Write a MEF like the nfprepare outputs: a PHU and SCI, VAR and DQ extensions."""
+    primary = astropy.io.fits.PrimaryHDU()
+    primary.header['NEXTEND'] = 3
+    primary.header['NSCIEXT'] = 1
+    sci = astropy.io.fits.ImageHDU(random.normal(100., 10., shape).astype(np.float32), name='SCI')
+    var = astropy.io.fits.ImageHDU(random.uniform(1., 20., shape).astype(np.float32), name='VAR')
+    dq = astropy.io.fits.ImageHDU((random.uniform(size=shape) < 0.05).astype(np.int16) * random.randint(1, 8, shape).astype(np.int16), name='DQ')
+    for hdu in (sci, var, dq):
+        hdu.header['EXTVER'] = 1
+    astropy.io.fits.HDUList([primary, sci, var, dq]).writeto(filename)
+
+def main(numberOfFrames):
+    directory = tempfile.mkdtemp(prefix='skySubtractionTest')
+    os.chdir(directory)
+    iraffunctions.chdir(directory)
+    loadIrafPackages(['gemini', 'gemtools'])
+    random = np.random.RandomState(1)
+    frames = ['obj{}'.format(i) for i in range(numberOfFrames)]
+    for frame in frames:
+        makeFrame('n'+frame+'.fits', random)
+    makeFrame('nsky.fits', random)
+
+    start = time.time()
+    for frame in frames:
+        iraf.gemarith("n"+frame, "-", "nsky", "gemarith"+frame, fl_vardq="yes", logfile=directory+'/test.log')
+    irafTime = time.time() - start
+
+    start = time.time()
+    subtractSky(frames, ['nsky'] * len(frames), True)
+    nativeTime = time.time() - start
+
+    failed = False
+    for frame in frames:
+        with astropy.io.fits.open('gemarith'+frame+'.fits') as expected:
+            with astropy.io.fits.open('sn'+frame+'.fits') as result:
+                for extension in ('SCI', 'VAR', 'DQ'):
+                    if not np.allclose(expected[extension].data, result[extension].data):
+                        print "{} of sn{} differs from gemarith".format(extension, frame)
+                        failed = True
+
+    os.chdir('/')
+    shutil.rmtree(directory)
+    print "{} frames: gemarith {:.2f} s, native {:.2f} s".format(numberOfFrames, irafTime, nativeTime)
+    if failed:
+        sys.exit(1)
+    print "SCI, VAR and DQ match gemarith."
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
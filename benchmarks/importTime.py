@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+"""
+Time importing nifty and reaching nifsPipeline.start, and list the heavy
+dependencies the imports loaded.
+
+    python importTime.py
+
+Run it against two checkouts to compare startup times. Each run is a new process,
+so nothing is already imported.
+"""
+import subprocess, sys
+
+CODE = """
+import sys, time
+start = time.time()
+import nifty
+from nifty.pipeline import nifsPipeline
+nifsPipeline.start
+elapsed = time.time() - start
+loaded = [name for name in ('pyraf', 'astropy', 'astroquery', 'numpy', 'scipy', 'matplotlib', 'requests') if name in sys.modules]
+print '%.3f %s' % (elapsed, ','.join(loaded) or '-')
+"""
+
+def main(runs=5):
+    times = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', CODE]).split()
+        times.append(float(output[0]))
+    print "import nifty and nifsPipeline: best {:.3f} s, median {:.3f} s over {} runs".format(min(times), sorted(times)[len(times)//2], runs)
+    print "heavy modules loaded: " + output[1]
+
+if __name__ == '__main__':
+    main()
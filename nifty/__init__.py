@@ -1,9 +1,23 @@
-import pipeline.nifsPipeline as nifsPipeline
-import pipeline.nifsLowMemoryPipeline as nifsLowMemoryPipeline
-import pipeline.nifsUtils as nifsUtils
-import pipeline.steps.nifsSort as nifsSort
-import pipeline.steps.nifsBaselineCalibration as nifsBaselineCalibration
-import pipeline.steps.nifsReduce as nifsReduce
-import pipeline.steps.nifsTelluric as nifsTelluric
-import pipeline.steps.nifsFluxCalibrate as nifsFluxCalibrate
-import pipeline.steps.nifsMerge as nifsMerge
+import importlib
+
+class LazyModule(object):
+    """Stand in for a Nifty module that imports it the first time one of its attributes is used.
+
+    Pipeline steps import pyraf and astropy, which takes several seconds; with lazy
+    modules "import nifty" is quick and only the steps a reduction runs are loaded.
+    """
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attribute):
+        return getattr(importlib.import_module(self.__name, __name__), attribute)
+
+nifsPipeline = LazyModule('.pipeline.nifsPipeline')
+nifsLowMemoryPipeline = LazyModule('.pipeline.nifsLowMemoryPipeline')
+nifsUtils = LazyModule('.pipeline.nifsUtils')
+nifsSort = LazyModule('.pipeline.steps.nifsSort')
+nifsBaselineCalibration = LazyModule('.pipeline.steps.nifsBaselineCalibration')
+nifsReduce = LazyModule('.pipeline.steps.nifsReduce')
+nifsTelluric = LazyModule('.pipeline.steps.nifsTelluric')
+nifsFluxCalibrate = LazyModule('.pipeline.steps.nifsFluxCalibrate')
+nifsMerge = LazyModule('.pipeline.steps.nifsMerge')
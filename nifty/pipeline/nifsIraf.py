@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2015, 2017 Marie Lemoine-Busserolle
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+################################################################################
+#                Import some useful Python utilities/modules                   #
+################################################################################
+
+# STDLIB
+
+import logging
+from pyraf import iraf
+
+#--------------------------------------------------------------------#
+#                                                                    #
+#     IRAF SESSION                                                   #
+#                                                                    #
+#    Load and set up IRAF packages once per process.                 #
+#                                                                    #
+#--------------------------------------------------------------------#
+
+# IRAF packages loaded in this process and whether the NIFS set up was done.
+irafSession = {'packages': [], 'configured': False}
+
+def loadIrafPackages(packages):
+    """Load the IRAF packages that are not loaded yet in this process. Eg: ['gemini', 'nifs']"""
+    for package in packages:
+        if package not in irafSession['packages']:
+            getattr(iraf, package)()
+            irafSession['packages'].append(package)
+
+#-----------------------------------------------------------------------------#
+
+def startIrafSession(log):
+    """Load the gemini, gemtools, gnirs and nifs packages and set them up for NIFS reductions.
+
+    This is done the first time it is called in a process; later calls (Eg: by the next
+    step of the pipeline, or the next task of a worker process) do nothing.
+
+    Args:
+        log (string): iraf log file used by nsheaders.
+
+    """
+    loadIrafPackages(['gemini', 'gemtools', 'gnirs', 'nifs'])
+    if irafSession['configured']:
+        return
+
+    # Reset to default parameters the used IRAF tasks.
+    iraf.unlearn(iraf.gemini,iraf.gemtools,iraf.gnirs,iraf.nifs,iraf.imcopy)
+
+    # From http://bishop.astro.pomona.edu/Penprase/webdocuments/iraf/beg/beg-image.html:
+    # Before doing anything involving image display the environment variable
+    # stdimage must be set to the correct frame buffer size for the display
+    # servers (as described in the dev$graphcap file under the section "STDIMAGE
+    # devices") or to the correct image display device. The task GDEVICES is
+    # helpful for determining this information for the display servers.
+    iraf.set(stdimage='imt2048')
+
+    # Prepare the IRAF package for NIFS.
+    # NSHEADERS lists the header parameters used by the various tasks in the
+    # NIFS package (excluding headers values which have values fixed by IRAF or
+    # FITS conventions).
+    iraf.nsheaders("nifs",logfile=log)
+
+    # Set clobber to 'yes' for the script. This still does not make the gemini
+    # tasks overwrite files, so:
+    # YOU WILL LIKELY HAVE TO REMOVE FILES IF YOU RE_RUN THE SCRIPT.
+    iraf.reset(clobber='yes')
+
+    irafSession['configured'] = True
+    logging.info("\nLoaded and set up the IRAF packages " + ", ".join(irafSession['packages']))
+
+#-----------------------------------------------------------------------------#
@@ -34,10 +34,8 @@ from datetime import datetime
 
 # LOCAL
 
-# Import major Nifty scripts.
-import steps.nifsSort as nifsSort
-import steps.nifsBaselineCalibration as nifsBaselineCalibration
-import steps.nifsReduce as nifsReduce
+# Major Nifty scripts are imported by the stages that run them; importing them
+# loads pyraf and astropy, which is slow.
 import nifsUtils as nifsUtils
 # Import config parsing.
 # Import config parsing.
@@ -179,6 +177,7 @@ def start(args):
     if sort:
         if manualMode:
             a = raw_input('About to enter nifsSort.')
+        import steps.nifsSort as nifsSort
         nifsSort.start()
     # By now, we should have paths to the three types of raw data. Print them out.
     printDirectoryLists()
@@ -221,6 +220,7 @@ def start(args):
         if calibrationReduction:
             if manualMode:
                 a = raw_input('About to enter nifsBaselineCalibration.')
+            import steps.nifsBaselineCalibration as nifsBaselineCalibration
             nifsBaselineCalibration.start(calibrationDirectoryList=calibrationDirectory)
 
         ###########################################################################
@@ -230,6 +230,7 @@ def start(args):
         if telluricReduction:
             if manualMode:
                 a = raw_input('About to enter nifsReduce to reduce Tellurics.')
+            import steps.nifsReduce as nifsReduce
             nifsReduce.start('Telluric', telluricDirectoryList=telluricDirectoryList)
 
         ###########################################################################
@@ -239,6 +240,7 @@ def start(args):
         if scienceReduction:
             if manualMode:
                 a = raw_input('About to enter nifsReduce to reduce science.')
+            import steps.nifsReduce as nifsReduce
             nifsReduce.start('Science')
 
     ###########################################################################
@@ -0,0 +1,835 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2015, 2017 Marie Lemoine-Busserolle
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+################################################################################
+#                Import some useful Python utilities/modules                   #
+################################################################################
+
+# STDLIB
+
+import os, time, logging, glob, hashlib, collections
+import numpy as np
+import scipy.sparse
+import astropy.io.fits
+
+# LOCAL
+
+# Import custom Nifty functions.
+from nifsUtils import framesToProcess, recordOutputs, writeFits
+
+# Resampling operators made by makeCubeOperator, by calibration. See makeNativeCubes.
+cubeOperators = {}
+# Vega models resampled to the wavelengths of a spectrum, least recently used first. See getVegaModels.
+vegaModels = collections.OrderedDict()
+VEGA_MODEL_CACHE_SIZE = 8
+# Blackbody spectra by temperature and wavelength grid. See makePlanckSpectrum.
+blackBodies = {}
+# Second radiation constant hc/k in Angstrom Kelvin.
+PLANCK_C2 = 1.4387769e8
+
+#--------------------------------------------------------------------#
+#                                                                    #
+#     NATIVE                                                         #
+#                                                                    #
+#    numpy versions of iraf tasks that are simple array operations   #
+#    on Gemini MEF files (SCI, VAR and DQ extensions).               #
+#                                                                    #
+#--------------------------------------------------------------------#
+
+def stampGemini(header, task):
+    """Add the time stamp keywords a Gemini iraf task writes to a primary header."""
+    now = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
+    header[task] = (now, 'UT Time stamp for '+task)
+    header['GEM-TLM'] = (now, 'UT Last modification with GEMINI')
+
+#-----------------------------------------------------------------------------#
+
+def subtractSky(frames, skies, over):
+    """Subtract sky frames from prepared frames, like iraf.gemarith with fl_vardq. Output: -->sn
+
+    SCI extensions are subtracted, VAR extensions added and DQ extensions OR-ed. Other
+    extensions (Eg: the MDF) and headers come from the object frame. Each sky is read
+    only once, however many frames use it, and frames are memory mapped.
+
+    Args:
+        frames (list): frame names; "n"+frame+".fits" are read.
+        skies (list): full names (without .fits) of the sky of each frame. Eg: "nN20100401S0137" or "gnN20100401S0137".
+        over (boolean): overwrite old outputs.
+
+    """
+    skyOfFrame = dict(zip([str(frame).strip() for frame in frames], skies))
+    dependencies = lambda frame: (["n"+frame+'.fits', skyOfFrame[frame]+'.fits'], 'subtractSky')
+    todo = framesToProcess(frames, "sn", over, dependencies=dependencies)
+
+    skyData = {}
+    for frame in todo:
+        sky = skyOfFrame[frame]
+        if sky not in skyData:
+            skyData[sky] = {}
+            with astropy.io.fits.open(sky+'.fits', memmap=True) as skyHdul:
+                for hdu in skyHdul[1:]:
+                    if hdu.name in ('SCI', 'VAR', 'DQ'):
+                        skyData[sky][(hdu.name, hdu.ver)] = np.array(hdu.data)
+
+        with astropy.io.fits.open("n"+frame+'.fits', memmap=True) as hdul:
+            output = astropy.io.fits.HDUList([astropy.io.fits.PrimaryHDU(header=hdul[0].header.copy())])
+            for hdu in hdul[1:]:
+                key = (hdu.name, hdu.ver)
+                if key not in skyData[sky]:
+                    output.append(hdu.copy())
+                    continue
+                if hdu.name == 'SCI':
+                    data = hdu.data - skyData[sky][key]
+                elif hdu.name == 'VAR':
+                    data = hdu.data + skyData[sky][key]
+                else:
+                    data = np.bitwise_or(hdu.data, skyData[sky][key])
+                output.append(astropy.io.fits.ImageHDU(data=data.astype(hdu.data.dtype), header=hdu.header.copy()))
+            stampGemini(output[0].header, 'GEMARITH')
+            writeFits(output, "sn"+frame+'.fits', output_verify='ignore')
+        recordOutputs([frame], "sn", dependencies)
+        logging.info("Subtracted sky " + sky + " from n" + frame)
+
+#-----------------------------------------------------------------------------#
+
+def readFitCoordsSurface(databaseFile):
+    """Read the gsurfit surface of an iraf fitcoords database file (database/fc*).
+
+    Returns the list of numbers after the last "surface" keyword; surface type, x order,
+    y order, cross terms, xmin, xmax, ymin, ymax and then the coefficients.
+    """
+    with open(databaseFile, 'r') as f:
+        words = f.read().split()
+    start = len(words) - 1 - words[::-1].index('surface')
+    numberOfValues = int(words[start+1])
+    return [float(x) for x in words[start+2:start+2+numberOfValues]]
+
+#-----------------------------------------------------------------------------#
+
+def evaluateSurface(surface, x, y):
+    """Evaluate an iraf gsurfit surface (as read by readFitCoordsSurface) at pixel coordinates x, y."""
+    surfaceType, xorder, yorder, xterms = [int(value) for value in surface[:4]]
+    xmin, xmax, ymin, ymax = surface[4:8]
+    coefficients = surface[8:]
+
+    def basis(z, order):
+        # 1 is chebyshev, 2 legendre and 3 polynomial.
+        functions = [np.ones_like(z), z]
+        for n in range(2, order):
+            if surfaceType == 1:
+                functions.append(2. * z * functions[n-1] - functions[n-2])
+            elif surfaceType == 2:
+                functions.append(((2. * n - 1.) * z * functions[n-1] - (n - 1.) * functions[n-2]) / n)
+            else:
+                functions.append(z * functions[n-1])
+        return functions[:order]
+
+    xBasis = basis((2. * x - (xmax + xmin)) / (xmax - xmin), xorder)
+    yBasis = basis((2. * y - (ymax + ymin)) / (ymax - ymin), yorder)
+
+    # Same order of coefficients as iraf gsurfit: x varies fastest, cross terms
+    # are none (0), full (1) or half (2).
+    result = np.zeros(np.shape(x))
+    k = 0
+    xincr = xorder
+    maxorder = max(xorder, yorder) + 1
+    for j in range(yorder):
+        for i in range(xincr):
+            result += coefficients[k] * xBasis[i] * yBasis[j]
+            k += 1
+        if xterms == 0:
+            xincr = 1
+        elif xterms == 2 and j + 1 + xorder + 1 > maxorder:
+            xincr -= 1
+    return result
+
+#-----------------------------------------------------------------------------#
+
+def makeCubeOperator(frame, shapes, cubePixelScale=0.05, slicePixelScale=0.043, sliceWidth=0.103):
+    """Make the sparse matrix that resamples the slices of a fbrsn frame into a data cube.
+
+    The wavelength (lamp) and spatial (sdist) nsfitcoords surfaces of each slice give the
+    wavelength and position along the slice of every detector pixel. Pixels are shared
+    linearly between the two nearest wavelength planes, put in the nearest row along
+    the slice and split between the cube columns a slice overlaps. Each cube voxel is the
+    weighted mean of its pixels.
+
+    Args:
+        frame (string): frame whose database/fcfbrsn<frame>_SCI_<n>_lamp and _sdist files are used.
+        shapes (list): shape of each SCI extension.
+        cubePixelScale (float): spatial pixel size of the cube in arcsec.
+        slicePixelScale (float): detector pixel size along a slice in arcsec.
+        sliceWidth (float): width of a slice in arcsec.
+
+    Returns:
+        a dictionary with the operator (a csr matrix with one row per voxel and one column per
+        detector pixel), the cube shape and the wavelength solution of the cube.
+    """
+    wavelengths = []
+    positions = []
+    dispersions = []
+    for n in range(len(shapes)):
+        lamp = readFitCoordsSurface('database/fcfbrsn'+frame+'_SCI_'+str(n+1)+'_lamp')
+        sdist = readFitCoordsSurface('database/fcfbrsn'+frame+'_SCI_'+str(n+1)+'_sdist')
+        y, x = np.mgrid[1:shapes[n][0]+1, 1:shapes[n][1]+1].astype(float)
+        wavelength = evaluateSurface(lamp, x, y)
+        wavelengths.append(wavelength.ravel())
+        positions.append(evaluateSurface(sdist, x, y).ravel() * slicePixelScale)
+        dispersions.append(np.median(np.diff(wavelength, axis=1)))
+
+    # Use the wavelengths covered by every slice.
+    dispersion = abs(np.median(dispersions))
+    wavelengthStart = max(w.min() for w in wavelengths)
+    wavelengthEnd = min(w.max() for w in wavelengths)
+    numberOfPlanes = int((wavelengthEnd - wavelengthStart) / dispersion) + 1
+    positionStart = min(p.min() for p in positions)
+    numberOfRows = int(np.ceil((max(p.max() for p in positions) - positionStart) / cubePixelScale)) + 1
+    numberOfColumns = int(np.ceil(len(shapes) * sliceWidth / cubePixelScale))
+
+    rows = []
+    columns = []
+    weights = []
+    offset = 0
+    for n in range(len(shapes)):
+        pixels = offset + np.arange(wavelengths[n].size)
+        plane = (wavelengths[n] - wavelengthStart) / dispersion
+        lowerPlane = np.floor(plane).astype(int)
+        upperWeight = plane - lowerPlane
+        row = np.rint((positions[n] - positionStart) / cubePixelScale).astype(int)
+        sliceStart = n * sliceWidth
+        sliceEnd = (n + 1) * sliceWidth
+        for column in range(int(sliceStart / cubePixelScale), int(np.ceil(sliceEnd / cubePixelScale))):
+            overlap = (min((column + 1) * cubePixelScale, sliceEnd) - max(column * cubePixelScale, sliceStart)) / cubePixelScale
+            if overlap <= 0 or column >= numberOfColumns:
+                continue
+            for planeIndex, planeWeight in ((lowerPlane, 1. - upperWeight), (lowerPlane + 1, upperWeight)):
+                good = (planeIndex >= 0) & (planeIndex < numberOfPlanes) & (planeWeight > 0)
+                rows.append(((planeIndex[good] * numberOfRows) + row[good]) * numberOfColumns + column)
+                columns.append(pixels[good])
+                weights.append(planeWeight[good] * overlap)
+        offset += wavelengths[n].size
+
+    shape = (numberOfPlanes, numberOfRows, numberOfColumns)
+    operator = scipy.sparse.coo_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(columns))), shape=(numberOfPlanes * numberOfRows * numberOfColumns, offset)).tocsr()
+    # Normalise each voxel by the total weight of its pixels.
+    totals = np.asarray(operator.sum(axis=1)).ravel()
+    totals[totals == 0] = 1.
+    operator = scipy.sparse.diags(1. / totals).dot(operator).tocsr()
+    return {'operator': operator, 'varianceOperator': operator.multiply(operator).tocsr(), 'coverage': np.asarray(operator.sum(axis=1)).ravel(),
+            'shape': shape, 'crval': wavelengthStart, 'cdelt': dispersion, 'pixelScale': cubePixelScale}
+
+#-----------------------------------------------------------------------------#
+
+def getCubeOperator(frame, shapes, cubePixelScale=0.05):
+    """Return the resampling operator of a frame, making it only once for each calibration.
+
+    Frames of an observation share their nsfitcoords solution, so operators are stored
+    by the contents of the database files (with the frame name taken out) and the slice shapes.
+    """
+    md5 = hashlib.md5(repr((shapes, cubePixelScale)))
+    for databaseFile in sorted(glob.glob('database/fcfbrsn'+frame+'_SCI_*')):
+        with open(databaseFile, 'r') as f:
+            md5.update(f.read().replace(frame, ''))
+    key = md5.hexdigest()
+    if key not in cubeOperators:
+        logging.info("\nMaking the cube resampling operator of " + frame)
+        cubeOperators[key] = makeCubeOperator(frame, shapes, cubePixelScale)
+    return cubeOperators[key]
+
+#-----------------------------------------------------------------------------#
+
+def makeNativeCubes(frames, over, cubePixelScale=0.05):
+    """Make data cubes of fbrsn frames with a sparse resampling operator. Output: -->ctfbrsn
+
+    This replaces nstransform followed by nifcube. The operator is made once per calibration
+    set; each cube is then one sparse matrix vector product for SCI, one for VAR (with squared
+    weights) and one for DQ. Voxels no pixel falls in are flagged in DQ.
+
+    """
+    for frame in framesToProcess(frames, "ctfbrsn", over):
+        with astropy.io.fits.open("fbrsn"+frame+'.fits', memmap=True) as hdulist:
+            extensions = {}
+            for name in ('SCI', 'VAR', 'DQ'):
+                extensions[name] = [hdu for hdu in hdulist[1:] if hdu.name == name]
+                extensions[name].sort(key=lambda hdu: hdu.ver)
+            shapes = [hdu.data.shape for hdu in extensions['SCI']]
+            cube = getCubeOperator(frame, shapes, cubePixelScale)
+            operator = cube['operator']
+
+            sci = operator.dot(np.concatenate([hdu.data.astype(float).ravel() for hdu in extensions['SCI']]))
+            var = cube['varianceOperator'].dot(np.concatenate([hdu.data.astype(float).ravel() for hdu in extensions['VAR']]))
+            dq = (operator.dot(np.concatenate([(hdu.data != 0).ravel() for hdu in extensions['DQ']]).astype(float)) > 0) | (cube['coverage'] == 0)
+
+            header = astropy.io.fits.Header()
+            header['CTYPE1'] = 'LINEAR'
+            header['CTYPE2'] = 'LINEAR'
+            header['CTYPE3'] = 'LINEAR'
+            header['CRPIX1'] = cube['shape'][2] / 2. + 0.5
+            header['CRPIX2'] = cube['shape'][1] / 2. + 0.5
+            header['CRPIX3'] = 1.
+            header['CRVAL1'] = 0.
+            header['CRVAL2'] = 0.
+            header['CRVAL3'] = cube['crval']
+            header['CD1_1'] = cube['pixelScale']
+            header['CD2_2'] = cube['pixelScale']
+            header['CD3_3'] = cube['cdelt']
+            header['WCSDIM'] = 3
+
+            output = astropy.io.fits.HDUList([astropy.io.fits.PrimaryHDU(header=hdulist[0].header.copy())])
+            output.append(astropy.io.fits.ImageHDU(data=sci.reshape(cube['shape']).astype(np.float32), header=header.copy(), name='SCI'))
+            output.append(astropy.io.fits.ImageHDU(data=var.reshape(cube['shape']).astype(np.float32), header=header.copy(), name='VAR'))
+            output.append(astropy.io.fits.ImageHDU(data=dq.reshape(cube['shape']).astype(np.int16), header=header.copy(), name='DQ'))
+            stampGemini(output[0].header, 'NIFCUBE')
+            writeFits(output, "ctfbrsn"+frame+'.fits', output_verify='ignore')
+        recordOutputs([frame], "ctfbrsn")
+        logging.info("Made cube ctfbrsn" + frame)
+
+#-----------------------------------------------------------------------------#
+
+def apertureWeights(shape, apertures, subsampling=10):
+    """Fraction of each spaxel inside each circular aperture.
+
+    Args:
+        shape (tuple): (y, x) size of the cube.
+        apertures (list): (xc, yc, radius) of each aperture in cube pixels, with 1 as the first pixel like iraf.
+        subsampling (int): each spaxel is split in subsampling x subsampling points.
+
+    Returns:
+        array of shape (len(apertures), y, x).
+    """
+    offsets = (np.arange(subsampling) + 0.5) / subsampling - 0.5
+    y, x = np.mgrid[1:shape[0]+1, 1:shape[1]+1].astype(float)
+    x = x[:, :, np.newaxis, np.newaxis] + offsets[np.newaxis, :]
+    y = y[:, :, np.newaxis, np.newaxis] + offsets[:, np.newaxis]
+    weights = np.zeros((len(apertures),) + tuple(shape))
+    for k in range(len(apertures)):
+        xc, yc, radius = apertures[k]
+        weights[k] = ((x - xc)**2 + (y - yc)**2 <= radius**2).mean(axis=(2, 3))
+    return weights
+
+#-----------------------------------------------------------------------------#
+
+def extractSpectra(cubes, apertures):
+    """Extract the spectra of several apertures from data cubes.
+
+    Aperture weights are computed once and applied to all apertures of a cube in one
+    operation. Bad (DQ) spaxels are left out and the sum scaled up by the aperture area
+    they cover.
+
+    Args:
+        cubes (list): cube file names.
+        apertures (list): (xc, yc, radius) of each aperture in cube pixels.
+
+    Returns:
+        spectra and variances, arrays of shape (len(cubes), len(apertures), wavelength),
+        and the header of the first SCI extension.
+    """
+    spectra = []
+    variances = []
+    weights = None
+    for cube in cubes:
+        with astropy.io.fits.open(cube, memmap=True) as hdulist:
+            if weights is None:
+                header = hdulist['SCI'].header.copy()
+                weights = apertureWeights(hdulist['SCI'].data.shape[1:], apertures)
+            good = (hdulist['DQ'].data == 0)
+            sci = np.where(good, hdulist['SCI'].data, 0.)
+            var = np.where(good, hdulist['VAR'].data, 0.)
+            # Aperture area actually covered by good spaxels, for each aperture and wavelength.
+            covered = np.einsum('kyx,lyx->kl', weights, good.astype(float))
+            area = weights.sum(axis=(1, 2))[:, np.newaxis]
+            scale = np.where(covered > 0, area / np.where(covered > 0, covered, 1.), 0.)
+            spectra.append(np.einsum('kyx,lyx->kl', weights, sci) * scale)
+            variances.append(np.einsum('kyx,lyx->kl', weights**2, var) * scale**2)
+    return np.array(spectra), np.array(variances), header
+
+#-----------------------------------------------------------------------------#
+
+def writeSpectra(filename, primaryHeader, cubeHeader, spectra, variances):
+    """Write one MEF 1D spectrum (SCI, VAR and DQ extensions) per aperture; aperture k has EXTVER k+1."""
+    header = astropy.io.fits.Header()
+    header['CTYPE1'] = cubeHeader.get('CTYPE3', 'LINEAR')
+    header['CRPIX1'] = cubeHeader.get('CRPIX3', 1.)
+    header['CRVAL1'] = cubeHeader['CRVAL3']
+    header['CD1_1'] = cubeHeader['CD3_3']
+    header['CDELT1'] = cubeHeader['CD3_3']
+    header['WCSDIM'] = 1
+    output = astropy.io.fits.HDUList([astropy.io.fits.PrimaryHDU(header=primaryHeader)])
+    for k in range(len(spectra)):
+        output.append(astropy.io.fits.ImageHDU(data=spectra[k].astype(np.float32), header=header.copy(), name='SCI', ver=k+1))
+        output.append(astropy.io.fits.ImageHDU(data=variances[k].astype(np.float32), header=header.copy(), name='VAR', ver=k+1))
+        output.append(astropy.io.fits.ImageHDU(data=(variances[k] <= 0).astype(np.int16), header=header.copy(), name='DQ', ver=k+1))
+    writeFits(output, filename, output_verify='ignore')
+
+#-----------------------------------------------------------------------------#
+
+def extractNativeSpectra(frames, apertures, over):
+    """Extract spectra of each ctfbrsn cube and median combine them. Output: -->xtfbrsn and gxtfbrsn
+
+    The combined spectrum is named after the first frame. The variance of the median is
+    taken as pi/2 times the mean variance divided by the number of frames.
+
+    Returns:
+        frames whose spectra were extracted.
+    """
+    frames = [str(frame).strip() for frame in frames if os.path.exists("ctfbrsn"+str(frame).strip()+".fits")]
+    if not frames:
+        return frames
+    combined = "gxtfbrsn"+frames[0]+".fits"
+    todo = framesToProcess(frames, "xtfbrsn", over)
+    if not todo and os.path.exists(combined) and not over:
+        logging.info("Output files exist and -over not set - skipping native extraction")
+        return frames
+
+    spectra, variances, cubeHeader = extractSpectra(["ctfbrsn"+frame+".fits" for frame in frames], apertures)
+    for i in range(len(frames)):
+        if frames[i] in todo:
+            writeSpectra("xtfbrsn"+frames[i]+".fits", astropy.io.fits.getheader("ctfbrsn"+frames[i]+".fits"), cubeHeader, spectra[i], variances[i])
+    recordOutputs(todo, "xtfbrsn")
+
+    if os.path.exists(combined):
+        os.remove(combined)
+    primaryHeader = astropy.io.fits.getheader("ctfbrsn"+frames[0]+".fits")
+    stampGemini(primaryHeader, 'GEMCOMB')
+    writeSpectra(combined, primaryHeader, cubeHeader, np.median(spectra, axis=0), np.pi / 2. * variances.mean(axis=0) / len(frames))
+    return frames
+
+#-----------------------------------------------------------------------------#
+
+def applySpectrumToCube(cubeFile, spectrum, op, outputFile, chunkSize=256):
+    """Multiply or divide every spaxel of a cube by a 1D spectrum. Output: outputFile.
+
+    The spectrum is broadcast along the spectral axis, a chunk of chunkSize wavelengths at a
+    time. The input cube is read through a memory map and each corrected chunk is streamed to
+    the output, so the cube is read and written once and never held in memory.
+
+    SCI is multiplied or divided by the spectrum and VAR by its square. Where the spectrum
+    can't be divided by (zero or not finite), SCI and VAR are set to 0 and DQ is flagged,
+    like imarith with divzero=0. The spectrum is taken as noiseless.
+
+    Args:
+        cubeFile (string): cube to correct. Eg: 'ctfbrsnN20100401S0182.fits'.
+        spectrum (array): 1D spectrum with one value per cube wavelength.
+        op (string): 'multiply' or 'divide'.
+        outputFile (string): corrected cube.
+        chunkSize (int): number of wavelengths corrected at once.
+
+    """
+    spectrum = np.asarray(spectrum, dtype=float).ravel()
+    if op == 'divide':
+        bad = (spectrum == 0) | ~np.isfinite(spectrum)
+        factor = np.where(bad, 0., 1. / np.where(bad, 1., spectrum))
+    elif op == 'multiply':
+        bad = ~np.isfinite(spectrum)
+        factor = np.where(bad, 0., spectrum)
+    else:
+        raise ValueError("op must be 'multiply' or 'divide', not " + str(op))
+
+    # Write the output under a temporary name, like writeFits.
+    temporary = outputFile+'.part'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    with astropy.io.fits.open(cubeFile, memmap=True) as hdulist:
+        extensions = [i for i in range(1, len(hdulist)) if hdulist[i].data is not None and hdulist[i].data.ndim == 3]
+        if not [i for i in extensions if hdulist[i].name in ('SCI', 'VAR', 'DQ')]:
+            # Cube without extension names; the first image extension is the science.
+            names = dict(zip(extensions[:1], ['SCI']))
+        else:
+            names = dict((i, hdulist[i].name) for i in extensions if hdulist[i].name in ('SCI', 'VAR', 'DQ'))
+        for i in names:
+            if hdulist[i].data.shape[0] != len(factor):
+                raise ValueError("The spectrum has " + str(len(factor)) + " pixels but " + cubeFile + " has " + str(hdulist[i].data.shape[0]) + " wavelengths.")
+        hdulist[0].writeto(temporary, output_verify='ignore')
+        for i in range(1, len(hdulist)):
+            hdu = hdulist[i]
+            if i not in names:
+                with astropy.io.fits.open(temporary, mode='append') as output:
+                    output.append(hdu)
+                continue
+            data = hdu.data
+            output = astropy.io.fits.StreamingHDU(temporary, hdu.header)
+            for start in range(0, data.shape[0], chunkSize):
+                chunk = slice(start, start+chunkSize)
+                if names[i] == 'SCI':
+                    corrected = data[chunk] * factor[chunk, np.newaxis, np.newaxis]
+                elif names[i] == 'VAR':
+                    corrected = data[chunk] * (factor[chunk]**2)[:, np.newaxis, np.newaxis]
+                else:
+                    corrected = data[chunk] | bad[chunk, np.newaxis, np.newaxis].astype(data.dtype)
+                output.write(corrected.astype(data.dtype.newbyteorder('=')))
+            output.close()
+    os.rename(temporary, outputFile)
+
+#-----------------------------------------------------------------------------#
+
+def findTelluricShiftScale(spectrum, calibration, maxLag=10., smoothing=20.):
+    """Find the shift and scale of a telluric calibration spectrum that best correct spectrum.
+
+    This is the model of iraf.telluric: the calibration shifted by shift pixels and raised to
+    the power scale (Beer's law), ie: spectrum / calibration(x + shift)**scale. Absorption
+    features are isolated by taking logs and removing a smoothed continuum, so the corrected
+    spectrum is the difference of the two and its rms is minimised.
+
+    The shift is found to the nearest pixel with an FFT cross-correlation, then refined with
+    a parabola through the peak and a grid of subpixel shifts. For each shift the best scale
+    is the least squares solution, so all trial scales are searched at once.
+
+    Args:
+        spectrum (array): 1D spectrum to correct.
+        calibration (array): 1D normalised telluric calibration spectrum on the same pixels.
+        maxLag (float): largest shift searched, in pixels.
+        smoothing (float): sigma in pixels of the gaussian continuum removed before matching.
+
+    Returns:
+        shift, scale (floats) and the corrected spectrum.
+    """
+    import scipy.ndimage
+
+    spectrum = np.asarray(spectrum, dtype=float)
+    calibration = np.asarray(calibration, dtype=float)
+    good = np.isfinite(spectrum) & np.isfinite(calibration) & (spectrum > 0) & (calibration > 0)
+
+    def features(data):
+        logData = np.zeros(len(data))
+        logData[good] = np.log(data[good])
+        # Fill masked pixels with the continuum so they don't make features of their own.
+        weights = scipy.ndimage.gaussian_filter1d(good.astype(float), smoothing)
+        continuum = scipy.ndimage.gaussian_filter1d(logData, smoothing) / np.maximum(weights, 1e-10)
+        return np.where(good, logData - continuum, 0.)
+
+    spectrumFeatures = features(spectrum)
+    calibrationFeatures = features(calibration)
+
+    # Cross-correlate with zero padding; correlation[k] = sum spectrum(x) calibration(x + k).
+    n = len(spectrum)
+    size = 2 ** int(np.ceil(np.log2(2 * n)))
+    correlation = np.fft.irfft(np.conj(np.fft.rfft(spectrumFeatures, size)) * np.fft.rfft(calibrationFeatures, size), size)
+    maxLag = int(min(np.ceil(maxLag), n - 1))
+    lags = np.arange(-maxLag, maxLag + 1)
+    values = correlation[lags % size]
+    peak = int(np.argmax(values))
+    shift = float(lags[peak])
+    if 0 < peak < len(values) - 1:
+        denominator = values[peak-1] - 2 * values[peak] + values[peak+1]
+        if denominator < 0:
+            shift += 0.5 * (values[peak-1] - values[peak+1]) / denominator
+
+    # Refine the shift on a subpixel grid, with the least squares scale of each shift.
+    trialShifts = shift + np.arange(-0.5, 0.5001, 0.05)
+    shiftedFeatures = np.array([scipy.ndimage.interpolation.shift(calibrationFeatures, -trialShift, order=3, mode='nearest') for trialShift in trialShifts])
+    scales = np.dot(shiftedFeatures, spectrumFeatures) / np.maximum(np.sum(shiftedFeatures**2, axis=1), 1e-30)
+    residuals = np.sum((spectrumFeatures[np.newaxis, :] - scales[:, np.newaxis] * shiftedFeatures)**2, axis=1)
+    best = int(np.argmin(residuals))
+    shift = float(trialShifts[best])
+    scale = float(scales[best])
+
+    shiftedCalibration = scipy.ndimage.interpolation.shift(calibration, -shift, order=3, cval=1.)
+    shiftedCalibration = np.where(shiftedCalibration > 0, shiftedCalibration, 1.)
+    corrected = spectrum / shiftedCalibration**scale
+    return shift, scale, corrected
+
+#-----------------------------------------------------------------------------#
+
+def getSampleMask(sample, x):
+    """Select the points of x in an iraf sample string. Eg: "20279:20395,20953:24283" or "*"."""
+    if sample.strip() in ('', '*'):
+        return np.ones(len(x), dtype=bool)
+    mask = np.zeros(len(x), dtype=bool)
+    for sampleRange in sample.replace(' ', ',').split(','):
+        if not sampleRange:
+            continue
+        ends = sampleRange.split(':')
+        start = float(ends[0]) if ends[0] not in ('', '*') else -np.inf
+        end = float(ends[-1]) if ends[-1] not in ('', '*') else np.inf
+        mask |= (x >= min(start, end)) & (x <= max(start, end))
+    return mask
+
+#-----------------------------------------------------------------------------#
+
+def getSpectrumWavelengths(header, length):
+    """Wavelength of each pixel of a 1D spectrum from the linear WCS of its header."""
+    delta = header.get('CD1_1', header.get('CDELT1', 1.))
+    return header.get('CRVAL1', 1.) + (np.arange(length) + 1 - header.get('CRPIX1', 1.)) * delta
+
+#-----------------------------------------------------------------------------#
+
+def getSplineBasis(x, order):
+    """Design matrix of an iraf spline3 fit: cubic B-splines of order equal pieces over the range of x."""
+    x = np.asarray(x, dtype=float)
+    span = x.max() - x.min()
+    u = (x - x.min()) / (span if span else 1.) * order
+    piece = np.clip(np.floor(u).astype(int), 0, order - 1)
+    t = u - piece
+    basis = np.zeros((len(x), order + 3))
+    rows = np.arange(len(x))
+    basis[rows, piece] = (1 - t)**3 / 6.
+    basis[rows, piece + 1] = (3 * t**3 - 6 * t**2 + 4) / 6.
+    basis[rows, piece + 2] = (-3 * t**3 + 3 * t**2 + 3 * t + 1) / 6.
+    basis[rows, piece + 3] = t**3 / 6.
+    return basis
+
+#-----------------------------------------------------------------------------#
+
+def fitContinua(x, spectra, sample="*", order=5, lowReject=1.0, highReject=3.0, niterate=2, grow=1.0):
+    """Fit the continuum of many spectra at once, like iraf.continuum with func='spline3' and type='fit'.
+
+    Each spectrum is fit with cubic splines of order pieces, using the points of x in sample.
+    Each of niterate rejection iterations removes points with residuals below -lowReject or
+    above highReject times the rms of the points still used, and points within grow pixels
+    of them. All spectra are fit together with one stacked least squares solve.
+
+    Args:
+        x (array): coordinate (Eg: wavelength) of each pixel, shared by all spectra.
+        spectra (array): one spectrum, or a 2D array of one spectrum per row.
+        sample (string): iraf sample ranges in the units of x. Eg: "20279:20395,20953:24283".
+        order (int): number of spline pieces.
+        lowReject, highReject (float): rejection limits in units of the fit rms; 0 disables.
+        niterate (int): number of rejection iterations.
+        grow (float): rejection growing radius in pixels.
+
+    Returns:
+        the continuum fits, with the shape of spectra.
+    """
+    spectra = np.asarray(spectra, dtype=float)
+    oneSpectrum = spectra.ndim == 1
+    spectra = np.atleast_2d(spectra)
+    basis = getSplineBasis(x, order)
+    used = getSampleMask(sample, np.asarray(x, dtype=float))[np.newaxis, :] & np.isfinite(spectra)
+    values = np.where(np.isfinite(spectra), spectra, 0.)
+    growPixels = int(grow)
+
+    for iteration in range(niterate + 1):
+        weights = used.astype(float)
+        normal = np.einsum('ni,mn,nj->mij', basis, weights, basis)
+        # A little damping keeps pieces without sample points from making the solve singular.
+        normal += 1e-10 * np.trace(normal, axis1=1, axis2=2)[:, np.newaxis, np.newaxis] * np.eye(basis.shape[1])
+        coefficients = np.linalg.solve(normal, np.einsum('ni,mn->mi', basis, weights * values)[..., np.newaxis])[..., 0]
+        fits = np.dot(coefficients, basis.T)
+        if iteration == niterate:
+            break
+        residuals = values - fits
+        sigma = np.sqrt(np.sum(weights * residuals**2, axis=1) / np.maximum(weights.sum(axis=1) - basis.shape[1], 1.))[:, np.newaxis]
+        rejected = np.zeros(used.shape, dtype=bool)
+        if lowReject > 0:
+            rejected |= residuals < -lowReject * sigma
+        if highReject > 0:
+            rejected |= residuals > highReject * sigma
+        rejected &= used
+        if not rejected.any():
+            break
+        for offset in range(1, growPixels + 1):
+            rejected[:, offset:] |= rejected[:, :-offset]
+            rejected[:, :-offset] |= rejected[:, offset:]
+        used &= ~rejected
+    return fits[0] if oneSpectrum else fits
+
+#-----------------------------------------------------------------------------#
+
+def getVegaModels(vegaFile, extension, wavelengths, shifts):
+    """Resample a Vega model to wavelengths, shifted by each of shifts (in pixels of wavelengths).
+
+    Resampled models are kept in a small least recently used cache, so frames of the same band
+    and wavelength grid only resample vega_ext.fits once.
+
+    Returns:
+        a read-only array with one resampled model per shift; it is shared with later calls,
+        so copy it before changing it.
+    """
+    key = (vegaFile, extension, len(wavelengths), float(wavelengths[0]), float(wavelengths[-1]), tuple(shifts))
+    if key in vegaModels:
+        models = vegaModels.pop(key)
+    else:
+        with astropy.io.fits.open(vegaFile) as vega:
+            model = vega[extension].data.astype(float)
+            vegaWavelengths = getSpectrumWavelengths(vega[extension].header, len(model))
+        step = (wavelengths[-1] - wavelengths[0]) / max(len(wavelengths) - 1, 1)
+        shiftedWavelengths = wavelengths[np.newaxis, :] + np.asarray(shifts)[:, np.newaxis] * step
+        models = np.interp(shiftedWavelengths.ravel(), vegaWavelengths, model, left=1., right=1.).reshape(shiftedWavelengths.shape)
+        models.flags.writeable = False
+    vegaModels[key] = models
+    while len(vegaModels) > VEGA_MODEL_CACHE_SIZE:
+        vegaModels.popitem(last=False)
+    return models
+
+#-----------------------------------------------------------------------------#
+
+def removeVegaLines(wavelengths, spectrum, vegaFile, extension, sample="*", maxShift=3., shiftStep=0.05):
+    """Remove the hydrogen lines of an A0V standard star spectrum by dividing it by a Vega model.
+
+    Like iraf.telluric, the model is shifted and raised to the power scale. Every trial shift
+    of the model is tried at once; for each the scale is the least squares solution that
+    removes the lines, with a straight continuum, over the sample region. The shift and scale
+    with the smallest residuals are used.
+
+    Args:
+        wavelengths (array): wavelength of each pixel of spectrum.
+        spectrum (array): 1D standard star spectrum.
+        vegaFile (string): Vega models; Eg: runtimeData/vega_ext.fits.
+        extension (int): extension of vegaFile with the model of the band of spectrum.
+        sample (string): iraf sample ranges, in wavelengths, around the hydrogen lines.
+        maxShift, shiftStep (float): range and step of trial shifts, in pixels.
+
+    Returns:
+        corrected spectrum, shift and scale.
+    """
+    spectrum = np.asarray(spectrum, dtype=float)
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    shifts = np.arange(-maxShift, maxShift + shiftStep / 2., shiftStep)
+    models = getVegaModels(vegaFile, extension, wavelengths, shifts)
+
+    used = getSampleMask(sample, wavelengths) & np.isfinite(spectrum) & (spectrum > 0) & np.all(models > 0, axis=0)
+    logSpectrum = np.log(spectrum[used])
+    logModels = np.log(models[:, used])
+    # Remove a straight continuum from both, then solve for the scale of each shift at once.
+    x = wavelengths[used] - wavelengths[used].mean()
+    continuum = np.vstack([np.ones(len(x)), x]).T
+    projection = np.dot(continuum, np.linalg.pinv(continuum))
+    logSpectrum = logSpectrum - np.dot(projection, logSpectrum)
+    logModels = logModels - np.dot(logModels, projection.T)
+    scales = np.dot(logModels, logSpectrum) / np.maximum(np.sum(logModels**2, axis=1), 1e-30)
+    scales = np.maximum(scales, 0.)
+    residuals = np.sum((logSpectrum[np.newaxis, :] - scales[:, np.newaxis] * logModels)**2, axis=1)
+    best = int(np.argmin(residuals))
+
+    corrected = spectrum / models[best]**scales[best]
+    return corrected, float(shifts[best]), float(scales[best])
+
+#-----------------------------------------------------------------------------#
+
+def makePlanckSpectrum(temperature, wstart, wdelt, npix, continuum=1000.):
+    """Make a blackbody spectrum B_lambda on a linear wavelength grid, like iraf.mk1dspec.
+
+    Pixel i is at wstart + i * wdelt Angstroms. Like mk1dspec, the spectrum is scaled to
+    continuum at the first pixel. Frames of an observation share the standard star temperature
+    and wavelength grid, so spectra are kept by (temperature, grid) and only made once.
+
+    Returns:
+        a 1D array of npix values.
+    """
+    key = (float(temperature), float(wstart), float(wdelt), int(npix))
+    if key not in blackBodies:
+        wavelengths = float(wstart) + float(wdelt) * np.arange(int(npix))
+        planck = wavelengths**-5 / np.expm1(PLANCK_C2 / (wavelengths * float(temperature)))
+        blackBodies[key] = planck / planck[0]
+    return continuum * blackBodies[key]
+
+#-----------------------------------------------------------------------------#
+
+class LazyCube(object):
+    """Read parts of a data cube without reading the whole cube.
+
+    Headers are read on their own and the data of the extension is memory-mapped the first
+    time it is used, so spaxel spectra, aperture sums and wavelength slices only read the
+    parts of the file they need.
+
+    Eg:
+        with LazyCube('ctfbrsnN20100401S0182.fits') as cube:
+            spectrum = cube.spaxel(30, 30)
+
+    Args:
+        filename (string): cube file.
+        extension: extension holding the cube; 'SCI' for Gemini cubes. Cubes without named
+                   extensions use the first one.
+    """
+
+    def __init__(self, filename, extension='SCI'):
+        self.filename = filename
+        self.extension = extension
+        self.hdulist = None
+        self.headers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the memory map of the cube data."""
+        if self.hdulist is not None:
+            self.hdulist.close()
+            self.hdulist = None
+
+    def getHeader(self, extension):
+        """Header of an extension of the cube file. Reading it doesn't read any data."""
+        if extension not in self.headers:
+            try:
+                self.headers[extension] = astropy.io.fits.getheader(self.filename, extension)
+            except KeyError:
+                if extension != self.extension:
+                    raise
+                self.headers[extension] = astropy.io.fits.getheader(self.filename, 1)
+        return self.headers[extension]
+
+    @property
+    def primaryHeader(self):
+        return self.getHeader(0)
+
+    @property
+    def header(self):
+        return self.getHeader(self.extension)
+
+    @property
+    def shape(self):
+        """(wavelengths, y, x) shape of the cube, from its header."""
+        return tuple(self.header['NAXIS'+str(axis)] for axis in range(self.header['NAXIS'], 0, -1))
+
+    @property
+    def data(self):
+        """Memory-mapped cube data; indexing it only reads the needed parts of the file."""
+        if self.hdulist is None:
+            self.hdulist = astropy.io.fits.open(self.filename, memmap=True)
+        try:
+            return self.hdulist[self.extension].data
+        except KeyError:
+            return self.hdulist[1].data
+
+    def wavelengths(self):
+        """Wavelength of each slice of the cube, from CRVAL3, CD3_3 and CRPIX3."""
+        return self.header['CRVAL3'] + (np.arange(self.shape[0]) + 1 - self.header.get('CRPIX3', 1.)) * self.header.get('CD3_3', self.header.get('CDELT3', 1.))
+
+    def spaxel(self, y, x):
+        """Spectrum of one spaxel."""
+        return np.array(self.data[:, y, x])
+
+    def aperture(self, xc, yc, radius):
+        """Weighted sum of the spectra of the spaxels in a circular aperture.
+
+        The aperture is given like extractionApertures, (xc, yc, radius) with 1 as the first
+        pixel, and spaxels are weighted by the fraction of them inside it (see apertureWeights).
+        Only the spaxels of the box around the aperture are read.
+        """
+        weights = apertureWeights(self.shape[1:], [(xc, yc, radius)])[0]
+        rows = np.flatnonzero(weights.any(axis=1))
+        columns = np.flatnonzero(weights.any(axis=0))
+        if not len(rows):
+            return np.zeros(self.shape[0])
+        box = (slice(rows[0], rows[-1]+1), slice(columns[0], columns[-1]+1))
+        return np.einsum('yx,lyx->l', weights[box], self.data[(slice(None),) + box])
+
+    def slice(self, index):
+        """Image of one wavelength slice (or a range of slices, given a slice object)."""
+        return np.array(self.data[index])
+
+#-----------------------------------------------------------------------------#
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2015, 2017 Marie Lemoine-Busserolle
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+################################################################################
+#                Import some useful Python utilities/modules                   #
+################################################################################
+
+# STDLIB
+
+import os, logging, multiprocessing, multiprocessing.queues, tempfile, traceback, atexit, shutil, Queue
+from collections import OrderedDict
+
+# LOCAL
+
+# Import custom Nifty functions.
+import nifsUtils
+from nifsUtils import checkLists
+
+#--------------------------------------------------------------------#
+#                                                                    #
+#     PARALLEL                                                       #
+#                                                                    #
+#    Run independent pieces of a reduction in a pool of worker       #
+#    processes. Each worker has its own IRAF environment.            #
+#                                                                    #
+#--------------------------------------------------------------------#
+
+def getNumberOfProcesses(numberOfProcesses):
+    """Turn the numberOfProcesses config value into a process count. 0 or less means use every core."""
+    if multiprocessing.current_process().daemon:
+        # Already in a worker (eg: of nifsReduce.startConcurrent); workers can't start their own pool.
+        return 1
+    if numberOfProcesses <= 0:
+        return multiprocessing.cpu_count()
+    return int(numberOfProcesses)
+
+#-----------------------------------------------------------------------------#
+
+# In a worker process, the queue of its pool on which it reports the named tasks it starts.
+workerTaskStarts = None
+
+def initIrafWorker(path, taskStartQueue=None, uparmDirectory=None):
+    """Set up the IRAF environment of a new worker process.
+
+    IRAF keeps task parameters in uparm$ parameter files, so each worker gets its own
+    uparm$ directory, in the uparmDirectory of its pool. Otherwise workers running the
+    same task would overwrite each other's parameter files.
+    """
+    global workerTaskStarts
+    workerTaskStarts = taskStartQueue
+    from pyraf import iraf, iraffunctions
+    os.chdir(path)
+    iraffunctions.chdir(path)
+    uparm = tempfile.mkdtemp(prefix='niftyUparm', dir=uparmDirectory)
+    iraf.set(uparm=uparm+'/')
+
+#-----------------------------------------------------------------------------#
+
+# Worker pools of this process, by number of processes. They are kept between steps
+# and observations so workers only load and set up IRAF packages once.
+pools = {}
+# Queues on which the workers of each pool report the named tasks they start, as (name, pid).
+taskStarts = {}
+# Directory holding the uparm$ directories of the workers of each pool; removed with the pool.
+uparmDirectories = {}
+# AsyncResults of the tasks given to each pool by runFrameGraph.
+asyncResults = {}
+# Seconds runFrameGraph waits for a result before checking its workers are still alive.
+WORKER_POLL_INTERVAL = 5.
+
+def getPool(numberOfProcesses):
+    """Return a pool of numberOfProcesses warm worker processes, starting it the first time."""
+    if numberOfProcesses not in pools:
+        # Puts on a SimpleQueue are written before they return, so a report isn't lost if the
+        # worker dies straight after it.
+        taskStarts[numberOfProcesses] = multiprocessing.queues.SimpleQueue()
+        uparmDirectories[numberOfProcesses] = tempfile.mkdtemp(prefix='niftyUparm')
+        asyncResults[numberOfProcesses] = []
+        pools[numberOfProcesses] = multiprocessing.Pool(numberOfProcesses, initializer=initIrafWorker, \
+                                                        initargs=(os.getcwd(), taskStarts[numberOfProcesses], uparmDirectories[numberOfProcesses]))
+    return pools[numberOfProcesses]
+
+def closePools():
+    """Stop the worker pools of this process and remove their uparm$ directories."""
+    for numberOfProcesses, pool in pools.items():
+        if not all(result.ready() for result in asyncResults[numberOfProcesses]):
+            # A task was lost with a worker that died; join would wait for it forever.
+            pool.terminate()
+        else:
+            pool.close()
+            pool.join()
+        shutil.rmtree(uparmDirectories[numberOfProcesses], ignore_errors=True)
+    pools.clear()
+    taskStarts.clear()
+    uparmDirectories.clear()
+    asyncResults.clear()
+
+atexit.register(closePools)
+
+def isProcessAlive(pid):
+    """True if the process pid is running. Dead pool workers are reaped by the pool, so their pids are gone."""
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+#-----------------------------------------------------------------------------#
+
+def makeWorkerTask(function, args, name=None):
+    """Package function(*args) with what a warm worker needs to run it like this process would.
+
+    Workers are reused across steps and observations, so the task carries the current
+    directory and the nifsUtils settings that steps set in their start functions. If name
+    is given, the worker reports the task and its process id when it starts it.
+    """
+    state = (nifsUtils.checkDependencies, nifsUtils.journalFile, nifsUtils.resumeFromJournal, dict(nifsUtils.scratchDirectories))
+    return (function, args, os.getcwd(), state, name)
+
+def runWorkerTask(task):
+    """Run one task from makeWorkerTask in a worker. Returns a traceback string on failure."""
+    function, args, path, state, name = task
+    if name is not None and workerTaskStarts is not None:
+        workerTaskStarts.put((name, os.getpid()))
+    try:
+        if os.getcwd() != path:
+            from pyraf import iraffunctions
+            os.chdir(path)
+            iraffunctions.chdir(path)
+        if multiprocessing.current_process().daemon:
+            checkDependencies, journalFile, resumeFromJournal, scratchDirectories = state
+            nifsUtils.setDependencyChecks(checkDependencies)
+            nifsUtils.setJournal(journalFile, resumeFromJournal)
+            nifsUtils.setScratchDirectories(scratchDirectories)
+        function(*args)
+    except (Exception, SystemExit):
+        # Steps raise SystemExit on bad input; it must not kill the worker and lose the task.
+        return traceback.format_exc()
+    return None
+
+#-----------------------------------------------------------------------------#
+
+def runFrameParallel(step, frames, args, numberOfProcesses, outPrefix, pairedFrames=None):
+    """Run a per-frame reduction step on frames, splitting the frames between worker processes.
+
+    Frames of an observation are independent, so each worker calls step(chunk, *args)
+    on its own subset of frames in the current observation directory. The outputs of
+    all workers are then checked with checkLists.
+
+    Args:
+        step: a function taking a list of frames as its first argument. Eg: nifsReduce.fixBad.
+        frames (list): frames to run step on.
+        args (tuple): other arguments of step.
+        numberOfProcesses (int): number of worker processes; 0 means one per core.
+        outPrefix (string): prefix step adds to frame names. Used to check outputs exist.
+        pairedFrames (list): optional list matching frames one to one, like the sky frame
+                             of each science frame. It is split the same way as frames and
+                             passed to step as its second argument.
+
+    Returns:
+        frames that have an output.
+    """
+    if pairedFrames is None:
+        pairs = [(frame, None) for frame in frames]
+    else:
+        pairs = zip(frames, pairedFrames)
+    # A frame can appear more than once (eg: a sky shared by several science frames);
+    # it must only be given to one worker.
+    uniquePairs = []
+    for pair in pairs:
+        if pair not in uniquePairs:
+            uniquePairs.append(pair)
+
+    numberOfProcesses = min(getNumberOfProcesses(numberOfProcesses), len(uniquePairs))
+    if numberOfProcesses <= 1:
+        if pairedFrames is None:
+            step(frames, *args)
+        else:
+            step(frames, pairedFrames, *args)
+        return checkLists(frames, '.', outPrefix, '.fits')
+
+    # Interleave frames so each worker gets a similar mix of the observation.
+    tasks = []
+    for i in range(numberOfProcesses):
+        chunk = uniquePairs[i::numberOfProcesses]
+        stepArgs = ([pair[0] for pair in chunk],)
+        if pairedFrames is not None:
+            stepArgs += ([pair[1] for pair in chunk],)
+        tasks.append(makeWorkerTask(step, stepArgs + tuple(args)))
+
+    logging.info("\nRunning " + step.__name__ + " on " + str(len(uniquePairs)) + " frames with " + str(numberOfProcesses) + " processes.")
+    errors = getPool(numberOfProcesses).map(runWorkerTask, tasks, chunksize=1)
+    for error in errors:
+        if error:
+            logging.info("\nA worker process failed in " + step.__name__ + ":\n" + error)
+    return checkLists(frames, '.', outPrefix, '.fits')
+
+#-----------------------------------------------------------------------------#
+
+def runFrameGraph(graph, numberOfProcesses):
+    """Run a graph of reduction tasks, starting each task as soon as its dependencies are done.
+
+    graph is an OrderedDict of name: (function, args, dependencies, output) or
+    (function, args, dependencies, output, after). A task runs function(*args) once every
+    task named in dependencies has made its output file, and every task named in after has
+    finished, whether or not it made its output. If a task fails or does not make its
+    output, tasks depending on it are skipped.
+
+    Ready tasks are started in the order of graph, and only numberOfProcesses tasks are
+    queued at a time. If graph lists all the tasks of one frame before the next frame,
+    frames flow through the reduction one after the other instead of step by step.
+
+    If a worker process dies while running a task (Eg: IRAF crashes), the task never
+    returns a result. While waiting, the workers are checked every WORKER_POLL_INTERVAL
+    seconds and a task whose worker died is counted as failed; the pool starts a new worker.
+
+    Args:
+        graph (OrderedDict): the tasks to run; dependencies must be listed before the tasks using them.
+        numberOfProcesses (int): number of worker processes; 0 means one per core.
+
+    Returns:
+        names of the tasks that made their output.
+    """
+    done = set()
+    failed = set()
+
+    def unpack(task):
+        """Returns function, args, dependencies, output and after of a task of graph."""
+        return tuple(task) + ((),) * (5 - len(task))
+
+    def finish(name, error):
+        output = graph[name][3]
+        if error:
+            logging.info("\nTask " + name + " failed:\n" + error)
+        if not error and os.path.exists(output):
+            done.add(name)
+        else:
+            logging.info("\nWARNING: " + output + " was not made; skipping the tasks that depend on it.")
+            failed.add(name)
+
+    numberOfProcesses = getNumberOfProcesses(numberOfProcesses)
+    if numberOfProcesses <= 1:
+        for name, task in graph.iteritems():
+            function, args, dependencies, output, after = unpack(task)
+            if not all(dependency in done for dependency in dependencies):
+                failed.add(name)
+                continue
+            finish(name, runWorkerTask(makeWorkerTask(function, args)))
+        return done
+
+    pending = OrderedDict(graph)
+    running = set()
+    finished = Queue.Queue()
+    pool = getPool(numberOfProcesses)
+    starts = taskStarts[numberOfProcesses]
+    results = asyncResults[numberOfProcesses]
+    # Forget the results of earlier graphs that finished.
+    results[:] = [result for result in results if not result.ready()]
+    workerOfTask = {}
+    # Forget tasks started by earlier graphs.
+    while not starts.empty():
+        starts.get()
+    while pending or running:
+        for name in list(pending):
+            if len(running) >= numberOfProcesses:
+                break
+            function, args, dependencies, output, after = unpack(pending[name])
+            if any(dependency in failed for dependency in dependencies):
+                failed.add(name)
+                del pending[name]
+            elif all(dependency in done for dependency in dependencies) and \
+                 all(task in done or task in failed or task not in graph for task in after):
+                del pending[name]
+                running.add(name)
+                results.append(pool.apply_async(runWorkerTask, (makeWorkerTask(function, args, name),), callback=lambda error, name=name: finished.put((name, error))))
+        if not running:
+            # Whatever is left depends on tasks that are not in graph.
+            for name in pending:
+                logging.info("\nWARNING: task " + name + " has missing dependencies; skipping it.")
+                failed.add(name)
+            break
+        # A timeout keeps the wait interruptible with ctrl-c, and lets us check the workers.
+        try:
+            name, error = finished.get(timeout=WORKER_POLL_INTERVAL)
+        except Queue.Empty:
+            while not starts.empty():
+                started, pid = starts.get()
+                if started in running:
+                    workerOfTask[started] = pid
+            for name in list(running):
+                if name in workerOfTask and not isProcessAlive(workerOfTask[name]):
+                    running.discard(name)
+                    finish(name, "The worker process running " + name + " (pid " + str(workerOfTask[name]) + ") died.")
+            continue
+        if name in running:
+            running.discard(name)
+            finish(name, error)
+    return done
+
+#-----------------------------------------------------------------------------#
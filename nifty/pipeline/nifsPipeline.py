@@ -34,13 +34,8 @@ from datetime import datetime
 
 # LOCAL
 
-# Import major Nifty Steps.
-import steps.nifsSort as nifsSort
-import steps.nifsBaselineCalibration as nifsBaselineCalibration
-import steps.nifsReduce as nifsReduce
-import steps.nifsTelluric as nifsTelluric
-import steps.nifsFluxCalibrate as nifsFluxCalibrate
-import steps.nifsMerge as nifsMerge
+# Major Nifty Steps are imported by the stages that run them; importing them
+# loads pyraf and astropy, which is slow.
 # Import nifs utilities module.
 import nifsUtils as nifsUtils
 # Import configuration file parsing.
@@ -165,6 +160,8 @@ def start(args):
         telluricCorrection = nifsPipelineConfig['telluricCorrection']
         fluxCalibration = nifsPipelineConfig['fluxCalibration']
         merge = nifsPipelineConfig['merge']
+        # Number of telluric and science observations reduced at once.
+        observationConcurrency = nifsPipelineConfig.get('observationConcurrency', 1)
 
     ###########################################################################
     ##                         SETUP COMPLETE                                ##
@@ -185,6 +182,7 @@ def start(args):
     if sort:
         if manualMode:
             a = raw_input('About to enter nifsSort.')
+        import steps.nifsSort as nifsSort
         nifsSort.start()
     # By now, we should have paths to the three types of raw data. Print them out.
     printDirectoryLists()
@@ -196,38 +194,54 @@ def start(args):
     if calibrationReduction:
         if manualMode:
             a = raw_input('About to enter nifsBaselineCalibration.')
+        import steps.nifsBaselineCalibration as nifsBaselineCalibration
         nifsBaselineCalibration.start()
 
     ###########################################################################
     ##                STEP 3: Reduce telluric observations.                  ##
     ###########################################################################
 
-    if telluricReduction:
-        if manualMode:
-            a = raw_input('About to enter nifsReduce to reduce Tellurics.')
-        nifsReduce.start('Telluric')
+    if observationConcurrency > 1 and not manualMode and (telluricReduction or scienceReduction):
+        # Reduce telluric and science observations (steps 3 and 4) at the same time.
+        kinds = []
+        if telluricReduction:
+            kinds.append('Telluric')
+        if scienceReduction:
+            kinds.append('Science')
+        import steps.nifsReduce as nifsReduce
+        nifsReduce.startConcurrent(kinds, observationConcurrency)
+    else:
+        if telluricReduction:
+            if manualMode:
+                a = raw_input('About to enter nifsReduce to reduce Tellurics.')
+            import steps.nifsReduce as nifsReduce
+            nifsReduce.start('Telluric')
 
     ###########################################################################
     ##                 STEP 4: Reduce science observations.                  ##
     ###########################################################################
 
-    if scienceReduction:
-        if manualMode:
-            a = raw_input('About to enter nifsReduce to reduce science.')
-        nifsReduce.start('Science')
+        if scienceReduction:
+            if manualMode:
+                a = raw_input('About to enter nifsReduce to reduce science.')
+            import steps.nifsReduce as nifsReduce
+            nifsReduce.start('Science')
     if telluricCorrection:
         if manualMode:
             a = raw_input('About to enter nifsTelluric to make and create telluric corrected cubes.')
+        import steps.nifsTelluric as nifsTelluric
         nifsTelluric.run()
 
     if fluxCalibration:
         if manualMode:
             a = raw_input('About to enter nifsFluxCalibrate to make and create flux calibrated and telluric corrected cubes.')
+        import steps.nifsFluxCalibrate as nifsFluxCalibrate
         nifsFluxCalibrate.run()
 
     if merge:
         if manualMode:
             a = raw_input('About to enter nifsMerge to merge final 3D data cubes to single cubes.')
+        import steps.nifsMerge as nifsMerge
         nifsMerge.run()
 
     ###########################################################################
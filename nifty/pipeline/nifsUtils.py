@@ -26,11 +26,11 @@
 
 # STDLIB
 
-import time, sys, calendar, astropy.io.fits, urllib, shutil, glob, os, fileinput, logging, smtplib, pkg_resources, math, re, collections, requests, hashlib, tempfile
-import numpy as np
+import time, sys, calendar, urllib, shutil, glob, os, fileinput, logging, smtplib, pkg_resources, math, re, collections, hashlib, tempfile, gzip, json
 from xml.dom.minidom import parseString
-from pyraf import iraf
-from astroquery.cadc import Cadc
+
+# pyraf, astropy, astroquery, numpy and requests are slow to import; they are imported
+# by the functions that use them so the pipeline starts quickly when they aren't needed.
 
 # LOCAL
 
@@ -292,7 +292,7 @@ def interactiveNIFSInput():
         hLineMethod = getParam(
         "H-line removal method? [vega]: ",
         "none",
-        "Nifty can attempt to remove H-lines from a telluric correction spectrum. The available options are \"vega\" and \"none\"."
+        "Nifty can attempt to remove H-lines from a telluric correction spectrum. The available options are \"vega\", \"vegaNative\" (without iraf) and \"none\"."
         )
         # Some of these are disabled (for now!) because of bugs in interactive Pyraf tasks.
         # TODO(nat): when interactive is fixed re-enable this.
@@ -596,34 +596,41 @@ def copyCalibrationDatabase(inputPrefix, grating, fileType, over):
 def replaceNameDatabaseFiles(inputFile, oldFileName, newFileName):
     """
     Replace old filenames in database text files with new file names.
+
+    The new text is written to a temporary file next to inputFile and renamed over it, so
+    calls running at the same time (Eg: in worker processes) can't mix up their files.
     """
     with open(inputFile, "r") as f:
         lines = f.read()
     modifiedLines = re.sub(oldFileName, newFileName, lines)
-    with open("temp.txt", "w") as f:
+    handle, temporary = tempfile.mkstemp(prefix=os.path.basename(inputFile)+'.', dir=os.path.dirname(inputFile) or '.')
+    with os.fdopen(handle, "w") as f:
         f.write(modifiedLines)
-    shutil.move("temp.txt", inputFile)
+    shutil.copymode(inputFile, temporary)
+    os.rename(temporary, inputFile)
 
 
 #-----------------------------------------------------------------------------#
 def copyResultsToScience(inputFile, outputFile, over):
     """
-
+    Copy inputFile to the products_telluric_corrected/ directory of every science
+    observation, as outputFile. Science directories get their own copy, so rerunning or
+    cleaning the telluric observation doesn't change the inputs of their reductions.
     """
     # Also copy it over to the relevant science directories.
     for scienceDirectory in glob.glob('../../obs*'):
         # Make sure the cals directory exists.
         if not os.path.exists(scienceDirectory+'/products_telluric_corrected'):
             os.mkdir(scienceDirectory+'/products_telluric_corrected')
-        # Check if the file exists; if not, copy it over.
-        if os.path.exists(scienceDirectory+'/products_telluric_corrected/'+outputFile):
+        destination = scienceDirectory+'/products_telluric_corrected/'+outputFile
+        # Check if the file exists; if not, copy it over. Links left by older versions are replaced too.
+        if os.path.lexists(destination):
             if over:
-                os.remove(scienceDirectory+'/products_telluric_corrected/'+outputFile)
-                shutil.copy(inputFile, scienceDirectory+'/products_telluric_corrected/'+outputFile)
+                os.remove(destination)
             else:
                 logging.info("\nOutput exists and -over not set - skipping copy of file to science directory")
-        else:
-            shutil.copy(inputFile, scienceDirectory+'/products_telluric_corrected/'+outputFile)
+                continue
+        shutil.copy(inputFile, destination)
 
 #-----------------------------------------------------------------------------#
 
@@ -634,6 +641,7 @@ def rewriteSciImageList(threshold, kind):
     Else append to new scienceFrameList.
     Write out both lists at end.
     """
+    import astropy.io.fits
     skyFrameList = open('skyFrameList', "r").readlines()
     skyFrameList = [image.strip() for image in skyFrameList]
     firstImage = astropy.io.fits.open(skyFrameList[0]+'.fits')
@@ -973,6 +981,251 @@ def checkLists(original_list, path, prefix, suffix):
 
 #-----------------------------------------------------------------------------#
 
+# Whether framesToProcess rebuilds outputs whose inputs changed. Set with setDependencyChecks.
+checkDependencies = False
+
+def setDependencyChecks(enabled):
+    """Turn make-style dependency checks of framesToProcess on or off."""
+    global checkDependencies
+    checkDependencies = enabled
+
+#-----------------------------------------------------------------------------#
+
+def getDependencyRecord(inputs, parameters):
+    """Return the size and modification time of each input file and a hash of the parameters."""
+    record = {'inputs': {}, 'parameters': hashlib.md5(repr(parameters)).hexdigest()}
+    for path in inputs:
+        if os.path.isfile(path):
+            status = os.stat(path)
+            record['inputs'][path] = [status.st_size, status.st_mtime]
+    return record
+
+#-----------------------------------------------------------------------------#
+
+def getDependencyRecordName(output):
+    """Name of the hidden file storing the dependency record of output."""
+    directory, name = os.path.split(output)
+    return os.path.join(directory, '.'+name+'.deps')
+
+#-----------------------------------------------------------------------------#
+
+def writeDependencyRecord(output, inputs, parameters):
+    """Store what output was made from, so framesToProcess can tell when it goes stale."""
+    with open(getDependencyRecordName(output), 'w') as f:
+        json.dump(getDependencyRecord(inputs, parameters), f)
+
+#-----------------------------------------------------------------------------#
+
+def isUpToDate(output, inputs, parameters):
+    """True if output was made from the same inputs (same sizes and times) and parameters as now."""
+    try:
+        with open(getDependencyRecordName(output), 'r') as f:
+            record = json.load(f)
+    except (IOError, ValueError):
+        return False
+    return record == json.loads(json.dumps(getDependencyRecord(inputs, parameters)))
+
+#-----------------------------------------------------------------------------#
+
+# Journal of completed (directory, frame, step) units. Set with setJournal.
+journalFile = ""
+resumeFromJournal = False
+journalCache = {'size': -1, 'units': set()}
+# Scratch directories (see stageToScratch) and the observation directory each one reduces.
+scratchDirectories = {}
+
+def setScratchDirectories(directories):
+    """Set the scratch directories of this process; a dictionary of scratch to observation directories."""
+    scratchDirectories.clear()
+    scratchDirectories.update(directories)
+
+def getJournalDirectory(directory=""):
+    """Return the directory units of directory are journaled under; the observation directory of a scratch directory."""
+    directory = os.path.realpath(directory or os.getcwd())
+    for scratchDirectory, observationDirectory in scratchDirectories.items():
+        if directory == scratchDirectory or directory.startswith(scratchDirectory+os.sep):
+            return os.path.realpath(observationDirectory) + directory[len(scratchDirectory):]
+    return directory
+
+def setJournal(path, resume=False):
+    """Start journaling completed units to path. If resume is set, units in the journal are treated as done."""
+    global journalFile, resumeFromJournal
+    journalFile = path
+    resumeFromJournal = resume
+
+#-----------------------------------------------------------------------------#
+
+def journalUnit(frame, step, directory="", state=""):
+    """Add a completed (directory, frame, step) unit to the journal. directory defaults to the current directory.
+
+    Units are marked as started before they run by passing state='started'; see startUnit.
+    """
+    if not journalFile:
+        return
+    directory = getJournalDirectory(directory)
+    # One short appended line per unit; flushed to disk so it survives a crash.
+    with open(journalFile, 'a') as f:
+        f.write(directory+'\t'+str(frame)+'\t'+str(step)+('\t'+state if state else '')+'\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+#-----------------------------------------------------------------------------#
+
+def startUnit(frame, step, over, directory=""):
+    """Mark a (directory, frame, step) unit as started in the journal before it runs.
+
+    Returns the over flag to run the unit with: over, or True if resuming from the journal
+    and an earlier run started the unit without finishing it, as its outputs may be partial.
+    Outputs of units that were never started are left to over.
+    """
+    unitOver = over or (isJournaled(frame, step, directory, state='started') and not isJournaled(frame, step, directory))
+    journalUnit(frame, step, directory, state='started')
+    return unitOver
+
+#-----------------------------------------------------------------------------#
+
+def isJournaled(frame, step, directory="", state=""):
+    """True if resuming from the journal and the (directory, frame, step) unit is in it; as started if state is 'started'."""
+    if not (journalFile and resumeFromJournal and os.path.exists(journalFile)):
+        return False
+    size = os.path.getsize(journalFile)
+    if size != journalCache['size']:
+        with open(journalFile, 'r') as f:
+            journalCache['units'] = set(tuple(line.rstrip('\n').split('\t')) for line in f)
+        journalCache['size'] = size
+    unit = (getJournalDirectory(directory), str(frame), str(step)) + ((state,) if state else ())
+    return unit in journalCache['units']
+
+#-----------------------------------------------------------------------------#
+
+def recordOutputs(frames, outPrefix, dependencies=None):
+    """Journal the frames that have an outPrefix output and, if dependency checks are on, record their dependencies."""
+    for frame in frames:
+        frame = str(frame).strip()
+        if os.path.exists(outPrefix+frame+'.fits'):
+            if checkDependencies and dependencies:
+                writeDependencyRecord(outPrefix+frame+'.fits', *dependencies(frame))
+            journalUnit(frame, outPrefix)
+
+#-----------------------------------------------------------------------------#
+
+def writeFits(hdulist, filename, **kwargs):
+    """Write a FITS file under a temporary name and rename it when complete.
+
+    A crash while writing then can't leave a partial file that later steps would take
+    for a finished one.
+    """
+    temporary = filename+'.part'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    hdulist.writeto(temporary, **kwargs)
+    os.rename(temporary, filename)
+
+#-----------------------------------------------------------------------------#
+
+def framesToProcess(frames, outPrefix, over, suffix='.fits', dependencies=None):
+    """Return the frames whose outPrefix+frame+suffix output still has to be made.
+
+    If over is set, old outputs are deleted and every frame is returned. Otherwise frames
+    with an existing output are skipped; unless dependency checks are on (see
+    setDependencyChecks) and dependencies(frame), a tuple of (input files, parameters),
+    differs from what the output was made from, or unless resuming from the journal
+    (see setJournal) and the output isn't in it, as it may be partial.
+
+    Single outputs that aren't named after a frame (Eg: a combined sky) can be checked by
+    passing their full name, without .fits, as the frame and "" as outPrefix. Steps that
+    don't go through this (Eg: the IRAF steps of the baseline calibrations) still only
+    follow over.
+    """
+    todo = []
+    for frame in frames:
+        frame = str(frame).strip()
+        if frame in todo:
+            # Eg: a sky frame shared by several science frames.
+            continue
+        output = outPrefix+frame+suffix
+        if os.path.exists(output):
+            if over:
+                os.remove(output)
+            elif resumeFromJournal and not isJournaled(frame, outPrefix):
+                logging.info("Output file " + output + " is not in the journal and may be partial - remaking it")
+                os.remove(output)
+            elif checkDependencies and dependencies and not isUpToDate(output, *dependencies(frame)):
+                logging.info("Inputs or parameters of " + output + " changed - remaking it")
+                os.remove(output)
+            else:
+                logging.info("Output file " + output + " exists and -over not set - skipping it")
+                continue
+        todo.append(frame)
+    return todo
+
+#-----------------------------------------------------------------------------#
+
+def writeIrafList(frames, prefix):
+    """Write prefix+frame for each frame to a new list file. Returns the file name."""
+    handle, listFile = tempfile.mkstemp(prefix=prefix+'list', suffix='.lis', dir='.')
+    with os.fdopen(handle, 'w') as f:
+        for frame in frames:
+            f.write(prefix+str(frame).strip()+'\n')
+    return os.path.basename(listFile)
+
+#-----------------------------------------------------------------------------#
+
+def runIrafTaskOnFrames(task, frames, inPrefix, outPrefix, over, **kwargs):
+    """Run a per-frame iraf task once on all frames that need it, using an @list input.
+
+    Starting an iraf task and reading its parameter file costs about as much as
+    processing a small frame, so frames are given to the task in a single call instead
+    of one call per frame. Frames are skipped or redone following the usual over
+    behaviour and, if they are on, dependency checks (see framesToProcess). If the
+    batched call fails part way through, the frames left without an output are
+    retried one at a time so one bad frame can't stop the rest.
+    benchmarks/benchmarkIrafBatching.py times this against one call per frame.
+
+    Args:
+        task: iraf task to run. Eg: iraf.nffixbad.
+        frames (list): frame names, without prefixes or .fits.
+        inPrefix (string): prefix of the task's input files. Eg: "rsn".
+        outPrefix (string): prefix of the task's output files. Eg: "brsn".
+        over (boolean): overwrite old outputs.
+        kwargs: other parameters of the iraf task.
+
+    Returns:
+        frames that have an output, checked with checkLists.
+    """
+    # Files named in kwargs (Eg: the flat) are inputs of every frame; directories like
+    # database/ are left out as tasks write to them.
+    fileInputs = []
+    for value in kwargs.values():
+        if isinstance(value, basestring) and value:
+            for path in (value, value+'.fits'):
+                if os.path.isfile(path):
+                    fileInputs.append(path)
+    name = task.getName() if hasattr(task, 'getName') else str(task)
+    parameters = (name, sorted((key, value) for key, value in kwargs.items() if key != 'logfile'))
+    dependencies = lambda frame: ([inPrefix+frame+'.fits'] + fileInputs, parameters)
+
+    todo = framesToProcess(frames, outPrefix, over, dependencies=dependencies)
+    if todo:
+        listFile = writeIrafList(todo, inPrefix)
+        try:
+            task('@'+listFile, **kwargs)
+        except Exception as e:
+            logging.info("\nBatched call of " + str(task) + " failed with: " + str(e))
+        finally:
+            os.remove(listFile)
+        for frame in todo:
+            if not os.path.exists(outPrefix+frame+'.fits'):
+                logging.info("\nNo " + outPrefix+frame + ".fits after batched call; retrying " + frame + " on its own.")
+                try:
+                    task(inPrefix+frame, **kwargs)
+                except Exception as e:
+                    logging.info("\n" + str(task) + " failed on " + inPrefix+frame + ": " + str(e))
+        recordOutputs(todo, outPrefix, dependencies)
+    return checkLists(frames, '.', outPrefix, '.fits')
+
+#-----------------------------------------------------------------------------#
+
 def checkSameLengthFlatLists():
     """Reads two textfile lists of filenames. If not the same length,
     removes last entry from longer list until they are. Prints loud warnings to
@@ -1145,6 +1398,7 @@ def convertRAdec(ra, dec):
 def timeCalc(image):
     """Read time from .fits header. Convert to a float of seconds.
     """
+    import astropy.io.fits
     telheader = astropy.io.fits.open(image)
     UT = telheader[0].header['UT']
     secs = float(UT[6:10])
@@ -1157,6 +1411,7 @@ def timeCalc(image):
 #-----------------------------------------------------------------------------#
 
 def MEFarithpy(MEF, image, op, result):
+    import astropy.io.fits
 
     if os.path.exists(result):
         os.remove(result)
@@ -1168,10 +1423,12 @@ def MEFarithpy(MEF, image, op, result):
                 scimage[i]=scimage[i]*arithim
             if op=='divide':
                 scimage[i]=scimage[i]/arithim
-    scimage.writeto(result, output_verify='ignore')
+    writeFits(scimage, result, output_verify='ignore')
 #-----------------------------------------------------------------------------#
 
 def MEFarith(MEF, image, op, result):
+    import astropy.io.fits
+    from pyraf import iraf
 
     if os.path.exists(result):
         os.remove(result)
@@ -1191,6 +1448,7 @@ def downloadQueryCadc(program, directory='./rawData'):
     Finds and downloads all CADC files for a particular gemini program ID to
     the current working directory.
     """
+    from astroquery.cadc import Cadc
 
     cadc = Cadc()
     job = cadc.create_async("SELECT observationID, publisherID, productID FROM caom2.Observation \
@@ -1221,6 +1479,7 @@ def getFile(url):
     """
     Gets a file from the specified url and returns the filename.
     """
+    import requests
     r = requests.get(url, stream=True)
     # Parse out filename from header
     try:
@@ -1264,10 +1523,139 @@ def writeWithTempFile(request, filename):
 
     return filename
 
+#-----------------------------------------------------------------------------#
+
+def getCachePath(subdirectory, cachePath=""):
+    """
+    Returns the path to a subdirectory of the persistent Nifty cache, creating it if needed.
+
+    The cache lives in ~/.nifty/cache unless cachePath is set in config.cfg. It
+    holds results that can be shared between data reductions; Eg: previous wavelength
+    solutions of the same instrument configuration.
+    """
+    if not cachePath:
+        cachePath = os.path.join(os.path.expanduser('~'), '.nifty', 'cache')
+    path = os.path.join(cachePath, subdirectory)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+#-----------------------------------------------------------------------------#
+
+def pruneCache(directory, maxSize=0, maxAge=0):
+    """
+    Removes files of a cache directory that are older than maxAge days, then the least
+    recently used files until the directory holds at most maxSize GB. Files are aged by
+    modification time, which cache users update when they reuse a file. A limit of 0 means
+    no limit.
+    """
+    files = []
+    for item in os.listdir(directory):
+        path = os.path.join(directory, item)
+        if os.path.isfile(path):
+            status = os.stat(path)
+            files.append((status.st_mtime, status.st_size, path))
+    files.sort()
+    now = time.time()
+    total = sum(size for mtime, size, path in files)
+    removed = 0
+    for mtime, size, path in files:
+        tooOld = maxAge > 0 and now - mtime > maxAge * 86400.
+        tooBig = maxSize > 0 and total > maxSize * 1e9
+        if not (tooOld or tooBig):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            # Another reduction may have removed it.
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        logging.info("\nRemoved " + str(removed) + " old files from the cache directory " + directory)
 
+#-----------------------------------------------------------------------------#
 
 
+def stageToScratch(observationDirectory, scratchPath):
+    """
+    Makes a scratch directory for reducing an observation on local disk.
 
+    Files of the observation directory (raw frames, lists, copied calibrations) and the
+    calibrations/ directory are symlinked into the scratch directory; database/ is copied
+    as iraf tasks write to it. Units done in the scratch directory are journaled under the
+    observation directory. Returns the path to the scratch directory.
+    """
+    if not os.path.exists(scratchPath):
+        os.makedirs(scratchPath)
+    scratchDirectory = tempfile.mkdtemp(prefix=os.path.basename(observationDirectory.rstrip(os.sep))+'_', dir=scratchPath)
+    for item in os.listdir(observationDirectory):
+        source = os.path.join(observationDirectory, item)
+        if item == 'database':
+            shutil.copytree(source, os.path.join(scratchDirectory, item))
+        elif os.path.isfile(source) or item == 'calibrations':
+            os.symlink(source, os.path.join(scratchDirectory, item))
+    scratchDirectories[os.path.realpath(scratchDirectory)] = os.path.realpath(observationDirectory)
+    logging.info("\nReducing " + observationDirectory + " in scratch directory " + scratchDirectory)
+    return scratchDirectory
 
 #-----------------------------------------------------------------------------#
 
+def unstageFromScratch(scratchDirectory, observationDirectory, products, intermediates, over):
+    """
+    Copies the results of a scratch reduction back to the observation directory and removes the scratch directory.
+
+    Args:
+        products (list): prefixes of FITS files to copy back. Eg: ['ctfbrsn', 'gxtfbrsn'].
+        intermediates (string): what to do with the other new FITS files; 'discard' deletes them,
+                                'compress' copies them back gzipped and 'keep' copies them back.
+        over (boolean): overwrite files of the directories (Eg: products_uncorrected/) made in scratch.
+
+    Text files (Eg: telluricfile) and directories made in scratch are always copied back.
+    """
+    for item in os.listdir(scratchDirectory):
+        source = os.path.join(scratchDirectory, item)
+        destination = os.path.join(observationDirectory, item)
+        if os.path.islink(source):
+            # An input, or an output that was already in the observation directory.
+            continue
+        if os.path.isdir(source):
+            if os.path.exists(destination) and over:
+                shutil.rmtree(destination)
+            if not os.path.exists(destination):
+                os.mkdir(destination)
+            for name in os.listdir(source):
+                if over or not os.path.exists(os.path.join(destination, name)):
+                    shutil.copy2(os.path.join(source, name), os.path.join(destination, name))
+        elif not item.endswith('.fits') or any(item.startswith(prefix) for prefix in products):
+            shutil.move(source, destination)
+        elif intermediates == 'keep':
+            shutil.move(source, destination)
+        elif intermediates == 'compress':
+            with open(source, 'rb') as f_in:
+                with gzip.open(destination+'.gz', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+    shutil.rmtree(scratchDirectory)
+    scratchDirectories.pop(os.path.realpath(scratchDirectory), None)
+
+#-----------------------------------------------------------------------------#
+
+def hashFitsData(filename):
+    """
+    Returns an md5 hex digest of the data of every extension of a FITS file.
+
+    Headers are left out, as iraf tasks write time stamps to them; two runs of a task
+    on the same inputs give files with the same data but different headers.
+    """
+    import astropy.io.fits
+    import numpy as np
+    md5 = hashlib.md5()
+    with astropy.io.fits.open(filename, memmap=True) as hdulist:
+        for hdu in hdulist:
+            md5.update(str(hdu.name))
+            if hdu.data is not None:
+                md5.update(np.ascontiguousarray(hdu.data).view(np.uint8))
+    return md5.hexdigest()
+
+#-----------------------------------------------------------------------------#
@@ -28,8 +28,9 @@
 
 # STDLIB
 
-import logging, os, pkg_resources, glob, shutil, sys
+import logging, os, pkg_resources, glob, shutil, sys, json
 import astropy.io.fits
+import numpy as np
 from pyraf import iraf, iraffunctions
 
 # LOCAL
@@ -38,13 +39,17 @@ from pyraf import iraf, iraffunctions
 from ..configobj.configobj import ConfigObj
 
 # Import custom Nifty functions.
-from ..nifsUtils import datefmt, listit, checkLists, copyCalibration, copyCalibrationDatabase, replaceNameDatabaseFiles
+from ..nifsIraf import startIrafSession
+from ..nifsUtils import datefmt, listit, checkLists, copyCalibration, copyCalibrationDatabase, replaceNameDatabaseFiles, getCachePath, runIrafTaskOnFrames, setDependencyChecks, setJournal
 
 # Define constants.
 # Paths to Nifty data.
 RECIPES_PATH = pkg_resources.resource_filename('nifty', 'recipes/')
 RUNTIME_DATA_PATH = pkg_resources.resource_filename('nifty', 'runtimeData/')
 
+# Arc line lists, parsed once per process. Keys are paths to line list files.
+arcLineLists = {}
+
 def start(calibrationDirectoryList=""):
     """
          nifsBaselineCalibration
@@ -95,34 +100,8 @@ def start(calibrationDirectoryList=""):
     logging.info('#                                               #')
     logging.info('#################################################\n')
 
-    # Set up/prepare IRAF.
-    iraf.gemini()
-    iraf.nifs()
-    iraf.gnirs()
-    iraf.gemtools()
-
-    # Reset to default parameters the used IRAF tasks.
-    iraf.unlearn(iraf.gemini,iraf.gemtools,iraf.gnirs,iraf.nifs)
-
-    # From http://bishop.astro.pomona.edu/Penprase/webdocuments/iraf/beg/beg-image.html:
-    # Before doing anything involving image display the environment variable
-    # stdimage must be set to the correct frame buffer size for the display
-    # servers (as described in the dev$graphcap file under the section "STDIMAGE
-    # devices") or to the correct image display device. The task GDEVICES is
-    # helpful for determining this information for the display servers.
-    iraf.set(stdimage='imt2048')
-
-    # Prepare the IRAF package for NIFS.
-    # NSHEADERS lists the header parameters used by the various tasks in the
-    # NIFS package (excluding headers values which have values fixed by IRAF or
-    # FITS conventions).
-    iraf.nsheaders("nifs",logfile=log)
-
-    # Set clobber to 'yes' for the script. This still does not make the gemini
-    # tasks overwrite files, so:
-    # YOU WILL LIKELY HAVE TO REMOVE FILES IF YOU RE_RUN THE SCRIPT.
-    user_clobber=iraf.envget("clobber")
-    iraf.reset(clobber='yes')
+    # Set up/prepare IRAF; only done once per process.
+    startIrafSession(log)
 
     # Load reduction parameters from ./config.cfg.
     with open('./config.cfg') as config_file:
@@ -130,12 +109,17 @@ def start(calibrationDirectoryList=""):
         # Read general pipeline config.
         manualMode = config['manualMode']
         over = config['over']
+        # Also remake existing outputs whose inputs or parameters changed.
+        setDependencyChecks(config.get('checkDependencies', False))
+        setJournal(path+'/Nifty.journal', config.get('resumeFromJournal', False))
+        cachePath = config.get('cachePath', '')
         if not calibrationDirectoryList:
             calibrationDirectoryList = config['calibrationDirectoryList']
         # Read baselineCalibrationReduction specfic config.
         calibrationReductionConfig = config['calibrationReductionConfig']
         start = calibrationReductionConfig['baselineCalibrationStart']
         stop = calibrationReductionConfig['baselineCalibrationStop']
+        waveCalCache = calibrationReductionConfig.get('waveCalCache', False)
 
     ################################################################################
     # Define Variables, Reduction Lists AND identify/run number of reduction steps #
@@ -251,7 +235,7 @@ def start(calibrationDirectoryList=""):
             elif valindex == 3:
                 if manualMode:
                     a = raw_input("About to enter step 3: wavelength solution.")
-                makeWaveCal(arclist, arc, arcdarklist, arcdark, grating, log, over, path)
+                makeWaveCal(arclist, arc, arcdarklist, arcdark, grating, log, over, path, waveCalCache, cachePath)
                 print "\n###################################################################"
                 print ""
                 print "         STEP 3: Wavelength Solution (NFPREPARE and Combine arc darks.  "
@@ -359,30 +343,10 @@ def makeFlat(flatlist, flatdarklist, calflat, flatdark, grating, over, log):
     """
 
     # Update lamps on flat frames with mdf offset value and generate variance and data quality extensions.
-    for image in flatlist:
-        image = str(image).strip()
-        if os.path.exists('n'+image+'.fits'):
-            if over:
-                os.remove('n'+image+'.fits')
-                iraf.nfprepare(image+'.fits',rawpath='.',shiftim="s"+calflat, fl_vardq='yes',fl_corr='no',fl_nonl='no', logfile=log)
-            else:
-                print "Output exists and -over- not set - skipping nfprepare of lamps on flats"
-        else:
-            iraf.nfprepare(image+'.fits',rawpath='.',shiftim="s"+calflat, fl_vardq='yes',fl_corr='no',fl_nonl='no', logfile=log)
-    flatlist = checkLists(flatlist, '.', 'n', '.fits')
+    flatlist = runIrafTaskOnFrames(iraf.nfprepare, flatlist, "", "n", over, rawpath='.',shiftim="s"+calflat, fl_vardq='yes',fl_corr='no',fl_nonl='no', logfile=log)
 
     # Update lamps off flat images with offset value and generate variance and data quality extensions.
-    for image in flatdarklist:
-        image = str(image).strip()
-        if os.path.exists('n'+image+'.fits'):
-            if over:
-                iraf.delete('n'+image+'.fits')
-                iraf.nfprepare(image+'.fits',rawpath='.',shiftim="s"+calflat, fl_vardq='yes',fl_corr='no',fl_nonl='no', logfile=log)
-            else:
-                print "\nOutput exists and -over- not set - skipping nfprepare of lamps off flats."
-        else:
-            iraf.nfprepare(image+'.fits',rawpath='.',shiftim="s"+calflat, fl_vardq='yes',fl_corr='no',fl_nonl='no', logfile=log)
-    flatdarklist = checkLists(flatdarklist, '.', 'n', '.fits')
+    flatdarklist = runIrafTaskOnFrames(iraf.nfprepare, flatdarklist, "", "n", over, rawpath='.',shiftim="s"+calflat, fl_vardq='yes',fl_corr='no',fl_nonl='no', logfile=log)
 
     # Combine lamps on flat images, "n"+image+".fits". Output combined file will have name of the first flat file with "gn" prefix.
     if os.path.exists('gn'+calflat+'.fits'):
@@ -510,7 +474,7 @@ def makeFlat(flatlist, flatdarklist, calflat, flatdark, grating, over, log):
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
-def makeWaveCal(arclist, arc, arcdarklist, arcdark, grating, log, over, path):
+def makeWaveCal(arclist, arc, arcdarklist, arcdark, grating, log, over, path, waveCalCache=False, cachePath=""):
     """Determine the wavelength solution of each slice of the observation and
     set the arc coordinate file.
 
@@ -518,6 +482,12 @@ def makeWaveCal(arclist, arc, arcdarklist, arcdark, grating, log, over, path):
     one, they need only to change the "clist" variable to their line list
     in the coordli= parameter in the nswavelength call.
 
+    If waveCalCache is set and an arc was taken before with the same grating, filter and
+    central wavelength, its identified arc and database solutions are given to NSWAVELENGTH
+    as the reference solution, with its crval and cdelt as the starting guess, and the line
+    list is trimmed to the lines covered by the arc. The new solution is stored in the cache
+    for the next reduction if the configuration had none, or if -over is set.
+
     Uses  NSWAVELENGTH to calibrate arc data (after cutting and
     optionally applying a flatfield with NSREDUCE in a previous step).
 
@@ -548,37 +518,14 @@ def makeWaveCal(arclist, arc, arcdarklist, arcdark, grating, log, over, path):
 
     # Update arc images with offset value and generate variance and data
     # quality extensions. Results in "n"+image+".fits"
-    for image in arclist:
-        image = str(image).strip()
-        if os.path.exists("n"+image+".fits"):
-            if over:
-                iraf.delete("n"+image+".fits")
-            else:
-                print "\nOutput file exists and -over not set - skipping nfprepare of arcs."
-                continue
-        iraf.nfprepare(image, rawpath=".", shiftimage=shiftima,bpm=sflat_bpm,\
-                       fl_vardq="yes",fl_corr='no',fl_nonl='no',logfile=log)
-
-    # Check that output files for all arc images exists from nfprepare; if output does not
-    # exist remove corresponding arc images from arclist.
-    arclist = checkLists(arclist, '.', 'n', '.fits')
+    # Arc images without an output from nfprepare are removed from arclist.
+    arclist = runIrafTaskOnFrames(iraf.nfprepare, arclist, "", "n", over, rawpath=".", shiftimage=shiftima,bpm=sflat_bpm,\
+                                  fl_vardq="yes",fl_corr='no',fl_nonl='no',logfile=log)
 
     # Update arc dark frames with mdf offset value and generate variance and data
     # quality extensions. Results in "n"+image+".fits"
-    for image in arcdarklist:
-        image = str(image).strip()
-        if os.path.exists("n"+image+".fits"):
-            if over:
-                iraf.delete("n"+image+".fits")
-            else:
-                print "\nOutput file exists and -over not set - skipping nfprepare of arcdarks."
-                continue
-        iraf.nfprepare(image, rawpath=".", shiftimage=shiftima, bpm=sflat_bpm, \
-                       fl_vardq='yes',fl_corr='no',fl_nonl='no',logfile=log)
-
-    # Check that output files for all arc images exists from nfprepare; if output does not
-    # exist remove corresponding arc images from arclist.
-    arcdarklist = checkLists(arcdarklist, '.', 'n', '.fits')
+    arcdarklist = runIrafTaskOnFrames(iraf.nfprepare, arcdarklist, "", "n", over, rawpath=".", shiftimage=shiftima, bpm=sflat_bpm, \
+                                      fl_vardq='yes',fl_corr='no',fl_nonl='no',logfile=log)
 
     # Combine arc frames, "n"+image+".fits". Output combined file will have the name of the first arc file.
     if os.path.exists("gn"+arc+".fits"):
@@ -679,6 +626,26 @@ def makeWaveCal(arclist, arc, arcdarklist, arcdark, grating, log, over, path):
         interactive = 'yes'
         pauseFlag = True
 
+    # Start from a previous solution of the same instrument configuration, if we have one.
+    # Otherwise NSWAVELENGTH uses the approximate solution in the header from NSAPPWAVE.
+    crval = 'INDEF'
+    cdelt = 'INDEF'
+    reference = ''
+    cachedSolution = None
+    if waveCalCache and not pauseFlag:
+        cacheKey = getWaveCalCacheKey(hdulist[0].header)
+        cachedSolution = readWaveCalCache(cacheKey, cachePath)
+        if cachedSolution:
+            crval = cachedSolution['crval']
+            cdelt = cachedSolution['cdelt']
+            reference = getWaveCalReference(cacheKey, cachePath)
+            logging.info("\nFound a cached wavelength solution for " + cacheKey + " from the arc " + str(cachedSolution.get('arc', 'unknown')) + \
+                         " in " + os.path.join(getCachePath('waveCal', cachePath), cacheKey) + "; starting NSWAVELENGTH from crval = " + \
+                         str(crval) + ", cdelt = " + str(cdelt) + ", reference = '" + reference + "'.")
+            # Only give NSWAVELENGTH the lines that fall on the detector.
+            if clist.startswith(RUNTIME_DATA_PATH):
+                clist = trimArcLineList(clist, "rgn"+arc, crval, cdelt)
+
     # TODO(nat): I don't like this nesting at all
     if not pauseFlag:
         # Establish wavelength calibration for arclamp spectra. Output: A series of
@@ -687,20 +654,30 @@ def makeWaveCal(arclist, arc, arcdarklist, arcdark, grating, log, over, path):
         if os.path.exists("wrgn"+arc+".fits"):
             if over:
                 iraf.delete("wrgn"+arc+".fits")
-                iraf.nswavelength("rgn"+arc, coordli=clist, nsum=10, thresho=my_thresh, \
+                iraf.nswavelength("rgn"+arc, coordli=clist, reference=reference, crval=crval, cdelt=cdelt, nsum=10, thresho=my_thresh, \
                                   trace='yes', fwidth=2.0, match=-6,cradius=8.0,fl_inter=interactive,nfound=10,nlost=10, \
                                   logfile=log)
             else:
                 print "\nOutput file exists and -over not set - ",\
                 "not determining wavelength solution and recreating the wavelength reference arc.\n"
         else:
-            iraf.nswavelength("rgn"+arc, coordli=clist, nsum=10, thresho=my_thresh, \
+            iraf.nswavelength("rgn"+arc, coordli=clist, reference=reference, crval=crval, cdelt=cdelt, nsum=10, thresho=my_thresh, \
                               trace='yes', fwidth=2.0, match=-6,cradius=8.0,fl_inter=interactive,nfound=10,nlost=10, \
                               logfile=log)
     else:
         print "ERROR: For now, only some wavelength configurations are supported. The grating/central wavelength(microns) possibilities are Z/1.05, J/1.25, H/1.65, K/2.20."
         sys.exit(1)
 
+    # Store the new solution so the next arc of this configuration can start from it.
+    # A cached solution is only replaced if -over is set.
+    if waveCalCache and os.path.exists("wrgn"+arc+".fits") and (not cachedSolution or over):
+        cacheKey = getWaveCalCacheKey(hdulist[0].header)
+        solution = getSolutionFromDatabase(glob.glob('database/idwrgn'+arc+'_SCI_*'), "rgn"+arc)
+        if solution:
+            solution['arc'] = os.path.abspath("wrgn"+arc+".fits")
+            writeWaveCalCache(cacheKey, solution, cachePath)
+            storeWaveCalReference(cacheKey, "wrgn"+arc, cachePath)
+
     # Copy to relevant science observation/calibrations/ directories
     for item in glob.glob('database/idwrgn*'):
         replaceNameDatabaseFiles(item, "wrgn"+arc, 'finalArc')
@@ -709,6 +686,147 @@ def makeWaveCal(arclist, arc, arcdarklist, arcdark, grating, log, over, path):
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
+def getWaveCalCacheKey(header):
+    """Return the wavelength solution cache key of an arc; its grating, filter and central wavelength."""
+    return "{}_{}_{:.4f}".format(header['GRATING'].strip(), header['FILTER'].strip(), float(header['GRATWAVE']))
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def readWaveCalCache(cacheKey, cachePath=""):
+    """Return the cached wavelength solution (a dictionary with crval, cdelt, crpix) for cacheKey or None."""
+    cacheFile = os.path.join(getCachePath('waveCal', cachePath), 'waveCalCache.json')
+    try:
+        with open(cacheFile, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return None
+    return cache.get(cacheKey)
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def writeWaveCalCache(cacheKey, solution, cachePath=""):
+    """Add or replace the wavelength solution of cacheKey in the wavelength solution cache."""
+    cacheFile = os.path.join(getCachePath('waveCal', cachePath), 'waveCalCache.json')
+    try:
+        with open(cacheFile, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    cache[cacheKey] = solution
+    # Write to a temporary file first so a crash can't leave a corrupt cache behind.
+    with open(cacheFile+'.tmp', 'w') as f:
+        json.dump(cache, f, indent=4, sort_keys=True)
+    os.rename(cacheFile+'.tmp', cacheFile)
+    logging.info("\nStored the wavelength solution of " + cacheKey + " in " + cacheFile)
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def storeWaveCalReference(cacheKey, arcImage, cachePath=""):
+    """Store the identified arc and its database solutions in the cache as the reference of cacheKey.
+
+    They are renamed waveCalReference, so getWaveCalReference can give them to any later reduction.
+    """
+    referencePath = os.path.join(getCachePath('waveCal', cachePath), cacheKey)
+    if not os.path.exists(referencePath):
+        os.makedirs(referencePath)
+    for item in glob.glob(os.path.join(referencePath, '*')):
+        os.remove(item)
+    shutil.copy(arcImage+'.fits', os.path.join(referencePath, 'waveCalReference.fits'))
+    for databaseFile in glob.glob('database/id'+arcImage+'_SCI_*'):
+        with open(databaseFile, 'r') as f:
+            lines = f.read().replace(arcImage, 'waveCalReference')
+        with open(os.path.join(referencePath, os.path.basename(databaseFile).replace(arcImage, 'waveCalReference')), 'w') as f:
+            f.write(lines)
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def getWaveCalReference(cacheKey, cachePath=""):
+    """Copy the cached reference arc of cacheKey and its database solutions to the current directory.
+
+    Returns the name of the reference to give NSWAVELENGTH, or '' if none is cached.
+    """
+    referencePath = os.path.join(getCachePath('waveCal', cachePath), cacheKey)
+    databaseFiles = glob.glob(os.path.join(referencePath, 'idwaveCalReference_SCI_*'))
+    if not os.path.exists(os.path.join(referencePath, 'waveCalReference.fits')) or not databaseFiles:
+        return ''
+    if not os.path.exists('database'):
+        os.mkdir('database')
+    shutil.copy(os.path.join(referencePath, 'waveCalReference.fits'), 'waveCalReference.fits')
+    for databaseFile in databaseFiles:
+        shutil.copy(databaseFile, os.path.join('database', os.path.basename(databaseFile)))
+    return 'waveCalReference'
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def getSolutionFromDatabase(databaseFiles, arcImage):
+    """Fit a linear dispersion to all the features identified by NSWAVELENGTH.
+
+    Reads the "features" tables of the identify database files and returns a dictionary
+    with the wavelength at the reference pixel of arcImage (crval), the dispersion (cdelt)
+    and the reference pixel (crpix). Returns None if no features were found.
+    """
+    pixels = []
+    wavelengths = []
+    for databaseFile in databaseFiles:
+        with open(databaseFile, 'r') as f:
+            lines = f.readlines()
+        i = 0
+        while i < len(lines):
+            entry = lines[i].split()
+            if entry and entry[0] == 'features':
+                for feature in lines[i+1:i+1+int(entry[1])]:
+                    feature = feature.split()
+                    # Columns are pixel, fitted wavelength, user (line list) wavelength, ...
+                    if len(feature) > 2 and feature[2] != 'INDEF':
+                        pixels.append(float(feature[0]))
+                        wavelengths.append(float(feature[2]))
+                i += int(entry[1])
+            i += 1
+    if len(pixels) < 2:
+        return None
+    crpix = astropy.io.fits.getheader(arcImage+'.fits', 1).get('CRPIX1', 1.)
+    cdelt, crval = np.polyfit(np.array(pixels) - crpix, np.array(wavelengths), 1)
+    return {'crval': float(crval), 'cdelt': float(cdelt), 'crpix': float(crpix)}
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def readArcLineList(clist):
+    """Return the lines of an arc line list as (wavelength, line) pairs. Each list is only read once per process."""
+    if clist not in arcLineLists:
+        lines = []
+        with open(clist, 'r') as f:
+            for line in f:
+                if line.strip() and not line.strip().startswith('#'):
+                    lines.append((float(line.split()[0]), line))
+        arcLineLists[clist] = lines
+    return arcLineLists[clist]
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def trimArcLineList(clist, arcImage, crval='INDEF', cdelt='INDEF', margin=0.1):
+    """Write the lines of clist that fall on arcImage (plus a margin) to arcLineList.dat.
+
+    The wavelength coverage comes from the cached solution if there is one, or from the
+    approximate NSAPPWAVE solution in the arcImage header. Returns the name of the new list.
+    """
+    header = astropy.io.fits.getheader(arcImage+'.fits', 1)
+    crpix = header.get('CRPIX1', 1.)
+    if crval == 'INDEF' or cdelt == 'INDEF':
+        crval = header['CRVAL1']
+        cdelt = header.get('CD1_1', header.get('CDELT1'))
+    wstart = crval + (1 - crpix) * cdelt
+    wend = crval + (header['NAXIS1'] - crpix) * cdelt
+    wmin = min(wstart, wend) - margin * abs(wend - wstart)
+    wmax = max(wstart, wend) + margin * abs(wend - wstart)
+    lines = [line for wavelength, line in readArcLineList(clist) if wmin <= wavelength <= wmax]
+    with open('arcLineList.dat', 'w') as f:
+        f.writelines(lines)
+    logging.info("\nUsing " + str(len(lines)) + " of " + str(len(readArcLineList(clist))) + " lines of " + clist + " between " + \
+                 str(wmin) + " and " + str(wmax) + " angstroms.")
+    return 'arcLineList.dat'
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
 def makeRonchi(ronchilist, ronchiflat, calflat, grating, over, flatdark, log):
     """Establish Spatial-distortion calibration with nfsdist.
 
@@ -726,21 +844,9 @@ def makeRonchi(ronchilist, ronchiflat, calflat, grating, over, flatdark, log):
 
     # Update ronchi flat frames with offset value and generate variance and data quality extensions.
     # Output: "n"+image+".fits".
-    for image in ronchilist:
-        image = str(image).strip()
-        if os.path.exists("n"+image+'.fits'):
-            if over:
-                iraf.delete("n"+image+'.fits')
-                iraf.nfprepare(image,rawpath=".", shiftimage="s"+calflat, \
-                               bpm="rgn"+calflat+"_sflat_bpm.pl", fl_vardq="yes",fl_corr="no",fl_nonl="no", \
-                               logfile=log)
-            else:
-                print "\nOutput file exists and -over not set - skipping prepare of ronchis"
-        else:
-            iraf.nfprepare(image,rawpath=".", shiftimage="s"+calflat, \
-                           bpm="rgn"+calflat+"_sflat_bpm.pl", fl_vardq="yes",fl_corr="no",fl_nonl="no", \
-                           logfile=log)
-    ronchilist = checkLists(ronchilist, '.', 'n', '.fits')
+    ronchilist = runIrafTaskOnFrames(iraf.nfprepare, ronchilist, "", "n", over, rawpath=".", shiftimage="s"+calflat, \
+                                     bpm="rgn"+calflat+"_sflat_bpm.pl", fl_vardq="yes",fl_corr="no",fl_nonl="no", \
+                                     logfile=log)
 
     # Combine nfprepared ronchi flat images "n"+image+".fits". Output: combined file will
     # have the name of the first ronchi flat file, "gn"+ronchiflat+".fits".
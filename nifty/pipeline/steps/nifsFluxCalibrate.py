@@ -31,6 +31,10 @@ import matplotlib.pyplot as plt
 
 # Import config parsing.
 from ..configobj.configobj import ConfigObj
+# Import custom Nifty functions.
+from ..nifsIraf import loadIrafPackages
+from ..nifsNative import LazyCube, applySpectrumToCube, makePlanckSpectrum
+from ..nifsUtils import setJournal, isJournaled, journalUnit, startUnit, writeFits
 
 # Define constants
 # Paths to Nifty data.
@@ -46,7 +50,7 @@ def run():
     # Set up the logging file.
     log = os.getcwd()+'/Nifty.log'
     # Set up iraf
-    iraf.gemini()
+    loadIrafPackages(['gemini'])
     #iraf.unlearn("gemini")
 
     #iraf.unlearn(iraf.gemini,iraf.gemtools,iraf.gnirs,iraf.nifs,iraf.imcopy)
@@ -69,6 +73,15 @@ def run():
         fluxCalbrationConfig = config['fluxCalbrationConfig']
         start = fluxCalbrationConfig['fluxCalibrationStart']
         stop = fluxCalbrationConfig['fluxCalibrationStop']
+        # Compose the continuum, fLambda and the blackbody into one factor and apply it to each cube
+        # in one pass in step 6, instead of writing the continuum divided cube in step 1.
+        fusedFluxCalibration = fluxCalbrationConfig.get('fusedFluxCalibration', False)
+        # 'iraf' makes the blackbody with iraf.mk1dspec; 'native' with numpy on the wavelength grid of the cube.
+        blackBodyMethod = fluxCalbrationConfig.get('blackBodyMethod', 'iraf')
+        # Journal finished steps of each frame and skip them when resuming. Steps that were
+        # started but not finished may have been cut short, so they are redone with -over.
+        resumeFromJournal = config.get('resumeFromJournal', False)
+        setJournal(path+'/Nifty.journal', resumeFromJournal)
 
     for scienceDirectory in scienceDirectoryList:
         try:
@@ -90,9 +103,20 @@ def run():
 
             valindex = start
             while valindex <= stop:
+                if isJournaled(rawFrame, 'fluxCalibration'+str(valindex)):
+                    logging.info("\nStep " + str(valindex) + " of " + rawFrame + " is in the journal - skipping it.")
+                    valindex += 1
+                    continue
+
+                if fusedFluxCalibration and valindex in [1, 4, 5]:
+                    logging.info("\nfusedFluxCalibration is set; step " + str(valindex) + " is done as part of step 6.")
+                    # Their products are not made, so they are not journaled.
+                    valindex += 1
+                    continue
+                unitOver = startUnit(rawFrame, 'fluxCalibration'+str(valindex), over)
 
                 if valindex == 1:
-                    divideByContinuum(rawFrame, log, over)
+                    divideByContinuum(rawFrame, log, unitOver)
 
                     logging.info("\n##############################################################################")
                     logging.info("")
@@ -100,8 +124,8 @@ def run():
                     logging.info("")
                     logging.info("##############################################################################\n")
 
-                if valindex == 2:
-                    makeFLambda(rawFrame, grating, log, over)
+                elif valindex == 2:
+                    makeFLambda(rawFrame, grating, log, unitOver)
 
                     logging.info("\n##############################################################################")
                     logging.info("")
@@ -109,8 +133,8 @@ def run():
                     logging.info("")
                     logging.info("##############################################################################\n")
 
-                if valindex == 3:
-                    makeBlackBody(rawFrame, grating, log, over)
+                elif valindex == 3:
+                    makeBlackBody(rawFrame, grating, log, unitOver, blackBodyMethod)
 
                     logging.info("\n##############################################################################")
                     logging.info("")
@@ -119,8 +143,8 @@ def run():
                     logging.info("##############################################################################\n")
 
 
-                if valindex == 4:
-                    makeBlackBodyScale(rawFrame, log, over)
+                elif valindex == 4:
+                    makeBlackBodyScale(rawFrame, log, unitOver)
 
                     logging.info("\n##############################################################################")
                     logging.info("")
@@ -128,8 +152,8 @@ def run():
                     logging.info("")
                     logging.info("##############################################################################\n")
 
-                if valindex == 5:
-                    scaleBlackBody(rawFrame, log, over)
+                elif valindex == 5:
+                    scaleBlackBody(rawFrame, log, unitOver)
 
                     logging.info("\n##############################################################################")
                     logging.info("")
@@ -137,8 +161,11 @@ def run():
                     logging.info("")
                     logging.info("##############################################################################\n")
 
-                if valindex == 6:
-                    multiplyByBlackBody(rawFrame, log, over)
+                elif valindex == 6:
+                    if fusedFluxCalibration:
+                        applyFluxCalibration(rawFrame, log, unitOver)
+                    else:
+                        multiplyByBlackBody(rawFrame, log, unitOver)
 
                     logging.info("\n##############################################################################")
                     logging.info("")
@@ -146,6 +173,7 @@ def run():
                     logging.info("")
                     logging.info("##############################################################################\n")
 
+                journalUnit(rawFrame, 'fluxCalibration'+str(valindex))
                 valindex += 1
 
         os.chdir(path)
@@ -156,28 +184,18 @@ def divideByContinuum(rawFrame, log, over):
       by the fit to the telluric correction.
 
     """
-    # Open the telluric corrected, un-fluxcalibrated data cube.
-    cube = astropy.io.fits.open('0_telactfbrsn'+rawFrame+'.fits')
-    # Open the scaled blackbody. We will multiply the cube by this.
-    shiftedFit = astropy.io.fits.open("0_fit"+rawFrame+".fits")
+    # Open the fit to the telluric correction. We will divide the cube by this.
+    shiftedFit = astropy.io.fits.getdata("0_fit"+rawFrame+".fits")
     if os.path.exists('1_continuum'+rawFrame+'.fits'):
         if over:
             os.remove('1_continuum'+rawFrame+'.fits')
-            # Divide each spectrum in the cubedata array by the
-            for i in range(cube[1].header['NAXIS2']):         # NAXIS2 is the y axis of the final cube.
-                for j in range(cube[1].header['NAXIS1']):     # NAXIS1 is the x axis of the final cube.
-                    cube[1].data[:,i,j] /= (shiftedFit[0].data)
-            # Write the corrected cube to a new file with new prefix
-            cube.writeto('1_continuum'+rawFrame+'.fits', output_verify='ignore')
+            # Divide each spectrum in the telluric corrected, un-fluxcalibrated cube by the fit.
+            applySpectrumToCube('0_telactfbrsn'+rawFrame+'.fits', shiftedFit, 'divide', '1_continuum'+rawFrame+'.fits')
         else:
             logging.info("\nOutput exists and -over not set - skipping cube division by continuum")
     else:
-        # Divide each spectrum in the cubedata array by the
-        for i in range(cube[1].header['NAXIS2']):         # NAXIS2 is the y axis of the final cube.
-            for j in range(cube[1].header['NAXIS1']):     # NAXIS1 is the x axis of the final cube.
-                cube[1].data[:,i,j] /= (shiftedFit[0].data)
-        # Write the corrected cube to a new file with new prefix
-        cube.writeto('1_continuum'+rawFrame+'.fits', output_verify='ignore')
+        # Divide each spectrum in the telluric corrected, un-fluxcalibrated cube by the fit.
+        applySpectrumToCube('0_telactfbrsn'+rawFrame+'.fits', shiftedFit, 'divide', '1_continuum'+rawFrame+'.fits')
 
 def makeFLambda(rawFrame, grating, log, over):
     """
@@ -241,9 +259,11 @@ def makeFLambda(rawFrame, grating, log, over):
             f.write("fLambda: {}".format(fLambda))
         logging.info("\nWrote a value of {} to 2_fLambda{}.txt".format(fLambda, rawFrame))
 
-def makeBlackBody(rawFrame, grating, log, over):
+def makeBlackBody(rawFrame, grating, log, over, method='iraf'):
     """
     - From Z header information from the cube, make a black body.
+      With method 'native' it is made with numpy on the wavelength axis of the cube
+      (CRVAL3, CD3_3, NAXIS3); with 'iraf', by iraf.mk1dspec over the NAXIS3 pixels of the cube.
     - Make scale factor: mean of black body over fLambda.
     - Multiply blackbody spectrum by scale factor.
     Creates:
@@ -251,11 +271,13 @@ def makeBlackBody(rawFrame, grating, log, over):
         - A scaled 1D blackbody spectrum, scaledBlackBody.fits[0]
     """
     # Find the start and end wavelengths of the blackbody from our cube header.
-    target_header = astropy.io.fits.open('../products_uncorrected/ctfbrsn'+rawFrame+'.fits')
-    wstart = target_header[1].header['CRVAL3']
-    wdelt = target_header[1].header['CD3_3']
-    wend = wstart + (2040 * wdelt)
-    crpix3 = target_header[1].header['CRPIX3']
+    target_header = LazyCube('../products_uncorrected/ctfbrsn'+rawFrame+'.fits').header
+    wstart = target_header['CRVAL3']
+    wdelt = target_header['CD3_3']
+    # 2040 for iraf cubes; native cubes can have a different number of slices.
+    npix = target_header['NAXIS3']
+    wend = wstart + (npix * wdelt)
+    crpix3 = target_header['CRPIX3']
     # Find the standard star temperature from 0_std_starRAWNAME.txt
     try:
         with open("0_std_star"+rawFrame+".txt", "r") as f:
@@ -273,19 +295,29 @@ def makeBlackBody(rawFrame, grating, log, over):
     if crpix3 != 1.:
         logging.info("WARNING in Reduce: CRPIX of wavelength axis not equal to one. Exiting flux calibration.")
         raise SystemExit
-    # Make a blackbody for each of the 2040 NIFS spectral pixels.
     if os.path.exists("3_BBody"+rawFrame+".fits"):
         if over:
             os.remove("3_BBody"+rawFrame+".fits")
-            iraf.chdir(os.getcwd())
-            iraf.mk1dspec(input="3_BBody"+rawFrame,output="",title='',ncols=2040,naps=1,header='',wstart=wstart,wend=wend,temperature=standardStarSpecTemperature)
-            logging.info("\nMade a blackbody in 3_BBody{}.fits".format(rawFrame))
         else:
             logging.info("\nOutput exists and -over not set - skipping production of unscaled black body")
+            return
+    if method == 'native':
+        # Make a blackbody for each spectral pixel of the cube.
+        blackBody = makePlanckSpectrum(float(standardStarSpecTemperature), wstart, wdelt, npix)
+        hdu = astropy.io.fits.PrimaryHDU(blackBody.astype(np.float32))
+        hdu.header['CTYPE1'] = 'LINEAR'
+        hdu.header['CRPIX1'] = 1.
+        hdu.header['CRVAL1'] = wstart
+        hdu.header['CDELT1'] = wdelt
+        hdu.header['CD1_1'] = wdelt
+        hdu.header['DC-FLAG'] = 0
+        hdu.header['BBTEMP'] = (float(standardStarSpecTemperature), 'Blackbody temperature (K)')
+        writeFits(hdu, "3_BBody"+rawFrame+".fits")
     else:
+        # Make a blackbody for each spectral pixel of the cube.
         iraf.chdir(os.getcwd())
-        iraf.mk1dspec(input="3_BBody"+rawFrame,output="",title='',ncols=2040,naps=1,header='',wstart=wstart,wend=wend,temperature=standardStarSpecTemperature)
-        logging.info("\nMade a blackbody in 3_BBody{}.fits".format(rawFrame))
+        iraf.mk1dspec(input="3_BBody"+rawFrame,output="",title='',ncols=npix,naps=1,header='',wstart=wstart,wend=wend,temperature=standardStarSpecTemperature)
+    logging.info("\nMade a blackbody in 3_BBody{}.fits".format(rawFrame))
 
 def makeBlackBodyScale(rawFrame, log, over):
     """
@@ -338,7 +370,7 @@ def scaleBlackBody(rawFrame, log, over):
             operand2 = bbodyScaleFactor
             multiplied = operand1 * operand2
             hdu = astropy.io.fits.PrimaryHDU(multiplied)
-            hdu.writeto("5_scaledBBody"+rawFrame+".fits")
+            writeFits(hdu, "5_scaledBBody"+rawFrame+".fits")
 
             logging.info("\nCreated a scaled blackbody, 5_scaledBBody{}.fits".format(rawFrame))
         else:
@@ -350,7 +382,7 @@ def scaleBlackBody(rawFrame, log, over):
         operand2 = bbodyScaleFactor
         multiplied = operand1 * operand2
         hdu = astropy.io.fits.PrimaryHDU(multiplied)
-        hdu.writeto("5_scaledBBody"+rawFrame+".fits")
+        writeFits(hdu, "5_scaledBBody"+rawFrame+".fits")
     # We now have a scaled blackbody, scaledBlackBody.fits
 
 def multiplyByBlackBody(rawFrame, log, over):
@@ -361,26 +393,51 @@ def multiplyByBlackBody(rawFrame, log, over):
     Creates:
         - Flux calibrated cube, "factfbrsn"+scienceObjectName+".fits"
     """
-    # Open the telluric corrected, continuum multiplied, un-fluxcalibrated data cube.
-    cube = astropy.io.fits.open('1_continuum'+rawFrame+'.fits')
     # Open the scaled blackbody. We will multiply the cube by this.
-    scaledBlackBody = astropy.io.fits.open("5_scaledBBody"+rawFrame+".fits")
+    scaledBlackBody = astropy.io.fits.getdata("5_scaledBBody"+rawFrame+".fits")
 
     if os.path.exists("factfbrsn"+rawFrame+'.fits'):
         if over:
             os.remove('factfbrsn'+rawFrame+'.fits')
-            # Divide each spectrum in the cubedata array by the telluric correction spectrum.
-            for i in range(cube[1].header['NAXIS2']):         # NAXIS2 is the y axis of the final cube.
-                for j in range(cube[1].header['NAXIS1']):     # NAXIS1 is the x axis of the final cube.
-                    cube[1].data[:,i,j] *= (scaledBlackBody[0].data)
-            # Write the corrected cube to a new file.
-            cube.writeto('factfbrsn'+rawFrame+'.fits', output_verify='ignore')
+            # Multiply each spectrum in the telluric corrected, continuum multiplied cube by the scaled black body.
+            applySpectrumToCube('1_continuum'+rawFrame+'.fits', scaledBlackBody, 'multiply', 'factfbrsn'+rawFrame+'.fits')
         else:
             logging.info("\nOutput exists and -over not set - skipping division of telluric corrected cube by scaled black body")
     else:
-        # Divide each spectrum in the cubedata array by the telluric correction spectrum.
-        for i in range(cube[1].header['NAXIS2']):         # NAXIS2 is the y axis of the final cube.
-            for j in range(cube[1].header['NAXIS1']):     # NAXIS1 is the x axis of the final cube.
-                cube[1].data[:,i,j] *= (scaledBlackBody[0].data)
-        # Write the corrected cube to a new file.
-        cube.writeto('factfbrsn'+rawFrame+'.fits', output_verify='ignore')
+        # Multiply each spectrum in the telluric corrected, continuum multiplied cube by the scaled black body.
+        applySpectrumToCube('1_continuum'+rawFrame+'.fits', scaledBlackBody, 'multiply', 'factfbrsn'+rawFrame+'.fits')
+
+def getFluxCalibrationFactor(rawFrame):
+    """
+    Compose the flux calibration of steps 1 to 6 into one spectrum:
+    fLambda / mean(blackbody) * blackbody / continuum fit.
+    Multiplying the telluric corrected cube by it gives the same flux calibrated cube as
+    dividing by the continuum fit then multiplying by the scaled blackbody.
+    Where the continuum fit is zero the factor is not finite, so applySpectrumToCube flags it.
+    """
+    continuum = astropy.io.fits.getdata("0_fit"+rawFrame+".fits").astype(float).ravel()
+    blackBody = astropy.io.fits.getdata("3_BBody"+rawFrame+".fits").astype(float).ravel()
+    with open("2_fLambda"+rawFrame+".txt", "r") as f:
+        fLambda = float(f.read().split()[1])
+    bbodyScaleFactor = fLambda / float(np.mean(blackBody))
+    logging.info("\nFound a blackbody scale factor of {}".format(bbodyScaleFactor))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return bbodyScaleFactor * blackBody / continuum
+
+def applyFluxCalibration(rawFrame, log, over):
+    """
+    - Multiply each slice of the telluric corrected cube by the composed flux calibration
+      factor, reading and writing the cube once.
+
+    Creates:
+        - Flux calibrated cube, "factfbrsn"+scienceObjectName+".fits"
+    """
+    if os.path.exists("factfbrsn"+rawFrame+'.fits'):
+        if over:
+            os.remove('factfbrsn'+rawFrame+'.fits')
+        else:
+            logging.info("\nOutput exists and -over not set - skipping flux calibration of the telluric corrected cube")
+            return
+    factor = getFluxCalibrationFactor(rawFrame)
+    applySpectrumToCube('0_telactfbrsn'+rawFrame+'.fits', factor, 'multiply', 'factfbrsn'+rawFrame+'.fits')
+    logging.info("\nMade the flux calibrated cube factfbrsn{}.fits in one pass".format(rawFrame))
@@ -35,6 +35,9 @@ import numpy
 
 # Import config parsing.
 from ..configobj.configobj import ConfigObj
+# Import custom Nifty functions.
+from ..nifsIraf import startIrafSession
+from ..nifsNative import LazyCube
 
 # Define constants
 # Paths to Nifty data.
@@ -49,24 +52,12 @@ def run():
     # Store current working directory for later use.
     path = os.getcwd()
 
-    # Set up iraf
-    iraf.gemini()
-    iraf.nifs()
-    iraf.gnirs()
-    iraf.gemtools()
-
-    # Unlearn the used tasks.
-    iraf.unlearn(iraf.gemini,iraf.gemtools,iraf.gnirs,iraf.nifs)
-
-    # Prepare the package for NIFS
-    iraf.nsheaders("nifs",logfile="Nifty.log")
-    iraf.set(stdimage='imt2048')
-    user_clobber=iraf.envget("clobber")
-    iraf.reset(clobber='yes')
-
     # Set up the logging file.
     log = os.getcwd()+'/Nifty.log'
 
+    # Set up iraf; only done once per process.
+    startIrafSession(log)
+
     logging.info('\n#################################################')
     logging.info('#                                               #')
     logging.info('#       Start the NIFS Final Cube Merging       #')
@@ -322,9 +313,9 @@ def mergeCubes(obsDirList, cubeType, mergeType, use_pq_offsets, im3dtran, over="
 
         if use_pq_offsets:
             # Set the zero point p and q offsets to the p and q offsets of the first cube in each list of cubes.
-            header = astropy.io.fits.open(cubes[0])
-            p0 = header[0].header['POFFSET']
-            q0 = header[0].header['QOFFSET']
+            header = LazyCube(cubes[0]).primaryHeader
+            p0 = header['POFFSET']
+            q0 = header['QOFFSET']
             foff = open('offsets.txt', 'w')
             foff.write('%d %d %d\n' % (0, 0, 0))
             foff.close()
@@ -348,17 +339,17 @@ def mergeCubes(obsDirList, cubeType, mergeType, use_pq_offsets, im3dtran, over="
             # Skip the first cube!
             if i == 0:
                 continue
-            header2 = astropy.io.fits.open(cubes[i])
+            header2 = LazyCube(cubes[i]).primaryHeader
             # Check to see if we are using ALTAIR. If we are, later we will invert the x offset
             # because of the different light path.
-            ALTAIR = header2[0].header['AOFOLD'].strip() == 'IN'
+            ALTAIR = header2['AOFOLD'].strip() == 'IN'
             suffix = cubes[i][-8:-5]
 
             # If user wants to merge using p and q offsets, grab those from .fits headers.
             if use_pq_offsets:
                 # find the p and q offsets of the other cubes in the sequence.
-                xoff = header2[0].header['POFFSET']
-                yoff = header2[0].header['QOFFSET']
+                xoff = header2['POFFSET']
+                yoff = header2['QOFFSET']
                 # calculate the difference between the zero point offsets and the offsets of the other cubes and convert that to pixels
                 if ALTAIR:
                     xShift = round(-1*(xoff - p0)/pixScale)
@@ -450,8 +441,8 @@ def finalMergeCubes(mergeType, over):
         iraffunctions.chdir(Merged)
         gratlist = []
         for i in range(len(mergedCubes)):
-            cubeheader = astropy.io.fits.open(mergedCubes[i])
-            grat = cubeheader[0].header['GRATING']
+            cubeheader = LazyCube(mergedCubes[i]).primaryHeader
+            grat = cubeheader['GRATING']
             gratlist.append(grat)
         print "gratlist is: ", gratlist
         # TODO(nat): right now we do more final merges here than we have to. Eg, if there are three H
@@ -506,10 +497,11 @@ def resizeAndCenterCubes(cubelist, over):
     cPix1Max = None
     cPix2Max = None
     for cube in cubelist:
-        cubeData = astropy.io.fits.open(cube)[1].data
-        cubeHeader = astropy.io.fits.open(cube)[1].header
-        xSize = cubeData.shape[2]
-        ySize = cubeData.shape[1]
+        # Only the header is read; the size comes from NAXIS.
+        lazyCube = LazyCube(cube)
+        cubeHeader = lazyCube.header
+        xSize = lazyCube.shape[2]
+        ySize = lazyCube.shape[1]
         if xSize > maxXSize:
             maxXSize = xSize
             cPix1Max = cubeHeader['CRPIX1']
@@ -549,8 +541,8 @@ def makeWavelengthOffsets(cubelist, grat):
     """
     Get wavelength shift of cubes.
     """
-    cubeheader0 = astropy.io.fits.open(cubelist[0])
-    wstart0 = cubeheader0[1].header['CRVAL3']
+    cubeheader0 = LazyCube(cubelist[0]).header
+    wstart0 = cubeheader0['CRVAL3']
     # If a user provided a waveoffsetsGRATING.txt, skip the creation of it.
     if os.path.exists('waveoffsets{0}.txt'.format(grat[0])):
         logging.info("\nwaveoffsets file exists; skipping creation of it.")
@@ -560,9 +552,9 @@ def makeWavelengthOffsets(cubelist, grat):
     for i in range(len(cubelist)):
         if i == 0:
             continue
-        cubeheader = astropy.io.fits.open(cubelist[i])
-        wstart = cubeheader[1].header['CRVAL3']
-        wdelt = cubeheader[1].header['CD3_3']
+        cubeheader = LazyCube(cubelist[i]).header
+        wstart = cubeheader['CRVAL3']
+        wdelt = cubeheader['CD3_3']
         waveoff = round((wstart-wstart0)/wdelt)
         fwave.write('%d %d %d\n' % (0, 0, waveoff))
     fwave.close()
@@ -28,7 +28,8 @@
 
 # STDLIB
 
-import sys, glob, shutil, os, time, logging, glob, urllib, re, pkg_resources
+import sys, glob, shutil, os, time, logging, glob, urllib, re, pkg_resources, multiprocessing, hashlib
+from collections import OrderedDict
 from pyraf import iraf, iraffunctions
 import astropy.io.fits
 import numpy as np
@@ -38,14 +39,17 @@ import numpy as np
 # Import config parsing.
 from ..configobj.configobj import ConfigObj
 # Import custom Nifty functions.
-from ..nifsUtils import datefmt, listit, writeList, checkLists, makeSkyList, MEFarith, convertRAdec, copyResultsToScience
+from ..nifsUtils import datefmt, listit, writeList, checkLists, makeSkyList, MEFarith, convertRAdec, copyResultsToScience, replaceNameDatabaseFiles, framesToProcess, runIrafTaskOnFrames, stageToScratch, unstageFromScratch, getCachePath, pruneCache, hashFitsData, setDependencyChecks, setJournal, recordOutputs
+from ..nifsNative import subtractSky, makeNativeCubes, extractNativeSpectra
+from ..nifsIraf import startIrafSession
+from ..nifsParallel import runFrameParallel, runFrameGraph, runWorkerTask, makeWorkerTask, getPool
 
 # Define constants
 # Paths to Nifty data.
 RECIPES_PATH = pkg_resources.resource_filename('nifty', 'recipes/')
 RUNTIME_DATA_PATH = pkg_resources.resource_filename('nifty', 'runtimeData/')
 
-def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
+def start(kind, telluricDirectoryList="", scienceDirectoryList="", deferTelluricCopy=False):
     """
 
     start(kind): Do a full reduction of either Science or Telluric data.
@@ -80,6 +84,8 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
         kind (string): either 'Telluric' or 'Science'.
         telluricDirectoryList (string): Used by low memory pipeline.
         scienceDirectoryList (string): Used by low memory pipeline.
+        deferTelluricCopy (boolean): don't copy extracted telluric spectra to the science
+                                     directories; the caller runs copyTelluricToScience later.
 
     """
 
@@ -107,34 +113,8 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
     logging.info('#                                               #')
     logging.info('#################################################\n')
 
-    # Set up/prepare IRAF.
-    iraf.gemini()
-    iraf.gemtools()
-    iraf.gnirs()
-    iraf.nifs()
-
-    # Reset to default parameters the used IRAF tasks.
-    iraf.unlearn(iraf.gemini,iraf.gemtools,iraf.gnirs,iraf.nifs,iraf.imcopy)
-
-    # From http://bishop.astro.pomona.edu/Penprase/webdocuments/iraf/beg/beg-image.html:
-    # Before doing anything involving image display the environment variable
-    # stdimage must be set to the correct frame buffer size for the display
-    # servers (as described in the dev$graphcap file under the section "STDIMAGE
-    # devices") or to the correct image display device. The task GDEVICES is
-    # helpful for determining this information for the display servers.
-    iraf.set(stdimage='imt2048')
-
-    # Prepare the IRAF package for NIFS.
-    # NSHEADERS lists the header parameters used by the various tasks in the
-    # NIFS package (excluding headers values which have values fixed by IRAF or
-    # FITS conventions).
-    iraf.nsheaders("nifs",logfile=log)
-
-    # Set clobber to 'yes' for the script. This still does not make the gemini
-    # tasks overwrite files, so:
-    # YOU WILL LIKELY HAVE TO REMOVE FILES IF YOU RE_RUN THE SCRIPT.
-    user_clobber=iraf.envget("clobber")
-    iraf.reset(clobber='yes')
+    # Set up/prepare IRAF; only done once per process.
+    startIrafSession(log)
 
     # This helps make sure all variables are initialized to prevent bugs.
     scienceSkySubtraction = None
@@ -142,19 +122,51 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
     extractionXC = None
     extractionYC = None
     extractionRadius = None
+    numberOfProcesses = None
+    streamFrames = None
+    scratchPath = None
+    skySubtractionMethod = None
+    skyStackDirectory = ""
+    fitCoordsOnce = None
+    cubeMethod = None
+    extractionMethod = None
+    extractionApertures = None
     telluricSkySubtraction = None
+    scienceSkyStack = False
+    skipTransform = False
 
     # Load reduction parameters from runtimeData/config.cfg.
     with open('./config.cfg') as config_file:
         config = ConfigObj(config_file, unrepr=True)
         # Read general pipeline config.
         over = config['over']
+        # Also remake existing outputs whose inputs or parameters changed.
+        setDependencyChecks(config.get('checkDependencies', False))
+        # Journal finished frames; when resuming, outputs missing from the journal are remade.
+        setJournal(path+'/Nifty.journal', config.get('resumeFromJournal', False))
         manualMode = config['manualMode']
         calDirList = config['calibrationDirectoryList']
         scienceOneDExtraction = config['scienceOneDExtraction']
         extractionXC = config['extractionXC']
         extractionYC = config['extractionYC']
         extractionRadius = config['extractionRadius']
+        # Number of processes used for per-frame steps; 0 means one per core.
+        numberOfProcesses = config.get('numberOfProcesses', 1)
+        # Run steps 1 to 4 frame by frame instead of step by step.
+        streamFrames = config.get('streamFrames', False)
+        # Optionally reduce in a local scratch directory and only copy back some products.
+        scratchPath = config.get('scratchPath', '')
+        # 'iraf' uses iraf.gemarith; 'native' subtracts skies with numpy.
+        skySubtractionMethod = config.get('skySubtractionMethod', 'iraf')
+        # Run nsfitcoords on one frame per observation and copy its solution to the others.
+        fitCoordsOnce = config.get('fitCoordsOnce', False)
+        # 'iraf' makes cubes with iraf.nifcube; 'native' with a sparse resampling operator.
+        cubeMethod = config.get('cubeMethod', 'iraf')
+        # 'iraf' extracts 1D spectra with iraf.nfextract; 'native' extracts extractionApertures from the cubes.
+        extractionMethod = config.get('extractionMethod', 'iraf')
+        extractionApertures = config.get('extractionApertures', [])
+        scratchProducts = config.get('scratchProducts', ['ctfbrsn', 'xtfbrsn', 'gxtfbrsn'])
+        scratchIntermediates = config.get('scratchIntermediates', 'discard')
 
         if kind == 'Telluric':
             # Telluric reduction specific config.
@@ -166,6 +178,8 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
             start = telluricReductionConfig['telStart']
             stop = telluricReductionConfig['telStop']
             telluricSkySubtraction = telluricReductionConfig['telluricSkySubtraction']
+            if telluricReductionConfig.get('skyStackCache', True):
+                skyStackDirectory = getCachePath('skyStacks', config.get('cachePath', ''))
 
         if kind == 'Science':
             # Science reduction specific config.
@@ -177,6 +191,17 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
             start = scienceReductionConfig['sciStart']
             stop = scienceReductionConfig['sciStop']
             scienceSkySubtraction = scienceReductionConfig['scienceSkySubtraction']
+            # Subtract one combined sky from every science frame, like tellurics, instead of the sky paired with each frame.
+            scienceSkyStack = scienceReductionConfig.get('scienceSkyStack', False)
+            if scienceSkyStack and scienceReductionConfig.get('skyStackCache', True):
+                skyStackDirectory = getCachePath('skyStacks', config.get('cachePath', ''))
+
+        # Native cubes are made straight from the fbrsn frames, so nstransform is only needed for nfextract.
+        skipTransform = cubeMethod == 'native' and (extractionMethod == 'native' or (kind == 'Science' and not scienceOneDExtraction))
+
+        if skyStackDirectory:
+            # Keep the sky stack cache from growing without bound; limits of 0 are no limit.
+            pruneCache(skyStackDirectory, config.get('skyStackCacheSize', 10.), config.get('skyStackCacheAge', 30.))
 
     ###########################################################################
     ##                                                                       ##
@@ -315,6 +340,34 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
             valindex = int(raw_input("\nPlease enter a valid start value (1 to 7, default 1): "))
             stop = int(raw_input("\nPlease enter a valid stop value (1 to 7, default 7): "))
 
+        telluricCopyPending = False
+        if scratchPath:
+            os.chdir(stageToScratch(pwd, scratchPath))
+            iraffunctions.chdir(os.getcwd())
+
+        cubesMade = False
+        if streamFrames and not manualMode and valindex <= 4:
+            # Let each frame go through steps 1 to 4 (and make its cube) as soon as
+            # its own inputs are ready, instead of waiting for every frame at each step.
+            lastStep = min(stop, 4)
+            cubesMade = stop >= 5
+            if kind == 'Telluric':
+                if telluricSkySubtraction:
+                    tellist = streamFrameReduction(tellist, skyFrameList, kind, valindex, lastStep, cubesMade, shift, finalBadPixelMask, flat, arc, ronchi, log, over, numberOfProcesses, skySubtractionMethod, skyStackDirectory, fitCoordsOnce, cubeMethod, skipTransform=skipTransform)
+                else:
+                    tellist = streamFrameReduction(tellist, [], kind, valindex, lastStep, cubesMade, shift, finalBadPixelMask, flat, arc, ronchi, log, over, numberOfProcesses, skySubtractionMethod, skyStackDirectory, fitCoordsOnce, cubeMethod, skipTransform=skipTransform)
+            elif kind == 'Science':
+                if scienceSkySubtraction:
+                    scienceFrameList = streamFrameReduction(scienceFrameList, skyFrameList, kind, valindex, lastStep, cubesMade, shift, finalBadPixelMask, flat, arc, ronchi, log, over, numberOfProcesses, skySubtractionMethod, skyStackDirectory, fitCoordsOnce, cubeMethod, scienceSkyStack, skipTransform=skipTransform)
+                else:
+                    scienceFrameList = streamFrameReduction(scienceFrameList, [], kind, valindex, lastStep, cubesMade, shift, finalBadPixelMask, flat, arc, ronchi, log, over, numberOfProcesses, skySubtractionMethod, skyStackDirectory, fitCoordsOnce, cubeMethod, skipTransform=skipTransform)
+            logging.info("\n##############################################################################")
+            logging.info("")
+            logging.info("  STEPS " + str(valindex) + " to " + str(lastStep) + ": Frame by frame reduction ->tfbrsn - COMPLETED ")
+            logging.info("")
+            logging.info("##############################################################################\n")
+            valindex = lastStep + 1
+
         while valindex <= stop :
 
             ###########################################################################
@@ -325,11 +378,11 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
                 if manualMode:
                     a = raw_input("About to enter step 1: locate the spectrum.")
                 if kind=='Telluric':
-                    tellist = prepare(tellist, shift, finalBadPixelMask, log, over)
+                    tellist = runFrameParallel(prepare, tellist, (shift, finalBadPixelMask, log, over), numberOfProcesses, "n")
                 elif kind=='Science':
-                    scienceFrameList = prepare(scienceFrameList, shift, finalBadPixelMask, log, over)
+                    scienceFrameList = runFrameParallel(prepare, scienceFrameList, (shift, finalBadPixelMask, log, over), numberOfProcesses, "n")
                 if telluricSkySubtraction or scienceSkySubtraction:
-                    skyFrameList = prepare(skyFrameList, shift, finalBadPixelMask, log, over)
+                    skyFrameList = runFrameParallel(prepare, skyFrameList, (shift, finalBadPixelMask, log, over), numberOfProcesses, "n")
                 logging.info("\n##############################################################################")
                 logging.info("")
                 logging.info("  STEP 1: Locate the Spectrum (and prepare raw data) ->n - COMPLETED ")
@@ -347,20 +400,25 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
                 if kind=='Telluric':
                     if telluricSkySubtraction:
                         if len(skyFrameList)>1:
-                            combineImages(skyFrameList, "gn"+sky, log, over)
+                            combineImages(skyFrameList, "gn"+sky, log, over, skyStackDirectory)
                         else:
                             copyImage(skyFrameList, 'gn'+sky+'.fits', over)
-                        skySubtractTel(tellist, "gn"+sky, log, over)
+                        runFrameParallel(skySubtractTel, tellist, ("gn"+sky, log, over, skySubtractionMethod), numberOfProcesses, "sn")
                     else:
-                        for image in tellist:
-                            iraf.copy('n'+image+'.fits', 'sn'+image+'.fits')
+                        copyUnsubtracted(tellist)
 
                 if kind=='Science':
-                    if scienceSkySubtraction:
-                        skySubtractObj(scienceFrameList, skyFrameList, log, over)
+                    if scienceSkySubtraction and scienceSkyStack:
+                        skies = list(OrderedDict.fromkeys(skyFrameList))
+                        if len(skies)>1:
+                            combineImages(skies, "gn"+skies[0], log, over, skyStackDirectory)
+                        else:
+                            copyImage(skies, 'gn'+skies[0]+'.fits', over)
+                        runFrameParallel(skySubtractTel, scienceFrameList, ("gn"+skies[0], log, over, skySubtractionMethod), numberOfProcesses, "sn")
+                    elif scienceSkySubtraction:
+                        runFrameParallel(skySubtractObj, scienceFrameList, (log, over, skySubtractionMethod), numberOfProcesses, "sn", pairedFrames=skyFrameList)
                     else:
-                        for image in scienceFrameList:
-                            iraf.copy('n'+image+'.fits', 'sn'+image+'.fits')
+                        copyUnsubtracted(scienceFrameList)
 
                 logging.info("\n##############################################################################")
                 logging.info("")
@@ -376,11 +434,11 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
                 if manualMode:
                     a = raw_input("About to enter step 3: flat fielding and bad pixels correction.")
                 if kind=='Telluric':
-                    applyFlat(tellist, flat, log, over, kind)
-                    fixBad(tellist, log, over)
+                    runFrameParallel(applyFlat, tellist, (flat, log, over, kind), numberOfProcesses, "rsn")
+                    runFrameParallel(fixBad, tellist, (log, over), numberOfProcesses, "brsn")
                 elif kind=='Science':
-                    applyFlat(scienceFrameList, flat, log, over, kind)
-                    fixBad(scienceFrameList, log, over)
+                    runFrameParallel(applyFlat, scienceFrameList, (flat, log, over, kind), numberOfProcesses, "rsn")
+                    runFrameParallel(fixBad, scienceFrameList, (log, over), numberOfProcesses, "brsn")
                 logging.info("\n##############################################################################")
                 logging.info("")
                 logging.info("  STEP 3: Flat fielding and Bad Pixels Correction ->brsn - COMPLETED ")
@@ -396,11 +454,19 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
                 if manualMode:
                     a = raw_input("About to enter step 4: 2D to 3D transformation and Wavelength Calibration.")
                 if kind=='Telluric':
-                    fitCoords(tellist, arc, ronchi, log, over, kind)
-                    transform(tellist, log, over)
+                    if fitCoordsOnce:
+                        fitCoords(tellist, arc, ronchi, log, over, kind, fitCoordsOnce)
+                    else:
+                        runFrameParallel(fitCoords, tellist, (arc, ronchi, log, over, kind), numberOfProcesses, "fbrsn")
+                    if not skipTransform:
+                        runFrameParallel(transform, tellist, (log, over), numberOfProcesses, "tfbrsn")
                 elif kind=='Science':
-                    fitCoords(scienceFrameList, arc, ronchi, log, over, kind)
-                    transform(scienceFrameList, log, over)
+                    if fitCoordsOnce:
+                        fitCoords(scienceFrameList, arc, ronchi, log, over, kind, fitCoordsOnce)
+                    else:
+                        runFrameParallel(fitCoords, scienceFrameList, (arc, ronchi, log, over, kind), numberOfProcesses, "fbrsn")
+                    if not skipTransform:
+                        runFrameParallel(transform, scienceFrameList, (log, over), numberOfProcesses, "tfbrsn")
                 logging.info("\n##############################################################################")
                 logging.info("")
                 logging.info("  STEP 4: 2D to 3D transformation and Wavelength Calibration ->tfbrsn - COMPLETED ")
@@ -427,25 +493,21 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
                 # For telluric data:
                 # Make a combined extracted 1D standard star spectrum.
                 if kind=='Telluric':
-                    extractOneD(tellist, kind, log, over, extractionXC, extractionYC, extractionRadius)
+                    if extractionMethod == 'native' and not cubesMade:
+                        # Native extraction works on the cubes.
+                        runFrameParallel(makeCubeFrames, tellist, ('tfbrsn', log, over, cubeMethod), numberOfProcesses, 'ctfbrsn')
+                        cubesMade = True
+                    extractOneD(tellist, kind, log, over, extractionXC, extractionYC, extractionRadius, numberOfProcesses, extractionMethod, extractionApertures)
 
-                    # TODO(nat): add this as a parameter; encapsulate this.
+                    # TODO(nat): add this as a parameter.
                     copyToScience = True
-                    if copyToScience:
-                        # Copy final extracted results to science directory.
-                        try:
-                            with open("scienceMatchedTellsList", "r") as f:
-                                lines = f.readlines()
-                            lines = [x.strip() for x in lines]
-
-                            for i in range(len(lines)):
-                                if "obs" in lines[i]:
-                                    k = 1
-                                    while i+k != len(lines) and "obs" not in lines[i+k]:
-                                        copyResultsToScience("gxtfbrsn"+tellist[0]+".fits", "0_tel"+lines[i+k]+".fits", over)
-                                        k+=1
-                        except IOError:
-                            logging.info("\nNo scienceMatchedTellsList found in "+ os.getcwd() +" . Skipping copy of extracted spectra to science directory.")
+                    if copyToScience and not deferTelluricCopy:
+                        if scratchPath:
+                            # Science directories are found relative to the observation directory.
+                            telluricCopyPending = True
+                        else:
+                            # Copy final extracted results to science directory.
+                            copyTelluricToScience(over)
 
                     logging.info("\n##############################################################################")
                     logging.info("")
@@ -455,8 +517,8 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
                     logging.info("##############################################################################\n")
                     #TODO(nat): add this as a parameter.
                     makeTelluricCube = True
-                    if makeTelluricCube:
-                        makeCube('tfbrsn', tellist, log, over)
+                    if makeTelluricCube and not cubesMade:
+                        runFrameParallel(makeCubeFrames, tellist, ('tfbrsn', log, over, cubeMethod), numberOfProcesses, 'ctfbrsn')
                         logging.info("\n##############################################################################")
                         logging.info("")
                         logging.info("  STEP 5b: Make uncorrected standard star data cubes, ->ctfbrsn  - COMPLETED")
@@ -467,14 +529,19 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
                 # Possibly extract 1D spectra, and make uncorrected cubes.
                 elif kind=='Science':
                     if scienceOneDExtraction:
-                        extractOneD(scienceFrameList, kind, log, over, extractionXC, extractionYC, extractionRadius)
-                        copyExtracted(scienceFrameList, over)
+                        if extractionMethod == 'native' and not cubesMade:
+                            # Native extraction works on the cubes.
+                            runFrameParallel(makeCubeFrames, scienceFrameList, ('tfbrsn', log, over, cubeMethod), numberOfProcesses, 'ctfbrsn')
+                            cubesMade = True
+                        extractOneD(scienceFrameList, kind, log, over, extractionXC, extractionYC, extractionRadius, numberOfProcesses, extractionMethod, extractionApertures)
+                        copyExtracted(scienceFrameList, over, pwd)
                         logging.info("\n##############################################################################")
                         logging.info("")
                         logging.info("  STEP 5a: Make extracted 1D Science spectra, ->ctgbrsn  - COMPLETED")
                         logging.info("")
                         logging.info("##############################################################################\n")
-                    makeCube('tfbrsn', scienceFrameList, log, over)
+                    if not cubesMade:
+                        runFrameParallel(makeCubeFrames, scienceFrameList, ('tfbrsn', log, over, cubeMethod), numberOfProcesses, 'ctfbrsn')
 
                     # TODO(nat): encapsulate this inside a function.
                     if os.path.exists('products_uncorrected'):
@@ -522,6 +589,14 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
 
             valindex += 1
 
+        if scratchPath:
+            scratchDirectory = os.getcwd()
+            os.chdir(pwd)
+            iraffunctions.chdir(pwd)
+            unstageFromScratch(scratchDirectory, pwd, scratchProducts, scratchIntermediates, over)
+            if telluricCopyPending:
+                copyTelluricToScience(over)
+
         logging.info("\n##############################################################################")
         logging.info("")
         logging.info("  COMPLETE - Reductions completed for " + str(observationDirectory))
@@ -531,6 +606,57 @@ def start(kind, telluricDirectoryList="", scienceDirectoryList=""):
     # Return to directory script was begun from.
     os.chdir(path)
 
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def reduceObservation(path, kind, observationDirectory):
+    """Reduce one observation directory with start(). Used by startConcurrent worker processes."""
+    os.chdir(path)
+    if kind == 'Telluric':
+        start(kind, telluricDirectoryList=[observationDirectory], deferTelluricCopy=True)
+    else:
+        start(kind, scienceDirectoryList=[observationDirectory])
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def startConcurrent(kinds, observationConcurrency):
+    """Reduce telluric and science observation directories concurrently.
+
+    Each observation directory is reduced by start() in a worker process, with at most
+    observationConcurrency running at a time. Extracted telluric spectra are copied to the
+    science directories once every observation is reduced.
+
+    Args:
+        kinds (list): 'Telluric' and/or 'Science'.
+        observationConcurrency (int): maximum number of observations reduced at once.
+
+    """
+    path = os.getcwd()
+    with open('./config.cfg') as config_file:
+        config = ConfigObj(config_file, unrepr=True)
+        over = config['over']
+        telluricDirectoryList = config['telluricDirectoryList']
+        scienceDirectoryList = config['scienceDirectoryList']
+
+    tasks = []
+    if 'Telluric' in kinds:
+        tasks += [(reduceObservation, (path, 'Telluric', directory)) for directory in telluricDirectoryList]
+    if 'Science' in kinds:
+        tasks += [(reduceObservation, (path, 'Science', directory)) for directory in scienceDirectoryList]
+
+    logging.info("\nReducing " + str(len(tasks)) + " observations with up to " + str(observationConcurrency) + " at a time.")
+    # Workers stay up between observations, so IRAF packages are only loaded once per worker.
+    errors = getPool(observationConcurrency).map(runWorkerTask, [makeWorkerTask(function, args) for function, args in tasks], chunksize=1)
+    for i in range(len(tasks)):
+        if errors[i]:
+            logging.info("\nReduction of " + tasks[i][1][2] + " failed:\n" + errors[i])
+
+    # Now every telluric is reduced, copy the extracted spectra to the science directories.
+    if 'Telluric' in kinds:
+        for observationDirectory in telluricDirectoryList:
+            os.chdir(observationDirectory)
+            copyTelluricToScience(over)
+        os.chdir(path)
+
 ##################################################################################################################
 #                                                     ROUTINES                                                   #
 ##################################################################################################################
@@ -553,74 +679,164 @@ def prepare(inlist, shiftima, finalBadPixelMask, log, over):
     """
 
     # Update frames with mdf offset value and generate variance and data quality extensions.
-    for frame in inlist:
-        if os.path.exists("n"+frame+".fits"):
-            if over:
-                os.remove("n"+frame+".fits")
-            else:
-                logging.info("Output file exists and -over not set - skipping prepare_list")
-                continue
-        iraf.nfprepare(frame, rawpath="", shiftimage=shiftima, fl_vardq="yes", bpm=finalBadPixelMask, fl_int='yes', fl_corr='no', fl_nonl='no', logfile=log)
-    inlist = checkLists(inlist, '.', 'n', '.fits')
+    inlist = runIrafTaskOnFrames(iraf.nfprepare, inlist, "", "n", over, rawpath="", shiftimage=shiftima, fl_vardq="yes", bpm=finalBadPixelMask, fl_int='yes', fl_corr='no', fl_nonl='no', logfile=log)
     return inlist
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
-def combineImages(inlist, out, log, over):
-    """Gemcombine multiple frames. Output: -->gn."""
+def streamFrameReduction(frames, skyFrameList, kind, firstStep, lastStep, makeCubes, shift, finalBadPixelMask, flat, arc, ronchi, log, over, numberOfProcesses, skySubtractionMethod='iraf', skyStackDirectory="", fitCoordsOnce=False, cubeMethod='iraf', skyStack=False, skipTransform=False):
+    """Run steps firstStep to lastStep (at most 4) of each frame as a graph of per-frame tasks.
 
-    if os.path.exists(out+".fits"):
-        if over:
-            iraf.delete(out+".fits")
-        else:
-            logging.info("Output file exists and -over not set - skipping combine_ima")
+    Each frame goes through prepare -> sky subtraction -> flat/bad pixels -> fitcoords/transform
+    (-> cube if makeCubes) as soon as its own inputs are ready. Prepared sky frames, and the
+    combined sky of a telluric observation (or of a science observation if skyStack is set),
+    are dependencies shared by several frames.
+
+    Pass an empty skyFrameList to copy frames to ->sn without sky subtraction. With
+    skipTransform, step 4 stops at ->fbrsn and native cubes are made from those frames.
+
+    Returns:
+        frames that made it through lastStep.
+    """
+    graph = OrderedDict()
+    steps = range(firstStep, lastStep+1)
+
+    def addTask(name, function, args, dependencies, after=()):
+        graph[name] = (function, args, [x for x in dependencies if x in graph], name+'.fits', [x for x in after if x in graph])
+        return name
+
+    # Shared inputs.
+    combinedSky = None
+    stackSkies = kind == 'Telluric' or skyStack
+    if skyFrameList:
+        if 1 in steps:
+            for sky in skyFrameList:
+                if 'n'+sky not in graph:
+                    addTask('n'+sky, prepare, ([sky], shift, finalBadPixelMask, log, over), [])
+        if stackSkies and 2 in steps:
+            preparedSkies = list(graph)
+            skies = list(OrderedDict.fromkeys(skyFrameList))
+            if len(skies) > 1:
+                combinedSky = addTask('gn'+skies[0], combineImages, (skies, 'gn'+skies[0], log, over, skyStackDirectory), preparedSkies)
+            else:
+                combinedSky = addTask('gn'+skies[0], copyImage, (skies, 'gn'+skies[0]+'.fits', over), preparedSkies)
+
+    # Per frame tasks, one frame after the other.
+    for i in range(len(frames)):
+        frame = frames[i]
+        last = None
+        if 1 in steps:
+            last = addTask('n'+frame, prepare, ([frame], shift, finalBadPixelMask, log, over), [])
+        if 2 in steps:
+            if not skyFrameList:
+                last = addTask('sn'+frame, copyUnsubtracted, ([frame],), [last])
+            elif stackSkies:
+                last = addTask('sn'+frame, skySubtractTel, ([frame], combinedSky, log, over, skySubtractionMethod), [last, combinedSky])
+            else:
+                last = addTask('sn'+frame, skySubtractObj, ([frame], [skyFrameList[i]], log, over, skySubtractionMethod), [last, 'n'+skyFrameList[i]])
+        if 3 in steps:
+            last = addTask('rsn'+frame, applyFlat, ([frame], flat, log, over, kind), [last])
+            last = addTask('brsn'+frame, fixBad, ([frame], log, over), [last])
+        if 4 in steps:
+            if fitCoordsOnce and i > 0:
+                # Reuse the solution of the first frame, or fit this frame if the first frame failed.
+                last = addTask('fbrsn'+frame, copyOrFitCoords, ([frame], frames[0], arc, ronchi, log, over, kind), [last], ['fbrsn'+frames[0]])
+            else:
+                last = addTask('fbrsn'+frame, fitCoords, ([frame], arc, ronchi, log, over, kind), [last])
+            if not skipTransform:
+                last = addTask('tfbrsn'+frame, transform, ([frame], log, over), [last])
+        if makeCubes:
+            addTask('ctfbrsn'+frame, makeCubeFrames, ([frame], 'tfbrsn', log, over, cubeMethod), [last])
+
+    runFrameGraph(graph, numberOfProcesses)
+    outPrefix = {1:'n', 2:'sn', 3:'brsn', 4:'fbrsn' if skipTransform else 'tfbrsn'}[lastStep]
+    return checkLists(frames, '.', outPrefix, '.fits')
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def combineImages(inlist, out, log, over, cacheDirectory=""):
+    """Gemcombine multiple frames. Output: -->gn.
+
+    If cacheDirectory is given, combined frames are stored there under a key made from the
+    data of the prepared input frames and the gemcombine parameters. A combination of the
+    same frames is then copied from the cache instead of being made again.
+
+    """
+    combineParameters = {'fl_dqpr':'yes', 'fl_vardq':'yes', 'masktype':"none", 'combine':"median"}
+    dependencies = lambda frame: (["n"+str(item).strip()+".fits" for item in inlist], ('gemcombine', sorted(combineParameters.items())))
+    if not framesToProcess([out], "", over, dependencies=dependencies):
+        return
+
+    if cacheDirectory:
+        # Headers of prepared frames have time stamps, so only their data is used in the key.
+        inputHashes = sorted(hashFitsData("n"+str(frame).strip()+".fits") for frame in inlist)
+        cacheKey = hashlib.md5(repr((inputHashes, sorted(combineParameters.items())))).hexdigest()
+        cacheFile = os.path.join(cacheDirectory, cacheKey+".fits")
+        if os.path.exists(cacheFile):
+            logging.info("\nCopying combined sky frame " + out + " from the sky stack cache.")
+            shutil.copy(cacheFile, out+".fits")
+            # Mark it as recently used for pruneCache.
+            os.utime(cacheFile, None)
+            recordOutputs([out], "", dependencies)
             return
 
-    iraf.gemcombine(listit(inlist,"n"),output=out,fl_dqpr='yes', fl_vardq='yes',masktype="none", combine="median", logfile=log)
+    iraf.gemcombine(listit(inlist,"n"),output=out, logfile=log, **combineParameters)
+    recordOutputs([out], "", dependencies)
+
+    if cacheDirectory and os.path.exists(out+".fits"):
+        # Copy to a temporary file first so a crash can't leave a partial stack in the cache.
+        shutil.copy(out+".fits", cacheFile+".tmp")
+        os.rename(cacheFile+".tmp", cacheFile)
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
 def copyImage(input, output, over):
     """Copy a frame (used to add the correct prefix when skipping steps)."""
 
-    if os.path.exists(output):
-        if over:
-            iraf.delete(output)
-        else:
-            logging.info("Output file exists and -over not set - skipping copy_ima")
-            return
+    name = output[:-len('.fits')] if output.endswith('.fits') else output
+    dependencies = lambda frame: (['n'+input[0]+'.fits'], 'copy')
+    if not framesToProcess([name], "", over, dependencies=dependencies):
+        return
 
     iraf.copy('n'+input[0]+'.fits', output)
+    recordOutputs([name], "", dependencies)
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
-def skySubtractObj(objlist, skyFrameList, log, over):
-    """"Sky subtraction for science using iraf.gemarith. Output: ->sgn"""
+def copyUnsubtracted(objlist):
+    """Copy frames to ->sn when sky subtraction is not done."""
 
-    for i in range(len(objlist)):
-        frame = str(objlist[i])
-        sky = str(skyFrameList[i])
-        if os.path.exists("sn"+frame+".fits"):
-           if over:
-               os.remove("sn"+frame+".fits")
-           else:
-               logging.info("Output file exists and -over not set - skipping skysub_list")
-               continue
-        iraf.gemarith ("n"+frame, "-", "n"+sky, "sn"+frame, fl_vardq="yes", logfile=log)
+    for image in objlist:
+        iraf.copy('n'+image+'.fits', 'sn'+image+'.fits')
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
-def skySubtractTel(tellist, sky, log, over):
-    """Sky subtraction for telluric using iraf.gemarith. Output: ->sgn"""
+def skySubtractObj(objlist, skyFrameList, log, over, method='iraf'):
+    """"Sky subtraction for science using iraf.gemarith (or numpy if method is 'native'). Output: ->sgn"""
 
-    for frame in tellist:
-        if os.path.exists("sn"+frame+".fits"):
-            if over:
-                os.remove("sn"+frame+".fits")
-            else:
-                logging.info("Output file exists and -over not set - skipping skySubtractTel.")
-                continue
+    if method == 'native':
+        subtractSky(objlist, ["n"+str(sky).strip() for sky in skyFrameList], over)
+        return
+
+    skyOfFrame = dict(zip([str(frame).strip() for frame in objlist], [str(sky).strip() for sky in skyFrameList]))
+    dependencies = lambda frame: (["n"+frame+".fits", "n"+skyOfFrame[frame]+".fits"], 'gemarith')
+    for frame in framesToProcess(objlist, "sn", over, dependencies=dependencies):
+        iraf.gemarith ("n"+frame, "-", "n"+skyOfFrame[frame], "sn"+frame, fl_vardq="yes", logfile=log)
+        recordOutputs([frame], "sn", dependencies)
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def skySubtractTel(tellist, sky, log, over, method='iraf'):
+    """Sky subtraction for telluric using iraf.gemarith (or numpy if method is 'native'). Output: ->sgn"""
+
+    if method == 'native':
+        subtractSky(tellist, [sky]*len(tellist), over)
+        return
+
+    dependencies = lambda frame: (["n"+frame+".fits", sky+".fits"], 'gemarith')
+    for frame in framesToProcess(tellist, "sn", over, dependencies=dependencies):
         iraf.gemarith ("n"+frame, "-", sky, "sn"+frame, fl_vardq="yes", logfile=log)
+        recordOutputs([frame], "sn", dependencies)
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
@@ -640,15 +856,7 @@ def applyFlat(objlist, flat, log, over, kind, dark=""):
     if dark != "":
         fl_dark = "yes"
 
-    for frame in objlist:
-        frame = str(frame).strip()
-        if os.path.exists("rsn"+frame+".fits"):
-            if over:
-                os.remove("rsn"+frame+".fits")
-            else:
-                logging.info("Output file exists and -over not set - skipping apply_flat_list")
-                continue
-        iraf.nsreduce("sn"+frame, fl_cut="yes", fl_nsappw="yes", fl_dark="no", fl_sky="no", fl_flat="yes", flatimage=flat, fl_vardq="yes",logfile=log)
+    return runIrafTaskOnFrames(iraf.nsreduce, objlist, "sn", "rsn", over, fl_cut="yes", fl_nsappw="yes", fl_dark="no", fl_sky="no", fl_flat="yes", flatimage=flat, fl_vardq="yes",logfile=log)
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
@@ -664,19 +872,11 @@ def fixBad(objlist, log, over):
 
     """
 
-    for frame in objlist:
-        frame = str(frame).strip()
-        if os.path.exists("brsn"+frame+".fits"):
-            if over:
-                os.remove("brsn"+frame+".fits")
-            else:
-                logging.info("Output file exists and -over not set - skipping fixbad_list")
-                continue
-        iraf.nffixbad("rsn"+frame,logfile=log)
+    return runIrafTaskOnFrames(iraf.nffixbad, objlist, "rsn", "brsn", over, logfile=log)
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
-def fitCoords(objlist, arc, ronchi, log, over, kind):
+def fitCoords(objlist, arc, ronchi, log, over, kind, once=False):
     """Derive the 2D to 3D spatial/spectral transformation with iraf.nsfitcoords.
     Output: -->fbrsn
 
@@ -688,17 +888,77 @@ def fitCoords(objlist, arc, ronchi, log, over, kind):
     NFSDIST and converts this into a calculation of where the data
     information should map to in a final IFU dataset.
 
+    The fit only depends on the arc, the ronchi and the fit orders, so with once set it is
+    done for one frame and copied to the other frames with copyFitCoords.
+
     """
+    fitParameters = dict(lamptransf=arc, sdisttransf=ronchi, database="database", lxorder=3, lyorder=2, sxorder=3, syorder=3, logfile=log)
+    if not once:
+        return runIrafTaskOnFrames(iraf.nsfitcoords, objlist, "brsn", "fbrsn", over, **fitParameters)
 
+    todo = framesToProcess(objlist, "fbrsn", over)
+    # Use a frame fitted by an earlier run if there is one.
+    reference = None
     for frame in objlist:
         frame = str(frame).strip()
-        if os.path.exists("fbrsn"+frame+".fits"):
-            if over:
-                os.remove("fbrsn"+frame+".fits")
-            else:
-                logging.info("Output file exists and -over not set - skipping fitcoord_list")
-                continue
-        iraf.nsfitcoords("brsn"+frame, lamptransf=arc, sdisttransf=ronchi, database="database", lxorder=3, lyorder=2, sxorder=3, syorder=3, logfile=log)
+        if frame not in todo and os.path.exists("fbrsn"+frame+".fits") and glob.glob("database/fcfbrsn"+frame+"_*"):
+            reference = frame
+            break
+    while reference is None and todo:
+        frame = todo.pop(0)
+        if runIrafTaskOnFrames(iraf.nsfitcoords, [frame], "brsn", "fbrsn", over, **fitParameters):
+            reference = frame
+    if reference:
+        copyFitCoords(todo, reference, over)
+    return checkLists(objlist, '.', 'fbrsn', '.fits')
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def copyOrFitCoords(objlist, reference, arc, ronchi, log, over, kind):
+    """Give frames the nsfitcoords solution of reference, or fit them with fitCoords if reference has none. Output: -->fbrsn"""
+    if os.path.exists("fbrsn"+reference+".fits") and glob.glob("database/fcfbrsn"+reference+"_*"):
+        copyFitCoords(objlist, reference, over)
+    else:
+        logging.info("\nNo nsfitcoords solution of " + reference + " to copy; fitting " + ", ".join(objlist) + " instead.")
+        fitCoords(objlist, arc, ronchi, log, over, kind)
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def copyFitCoords(objlist, reference, over):
+    """Give frames the nsfitcoords solution of reference without running iraf.nsfitcoords. Output: -->fbrsn
+
+    Copies brsn frames to fbrsn, adds the header keywords nsfitcoords added to reference (with the
+    frame name in place of the reference name) and copies the database/fc* files of reference.
+
+    """
+    # Find the keywords nsfitcoords added or changed.
+    with astropy.io.fits.open("brsn"+reference+".fits") as before:
+        with astropy.io.fits.open("fbrsn"+reference+".fits") as after:
+            addedCards = []
+            for i in range(len(after)):
+                cards = []
+                for card in after[i].header.cards:
+                    if card.keyword in ('', 'COMMENT', 'HISTORY'):
+                        continue
+                    if card.keyword not in before[i].header or before[i].header[card.keyword] != card.value:
+                        cards.append((card.keyword, card.value, card.comment))
+                addedCards.append(cards)
+    databaseFiles = glob.glob("database/fcfbrsn"+reference+"_*")
+
+    for frame in framesToProcess(objlist, "fbrsn", over):
+        shutil.copy("brsn"+frame+".fits", "fbrsn"+frame+".fits")
+        with astropy.io.fits.open("fbrsn"+frame+".fits", mode='update') as hdulist:
+            for i in range(len(addedCards)):
+                for keyword, value, comment in addedCards[i]:
+                    if isinstance(value, basestring):
+                        value = value.replace(reference, frame)
+                    hdulist[i].header[keyword] = (value, comment)
+        for databaseFile in databaseFiles:
+            newDatabaseFile = databaseFile.replace(reference, frame)
+            shutil.copy(databaseFile, newDatabaseFile)
+            replaceNameDatabaseFiles(newDatabaseFile, reference, frame)
+        recordOutputs([frame], "fbrsn")
+        logging.info("Copied the nsfitcoords solution of " + reference + " to " + frame)
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
@@ -717,19 +977,11 @@ def transform(objlist, log, over):
 
     """
 
-    for frame in objlist:
-        frame = str(frame).strip()
-        if os.path.exists("tfbrsn"+frame+".fits"):
-            if over:
-                iraf.delete("tfbrsn"+frame+".fits")
-            else:
-                logging.info("Output file exists and -over not set - skipping transform_list")
-                continue
-        iraf.nstransform("fbrsn"+frame, logfile=log)
+    return runIrafTaskOnFrames(iraf.nstransform, objlist, "fbrsn", "tfbrsn", over, logfile=log)
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
-def makeCube(pre, scienceFrameList, log, over):
+def makeCube(pre, scienceFrameList, log, over, method='iraf'):
     """ Reformat the data into a 3-D datacube using iraf.nifcube. Output: -->ctfbrsgn.
 
     NIFCUBE - Construct 3D NIFS datacubes.
@@ -738,19 +990,30 @@ def makeCube(pre, scienceFrameList, log, over):
     NFTRANSFORM and converts the 2D data images into data cubes
     that have coordinates of x, y, lambda.
 
+    If method is 'native', cubes are made straight from the fbrsn frames by
+    nifsNative.makeNativeCubes instead.
+
     """
-    for frame in scienceFrameList:
-        if os.path.exists("c"+pre+frame+".fits"):
-            if over:
-                iraf.delete("c"+pre+frame+".fits")
-            else:
-                logging.info("Output file exists and -over not set - skipping make_cube_list")
-                continue
-        iraf.nifcube (pre+frame, outcubes = 'c'+pre+frame, logfile=log)
+    if method == 'native':
+        makeNativeCubes(scienceFrameList, over)
+        return checkLists(scienceFrameList, '.', "c"+pre, '.fits')
+    return runIrafTaskOnFrames(iraf.nifcube, scienceFrameList, pre, "c"+pre, over, outprefix='c', logfile=log)
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def makeCubeFrames(scienceFrameList, pre, log, over, method='iraf'):
+    """makeCube with the frame list first, so frames can be split between processes with runFrameParallel."""
+    return makeCube(pre, scienceFrameList, log, over, method)
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
-def extractOneD(inputList, kind, log, over, extractionXC=15.0, extractionYC=33.0, extractionRadius=2.5):
+def extractFrames(inputList, log, over, extractionXC=15.0, extractionYC=33.0, extractionRadius=2.5):
+    """Extract 1-D spectra of each frame with iraf.nfextract. Output: -->xtfbrsn"""
+    return runIrafTaskOnFrames(iraf.nfextract, inputList, "tfbrsn", "xtfbrsn", over, outpref="x", xc=extractionXC, yc=extractionYC, diameter=extractionRadius, fl_int='no', logfile=log)
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def extractOneD(inputList, kind, log, over, extractionXC=15.0, extractionYC=33.0, extractionRadius=2.5, numberOfProcesses=1, method='iraf', apertures=None):
     """Extracts 1-D spectra with iraf.nfextract and combines them with iraf.gemcombine.
     iraf.nfextract is currently only done interactively. Output: -->xtfbrsn and gxtfbrsn
 
@@ -761,33 +1024,31 @@ def extractOneD(inputList, kind, log, over, extractionXC=15.0, extractionYC=33.0
     telluric calibrator stars. Note that this routine only works
     on data that has been run through NFTRANSFORM.
 
+    If method is 'native', spectra are extracted from the ctfbrsn cubes by
+    nifsNative.extractNativeSpectra instead; apertures is a list of (xc, yc, radius)
+    in cube pixels and the first aperture is the one used later by the pipeline.
+
     """
 
-    for frame in inputList:
-        frame = str(frame).strip()
-        if os.path.exists("xtfbrsn"+frame+".fits"):
-            if over:
-                iraf.delete("xtfbrsn"+frame+".fits")
-            else:
-                logging.info("Output file exists and -over not set - skipping nfextract in extract1D")
-                continue
-
-        iraf.nfextract("tfbrsn"+frame, outpref="x", xc=extractionXC, yc=extractionYC, diameter=extractionRadius, fl_int='no', logfile=log)
-    inputList = checkLists(inputList, '.', 'xtfbrsn', '.fits')
-    # Combine all the 1D spectra to one final output file with the name of the first input file.
-    combined = str(inputList[0]).strip()
-    if len(inputList) > 1:
-        if os.path.exists("gxtfbrsn"+combined+".fits"):
-            if over:
-                iraf.delete("gxtfbrsn"+combined+".fits")
-            else:
-                logging.info("Output file exists and -over not set - skipping gemcombine in extract1D")
-                return
-        iraf.gemcombine(listit(inputList,"xtfbrsn"),output="gxtfbrsn"+combined, statsec="[*]", combine="median",masktype="none",fl_vardq="yes", logfile=log)
+    if method == 'native':
+        if not apertures:
+            # The nfextract aperture, converted from slices and slice pixels to 0.05" cube pixels.
+            apertures = [(extractionXC * 0.103 / 0.05, extractionYC * 0.043 / 0.05, extractionRadius / 2. * 0.043 / 0.05)]
+        inputList = extractNativeSpectra(inputList, apertures, over)
+        if not inputList:
+            return
+        combined = inputList[0]
     else:
-        if over:
-            iraf.delete("gxtfbrsn"+combined+".fits")
-        iraf.copy(input="xtfbrsn"+combined+".fits", output="gxtfbrsn"+combined+".fits")
+        inputList = runFrameParallel(extractFrames, inputList, (log, over, extractionXC, extractionYC, extractionRadius), numberOfProcesses, "xtfbrsn")
+        # Combine all the 1D spectra to one final output file with the name of the first input file.
+        combined = str(inputList[0]).strip()
+        dependencies = lambda frame: (["xtfbrsn"+str(item).strip()+".fits" for item in inputList], 'gemcombine')
+        if framesToProcess([combined], "gxtfbrsn", over, dependencies=dependencies):
+            if len(inputList) > 1:
+                iraf.gemcombine(listit(inputList,"xtfbrsn"),output="gxtfbrsn"+combined, statsec="[*]", combine="median",masktype="none",fl_vardq="yes", logfile=log)
+            else:
+                iraf.copy(input="xtfbrsn"+combined+".fits", output="gxtfbrsn"+combined+".fits")
+            recordOutputs([combined], "gxtfbrsn", dependencies)
 
     if kind == 'Telluric':
         # Put the name of the final combined file into a text file called
@@ -798,13 +1059,41 @@ def extractOneD(inputList, kind, log, over, extractionXC=15.0, extractionYC=33.0
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 
-def copyExtracted(scienceFrameList, over):
+def copyTelluricToScience(over):
+    """Copy the combined extracted telluric spectrum to the science directories listed in scienceMatchedTellsList.
+
+    Output: -->0_tel<scienceFrame> in the science observation directories.
+
+    """
+    try:
+        with open("telluricfile", "r") as f:
+            telluric = f.read().strip()
+        with open("scienceMatchedTellsList", "r") as f:
+            lines = f.readlines()
+    except IOError:
+        logging.info("\nNo telluricfile or scienceMatchedTellsList found in "+ os.getcwd() +" . Skipping copy of extracted spectra to science directory.")
+        return
+    lines = [x.strip() for x in lines]
+
+    for i in range(len(lines)):
+        if "obs" in lines[i]:
+            k = 1
+            while i+k != len(lines) and "obs" not in lines[i+k]:
+                copyResultsToScience(telluric+".fits", "0_tel"+lines[i+k]+".fits", over)
+                k+=1
+
+#--------------------------------------------------------------------------------------------------------------------------------#
+
+def copyExtracted(scienceFrameList, over, observationDirectory):
     """
     Copy all extracted 1D spectra to objectname/ExtractedOneD/date_obsname/,
     and combined 1D spectra to objectname/ExtractedOneD
+
+    The spectra are read from the current directory, which can be a scratch
+    directory; the destination is found from observationDirectory.
     """
     # TODO(nat): make this clearer.
-    obsDir = os.getcwd()
+    obsDir = os.path.realpath(observationDirectory)
     temp1 = os.path.split(obsDir)
     temp2 = os.path.split(temp1[0])
     temp3 = os.path.split(temp2[0])
@@ -813,7 +1102,6 @@ def copyExtracted(scienceFrameList, over):
     date = temp3[1]
     obsid = temp1[1]
     obsPath = temp3[0]
-    os.chdir(obsDir)
     # Create a directory called ExtractedOneD and copy all the data cubes to this directory.
     if not os.path.exists(obsPath+'/ExtractedOneD/'):
         os.mkdir(obsPath+'/ExtractedOneD/')
@@ -31,7 +31,6 @@
 
 from xml.dom.minidom import parseString
 import urllib
-from pyraf import iraf
 import astropy.io.fits
 import os, sys, shutil, glob, math, logging, pkg_resources, time, datetime, re
 import numpy as np
@@ -22,7 +22,7 @@
 
 # STDLIB
 
-import glob, shutil, os, logging, glob, urllib, re, traceback, pkg_resources
+import collections, glob, shutil, os, sys, time, logging, glob, urllib, urllib2, re, json, hashlib, argparse, traceback, pkg_resources
 from pyraf import iraf, iraffunctions
 import astropy.io.fits
 import numpy as np
@@ -33,12 +33,19 @@ import matplotlib.pyplot as plt
 
 # Import config parsing.
 from ..configobj.configobj import ConfigObj
+# Import custom Nifty functions.
+from ..nifsIraf import loadIrafPackages
+from ..nifsNative import LazyCube, applySpectrumToCube, findTelluricShiftScale, fitContinua, getSpectrumWavelengths, removeVegaLines
+from ..nifsUtils import setJournal, isJournaled, journalUnit, startUnit, writeFits, hashFitsData, getCachePath
 
 # Define constants
 # Paths to Nifty data.
 RECIPES_PATH = pkg_resources.resource_filename('nifty', 'recipes/')
 RUNTIME_DATA_PATH = pkg_resources.resource_filename('nifty', 'runtimeData/')
 
+# Effective temperatures of new_starstemp.txt by spectral type. See getSpectralTypeTemperature.
+spectralTypeTemperatures = collections.OrderedDict()
+
 def run():
     """
     Do a telluric correction.
@@ -76,9 +83,26 @@ def run():
         standardStarBand = telluricCorrectionConfig['standardStarBand']
         standardStarRA = telluricCorrectionConfig['standardStarRA']
         standardStarDec = telluricCorrectionConfig['standardStarDec']
+        # Standard star lookups are cached; SIMBAD is only queried for stars not in the cache.
+        # 'native' finds the shift and scale of the telluric correction with numpy instead of iraf.telluric.
+        shiftScaleMethod = telluricCorrectionConfig.get('shiftScaleMethod', 'iraf')
+        # 'native' fits the continuum of the telluric correction with numpy instead of iraf.continuum.
+        continuumMethod = telluricCorrectionConfig.get('continuumMethod', 'iraf')
+        simbadRetries = telluricCorrectionConfig.get('simbadRetries', 3)
+        simbadTimeout = telluricCorrectionConfig.get('simbadTimeout', 10.0)
+        cachePath = config.get('cachePath', '')
+        # Keep derived telluric corrections in the Nifty cache and reuse them for any science
+        # observation, rerun or program using the same standard star observation.
+        telluricLibrary = telluricCorrectionConfig.get('telluricLibrary', False) and not (hLineInter or continuumInter)
+        telluricParameters = {'hLineMethod': hLineMethod, 'continuumMethod': continuumMethod, 'standardStarSpecTemperature': standardStarSpecTemperature, \
+                              'standardStarMagnitude': standardStarMagnitude, 'standardStarBand': standardStarBand, 'standardStarRA': standardStarRA, 'standardStarDec': standardStarDec}
+        # Journal finished steps of each frame and skip them when resuming. Steps that were
+        # started but not finished may have been cut short, so they are redone with -over.
+        resumeFromJournal = config.get('resumeFromJournal', False)
+        setJournal(path+'/Nifty.journal', resumeFromJournal)
 
     # TESTING IRAF
-    iraf.gemini()
+    loadIrafPackages(['gemini'])
     #iraf.gemtools()
     #iraf.gnirs()
     #iraf.nifs()
@@ -107,12 +131,33 @@ def run():
         temp3 = os.path.split(temp2[0]) # Looks like: ('/Users/nat/tests/core/linearPipelineTest/HD141004/20100401', 'K')
         grating = temp3[1] # Looks like: 'K'
 
+        # 0_tel files are copies of the same telluric spectrum; steps 1 to 4 only depend on it,
+        # so they are done for the first frame using each telluric and copied for the others.
+        telluricReferences = getTelluricReferences(scienceFrameList)
+        libraryEntries = {}
+        if telluricLibrary:
+            for rawFrame in set(telluricReferences.values()):
+                if os.path.exists('0_tel'+rawFrame+'.fits'):
+                    libraryEntries[rawFrame] = getTelluricLibraryEntry(rawFrame, telluricParameters, cachePath, over)
+
         for rawFrame in scienceFrameList:
 
             valindex = start
             while valindex <= stop:
-                if valindex == 1:
-                    getStandardInfo(rawFrame, standardStarMagnitude, standardStarSpecTemperature, standardStarBand, standardStarRA, standardStarDec, log, over)
+                if isJournaled(rawFrame, 'telluricCorrection'+str(valindex)):
+                    logging.info("\nStep " + str(valindex) + " of " + rawFrame + " is in the journal - skipping it.")
+                    valindex += 1
+                    continue
+                unitOver = startUnit(rawFrame, 'telluricCorrection'+str(valindex), over)
+                reused = valindex <= 4 and telluricReferences[rawFrame] != rawFrame
+                if reused:
+                    copyTelluricDerivation(telluricReferences[rawFrame], rawFrame, valindex, unitOver)
+                    logging.info("\nStep " + str(valindex) + " of " + rawFrame + " reused from " + telluricReferences[rawFrame] + ", which has the same telluric spectrum.")
+                elif valindex <= 4 and rawFrame in libraryEntries:
+                    reused = useTelluricLibrary(libraryEntries[rawFrame], rawFrame, valindex, unitOver)
+
+                if valindex == 1 and not reused:
+                    getStandardInfo(rawFrame, standardStarMagnitude, standardStarSpecTemperature, standardStarBand, standardStarRA, standardStarDec, simbadRetries, simbadTimeout, cachePath, log, unitOver)
 
                     logging.info("\n##############################################################################")
                     logging.info("")
@@ -120,8 +165,8 @@ def run():
                     logging.info("")
                     logging.info("##############################################################################\n")
 
-                if valindex == 2:
-                    hLineCorrection(rawFrame, grating, hLineInter, hLineMethod, tempInter, log, over)
+                if valindex == 2 and not reused:
+                    hLineCorrection(rawFrame, grating, hLineInter, hLineMethod, tempInter, log, unitOver)
 
                     logging.info("\n##############################################################################")
                     logging.info("")
@@ -129,16 +174,16 @@ def run():
                     logging.info("")
                     logging.info("##############################################################################\n")
 
-                if valindex == 3:
-                    fitContinuum(rawFrame, grating, continuumInter, tempInter, log, over)
+                if valindex == 3 and not reused:
+                    fitContinuum(rawFrame, grating, continuumInter, tempInter, log, unitOver, continuumMethod)
                     logging.info("\n##############################################################################")
                     logging.info("")
                     logging.info("  STEP 3 - COMPLETED ")
                     logging.info("")
                     logging.info("##############################################################################\n")
 
-                if valindex == 4:
-                    divideByContinuum(rawFrame, log, over)
+                if valindex == 4 and not reused:
+                    divideByContinuum(rawFrame, log, unitOver)
                     logging.info("\n##############################################################################")
                     logging.info("")
                     logging.info("  STEP 4 - COMPLETED ")
@@ -146,7 +191,7 @@ def run():
                     logging.info("##############################################################################\n")
 
                 if valindex == 5:
-                    get1dSpecFromCube(rawFrame, log, over)
+                    get1dSpecFromCube(rawFrame, log, unitOver)
                     logging.info("\n##############################################################################")
                     logging.info("")
                     logging.info("  STEP 5 - COMPLETED ")
@@ -154,7 +199,7 @@ def run():
                     logging.info("##############################################################################\n")
 
                 if valindex == 6:
-                    getShiftScale(rawFrame, telluricInter, log, over)
+                    getShiftScale(rawFrame, telluricInter, log, unitOver, shiftScaleMethod)
                     logging.info("\n##############################################################################")
                     logging.info("")
                     logging.info("  STEP 6 - COMPLETED ")
@@ -162,8 +207,8 @@ def run():
                     logging.info("##############################################################################\n")
                 # Shift and scale the telluric correction spectrum and continuum fit to the telluric correction spectrum.
                 if valindex == 7:
-                    shiftScaleSpec(rawFrame, "2_fit", "6_shiftedFit", log, over)
-                    shiftScaleSpec(rawFrame, "3_chtel", "7_schtel", log, over)
+                    shiftScaleSpec(rawFrame, "2_fit", "6_shiftedFit", log, unitOver, native=shiftScaleMethod == 'native', scaleSpectrum=False)
+                    shiftScaleSpec(rawFrame, "3_chtel", "7_schtel", log, unitOver, native=shiftScaleMethod == 'native')
                     logging.info("\n##############################################################################")
                     logging.info("")
                     logging.info("  STEP 7 - COMPLETED ")
@@ -171,7 +216,7 @@ def run():
                     logging.info("##############################################################################\n")
 
                 if valindex == 8:
-                    divideCubebyTel(rawFrame, log, over)
+                    divideCubebyTel(rawFrame, log, unitOver)
                     logging.info("\n##############################################################################")
                     logging.info("")
                     logging.info("  STEP 8 - COMPLETED ")
@@ -179,7 +224,7 @@ def run():
                     logging.info("##############################################################################\n")
 
                 if valindex == 9:
-                    copyToFluxCalDirectory(rawFrame, log, over)
+                    copyToFluxCalDirectory(rawFrame, log, unitOver)
                     logging.info("\n##############################################################################")
                     logging.info("")
                     logging.info("  STEP 9 - COMPLETED ")
@@ -187,17 +232,324 @@ def run():
                     logging.info("##############################################################################\n")
 
 
+                if valindex <= 4 and rawFrame in libraryEntries and not reused:
+                    storeInTelluricLibrary(libraryEntries[rawFrame], rawFrame, valindex, cachePath)
+
+                journalUnit(rawFrame, 'telluricCorrection'+str(valindex))
                 valindex += 1
 
         os.chdir(path)
 
-def getStandardInfo(rawFrame, standardStarMagnitude, standardStarSpecTemperature, standardStarBand, standardStarRA, standardStarDec, log, over):
+def getTelluricReferences(scienceFrameList):
+    """
+    Map each science frame to the first frame of scienceFrameList with the same
+    0_tel telluric spectrum, comparing the data of the files.
+    """
+    references = {}
+    firstFrames = {}
+    for rawFrame in scienceFrameList:
+        if not os.path.exists('0_tel'+rawFrame+'.fits'):
+            references[rawFrame] = rawFrame
+            continue
+        references[rawFrame] = firstFrames.setdefault(hashFitsData('0_tel'+rawFrame+'.fits'), rawFrame)
+    return references
+
+def getTelluricDerivationFiles(rawFrame, step):
+    """
+    Files made by step (1 to 4) of the telluric correction of rawFrame.
+    """
+    if step == 1:
+        return ['../products_fluxcal_AND_telluric_corrected/0_std_star'+rawFrame+'.txt']
+    if step == 2:
+        return ['1_htel'+rawFrame+'.fits']
+    if step == 3:
+        return ['2_fit'+rawFrame+'.fits', '../products_fluxcal_AND_telluric_corrected/0_fit'+rawFrame+'.fits']
+    if step == 4:
+        return ['3_chtel'+rawFrame+'.fits']
+    return []
+
+def copyFile(source, destination, over):
+    """
+    Copy source to destination, replacing destination if over is set.
+    """
+    if os.path.exists(destination):
+        if over:
+            os.remove(destination)
+        else:
+            logging.info("\nOutput exists and -over not set - skipping copy of " + source)
+            return
+    shutil.copy(source, destination)
+
+def copyTelluricDerivation(reference, rawFrame, step, over):
+    """
+    Copy the files made by step of the telluric correction of reference to the
+    names used by rawFrame.
+    """
+    for referenceFile, frameFile in zip(getTelluricDerivationFiles(reference, step), getTelluricDerivationFiles(rawFrame, step)):
+        if not os.path.exists(referenceFile):
+            logging.info("\nWARNING: " + referenceFile + " was not made - can't reuse it for " + rawFrame)
+            continue
+        copyFile(referenceFile, frameFile, over)
+
+def getTelluricLibraryEntry(rawFrame, parameters, cachePath="", over=False):
+    """
+    Find the telluric library entry for the 0_tel spectrum of rawFrame.
+
+    The telluric library, in the tellurics directory of the Nifty cache, holds the files made by
+    steps 1 to 4 of telluric corrections. index.json lists them by standard star, date, grating
+    and airmass. An entry is only reused if it was derived from the same spectrum data with the
+    same parameters; otherwise it is started again. If over is set the stored steps are not
+    reused, and the entry is replaced as the steps are redone.
+
+    Returns:
+        a dictionary with the key, directory and finished steps of the entry.
+    """
+    header = astropy.io.fits.getheader('0_tel'+rawFrame+'.fits')
+    key = "{}_{}_{}_{:.2f}".format(str(header.get('OBJECT', 'unknown')).replace(' ', ''), header.get('DATE-OBS', 'unknown'), \
+                                   str(header.get('GRATING', 'unknown')).strip(), float(header.get('AIRMASS', 0.)))
+    libraryPath = getCachePath('tellurics', cachePath)
+    entry = {'key': key, 'directory': os.path.join(libraryPath, key), 'dataHash': hashFitsData('0_tel'+rawFrame+'.fits'), \
+             'parameters': hashlib.md5(json.dumps(parameters, sort_keys=True)).hexdigest(), 'steps': []}
+    if over:
+        return entry
+    index = readTelluricLibraryIndex(cachePath)
+    stored = index.get(key)
+    if stored and stored['dataHash'] == entry['dataHash'] and stored['parameters'] == entry['parameters']:
+        entry['steps'] = stored['steps']
+        logging.info("\nFound the telluric correction of " + key + " in the telluric library; steps " + str(entry['steps']) + " are done.")
+    return entry
+
+def readTelluricLibraryIndex(cachePath=""):
+    """
+    Returns the index of the telluric library; a dictionary of entries by key.
+    """
+    indexFile = os.path.join(getCachePath('tellurics', cachePath), 'index.json')
+    try:
+        with open(indexFile, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def useTelluricLibrary(entry, rawFrame, step, over):
+    """
+    Copy the files of step from the telluric library to the names used by rawFrame.
+    Returns True if the library had them.
+    """
+    if step not in entry['steps']:
+        return False
+    libraryFiles = [os.path.join(entry['directory'], os.path.basename(name)) for name in getTelluricDerivationFiles('', step)]
+    if not all(os.path.exists(libraryFile) for libraryFile in libraryFiles):
+        return False
+    if not os.path.exists('../products_fluxcal_AND_telluric_corrected'):
+        os.mkdir('../products_fluxcal_AND_telluric_corrected')
+    for libraryFile, frameFile in zip(libraryFiles, getTelluricDerivationFiles(rawFrame, step)):
+        copyFile(libraryFile, frameFile, over)
+    logging.info("\nStep " + str(step) + " of " + rawFrame + " taken from the telluric library entry " + entry['key'])
+    return True
+
+def storeInTelluricLibrary(entry, rawFrame, step, cachePath=""):
+    """
+    Add the files made by step of the telluric correction of rawFrame to its telluric library entry.
+    """
+    frameFiles = getTelluricDerivationFiles(rawFrame, step)
+    if not all(os.path.exists(frameFile) for frameFile in frameFiles):
+        return
+    if not os.path.exists(entry['directory']):
+        os.makedirs(entry['directory'])
+    for frameFile, name in zip(frameFiles, getTelluricDerivationFiles('', step)):
+        copyFile(frameFile, os.path.join(entry['directory'], os.path.basename(name)), True)
+    if step not in entry['steps']:
+        entry['steps'] = sorted(entry['steps'] + [step])
+    # Re-read the index in case another reduction added to it, and write it atomically.
+    index = readTelluricLibraryIndex(cachePath)
+    index[entry['key']] = {'dataHash': entry['dataHash'], 'parameters': entry['parameters'], 'steps': entry['steps']}
+    indexFile = os.path.join(getCachePath('tellurics', cachePath), 'index.json')
+    with open(indexFile+'.part', 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.rename(indexFile+'.part', indexFile)
+
+def getSpectralTypeTemperature(spectralType):
+    """
+    Returns the effective temperature of new_starstemp.txt for a spectral type as a string,
+    or '' if there is none. The table is read once per process.
+
+    Like the table scan this replaces, the first type of the table containing spectralType
+    is used when there isn't an exact match. Eg: 'A0' matches 'A0V'.
+    """
+    if not spectralType:
+        return ''
+    if not spectralTypeTemperatures:
+        with open(RUNTIME_DATA_PATH+'new_starstemp.txt') as f:
+            for line in f:
+                if '#' in line or not line.split():
+                    continue
+                spectralTypeTemperatures[line.split()[0]] = line.split()[1]
+    if spectralType in spectralTypeTemperatures:
+        return spectralTypeTemperatures[spectralType]
+    for tableType in spectralTypeTemperatures:
+        if spectralType in tableType:
+            return spectralTypeTemperatures[tableType]
+    return ''
+
+def getStandardCacheKey(standardStarRA, standardStarDec):
+    """
+    Key of a star in the standard star cache: its coordinates in degrees rounded to 0.001
+    degrees, so headers of different observations of a star give the same key.
+    """
+    try:
+        return '%.3f %+.3f' % (float(standardStarRA), float(standardStarDec))
+    except ValueError:
+        return str(standardStarRA)+' '+str(standardStarDec)
+
+def readSimbadPage(coordinates, radius, simbadRetries, simbadTimeout):
+    """
+    Returns the html page of a SIMBAD coordinate query with its spaces removed, or None if
+    SIMBAD can't be reached after simbadRetries tries.
+    """
+    start_name='http://simbad.u-strasbg.fr/simbad/sim-coo?Coord='
+    end_name = '&submit=submit%20query&Radius.unit=arcsec&Radius='+str(radius)
+    www_page = start_name+coordinates+end_name
+    for attempt in range(simbadRetries):
+        try:
+            html2 = urllib2.urlopen(www_page, timeout=simbadTimeout).read()
+            return html2.replace(' ','')
+        except IOError as e:
+            logging.info("\nFailed to open SIMBAD (" + str(e) + "); try " + str(attempt+1) + " of " + str(simbadRetries) + ".")
+            if attempt+1 < simbadRetries:
+                time.sleep(2**attempt)
+    return None
+
+def parseSimbadPage(html2):
+    """
+    Returns the spectral type and the 2MASS K, H and J magnitudes ('' when missing) in
+    the html page of a SIMBAD query of one star.
+    """
+    star = {'spectralType': '', 'K': '', 'H': '', 'J': ''}
+    html2 = html2.split('\n')
+    for numi in range(len(html2)):
+        if html2[numi][0:13] == 'Spectraltype:':
+            if numi+5 < len(html2):
+                star['spectralType'] = str(html2[numi+5][0:3])
+            break
+    i = None
+    for line in html2:
+        if 'Fluxes' in line:
+            i = html2.index(line)
+            break
+    while i is not None and i+2 < len(html2) and 'IMGSRC' not in html2[i]:
+        for band in ('K', 'H', 'J'):
+            if all(s in html2[i] for s in (band, '[', ']')):
+                if 'C' in html2[i+2]:
+                    index = html2[i].index('[')
+                    star[band] = html2[i][1:index]
+        i+=1
+    return star
+
+def lookupStandardStar(standardStarRA, standardStarDec, simbadRetries=3, simbadTimeout=10.0, cachePath=""):
+    """
+    Returns the spectral type and magnitudes of the standard star at standardStarRA,
+    standardStarDec (degrees) from parseSimbadPage, or None if they can't be found.
+
+    Results are kept in standards.json of the persistent Nifty cache, so each star is only
+    queried once; with simbadRetries of 0 only the cache is used. Stars that weren't found
+    aren't cached, so an outage or a bad query is retried by the next reduction. SIMBAD
+    queries give up after simbadRetries tries so reductions on machines without network
+    access don't hang.
+    """
+    cacheFile = os.path.join(getCachePath('standards', cachePath), 'standards.json')
+    key = getStandardCacheKey(standardStarRA, standardStarDec)
+    cache = readStandardStarCache(cacheFile)
+    # Caches written by older versions can hold None for stars that weren't found; query those again.
+    if cache.get(key) is not None:
+        logging.info("\nFound the standard star at " + key + " in the standard star cache.")
+        return cache[key]
+
+    # Make pretty Right Ascensions and Declinations, to pass to SIMBAD.
+    if '-' in str(standardStarDec):
+        coordinates = str(standardStarRA)+'d'+str(standardStarDec)+'d'
+    else:
+        coordinates = str(standardStarRA)+'d+'+str(standardStarDec)+'d'
+    coordinates = coordinates.replace("+","%2b")
+    coordinates = coordinates.replace("-", "%2D")
+    html2 = readSimbadPage(coordinates, 10, simbadRetries, simbadTimeout)
+    #If >1 object found, decrease search radius and try again
+    if html2 and 'Numberofrows:' in html2:
+        html2 = readSimbadPage(coordinates, 1, simbadRetries, simbadTimeout)
+    if html2 is None:
+        logging.info("ERROR: couldn't reach SIMBAD to look up the standard star at " + key + ".")
+        return None
+    if 'Noastronomicalobjectfound' in html2:
+        logging.info("ERROR: didn't find a star at your coordinates within a search radius of 10 or 1 arcsec. You'll need to supply information in the config file; see the manual for instructions.")
+        star = None
+    else:
+        star = parseSimbadPage(html2)
+    if star is None:
+        return None
+
+    # Re-read the cache in case another reduction added to it, and write it atomically.
+    cache = readStandardStarCache(cacheFile)
+    cache[key] = star
+    with open(cacheFile+'.part', 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.rename(cacheFile+'.part', cacheFile)
+    return star
+
+def readStandardStarCache(cacheFile):
+    """
+    Returns the standard star cache; a dictionary of stars by coordinates. A missing or
+    unreadable (Eg: truncated) cache file is treated as an empty cache.
+    """
+    try:
+        with open(cacheFile, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def prefetchStandards(args):
+    """
+    Look up standard stars and store them in the standard star cache, so reductions can
+    later run without network access.
+
+    Usage: runNifty prefetchStandards [-c RA DEC] [FITS files or directories]
+
+    The coordinates of FITS files (Eg: raw telluric frames) are read from their RA and DEC
+    header keywords; directories are searched recursively for FITS files. Frames with an
+    OBSCLASS other than partnerCal or progCal are skipped.
+    """
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Store standard star information in the Nifty cache.')
+    parser.add_argument('files', nargs='*', help='FITS files or directories of standard star observations.')
+    parser.add_argument('-c', '--coordinates', nargs=2, action='append', default=[], metavar=('RA', 'DEC'), help='coordinates in degrees of a standard star.')
+    parser.add_argument('--cachePath', default='', help='directory of the Nifty cache.')
+    args = parser.parse_args(args)
+
+    coordinates = [tuple(pair) for pair in args.coordinates]
+    for name in args.files:
+        if os.path.isdir(name):
+            fitsFiles = [os.path.join(root, f) for root, dirs, files in os.walk(name) for f in files if f.endswith('.fits')]
+        else:
+            fitsFiles = [name]
+        for fitsFile in fitsFiles:
+            header = astropy.io.fits.getheader(fitsFile)
+            if header.get('OBSCLASS', 'partnerCal') not in ('partnerCal', 'progCal') or 'RA' not in header or 'DEC' not in header:
+                continue
+            coordinates.append((header['RA'], header['DEC']))
+
+    keys = collections.OrderedDict()
+    for standardStarRA, standardStarDec in coordinates:
+        keys.setdefault(getStandardCacheKey(standardStarRA, standardStarDec), (standardStarRA, standardStarDec))
+    for key, (standardStarRA, standardStarDec) in keys.items():
+        star = lookupStandardStar(standardStarRA, standardStarDec, cachePath=args.cachePath)
+        logging.info(key + ": " + str(star))
+
+def getStandardInfo(rawFrame, standardStarMagnitude, standardStarSpecTemperature, standardStarBand, standardStarRA, standardStarDec, simbadRetries, simbadTimeout, cachePath, log, over):
     """
     Find standard star spectral type, temperature, and standardStarMagnitude, and exposure time. Write results
     to std_starRAWNAME.txt in products_fluxcal_AND_telluric_corrected. Based on XDGNIRS code.
 
-    Executes a SIMBAD query and parses the resulting html to find spectal type,
-    temperature and/or standardStarMagnitude.
+    Looks the star up in the standard star cache, or with a SIMBAD query, to find spectral type,
+    temperature and/or standardStarMagnitude. If the lookup fails a relative flux calibration
+    with a 9700 K black body is set up instead.
 
     Args:
         rawFrame (str): name of raw science frame. Eg: "N20130527S0264"
@@ -206,6 +558,9 @@ def getStandardInfo(rawFrame, standardStarMagnitude, standardStarSpecTemperature
         standardStarBand (str): spectral standardStarBand of standard star specified in config file
         standardStarRA (str): Right Ascension of standard star specified in config file
         standardStarDec (str): Declination of standard star specified in config file
+        simbadRetries (int): number of times SIMBAD is queried before giving up; 0 only uses the cache
+        simbadTimeout (float): seconds to wait for SIMBAD to answer each query
+        cachePath (str): directory of the persistent Nifty cache; '' for the default
 
     Reads:
         0_tel + rawFrame + .fits : Combined, extracted one d standard star spectra
@@ -217,7 +572,6 @@ def getStandardInfo(rawFrame, standardStarMagnitude, standardStarSpecTemperature
     """
 
     starfile = '../products_fluxcal_AND_telluric_corrected/0_std_star'+rawFrame+'.txt'
-    kelvinfile = RUNTIME_DATA_PATH+'new_starstemp.txt'
 
     if os.path.exists(starfile):
         if over:
@@ -229,35 +583,21 @@ def getStandardInfo(rawFrame, standardStarMagnitude, standardStarSpecTemperature
     if not os.path.exists('../products_fluxcal_AND_telluric_corrected'):
         os.mkdir('../products_fluxcal_AND_telluric_corrected')
 
-    sf = open(starfile,'w')
-    klf = open (kelvinfile)
     Kmag = ''
     Jmag = ''
     Hmag = ''
 
-    # If user didn't specify a standardStarMagnitude, standardStarSpecTemperature, standardStarBand, standardStarRA, or standardStarDec
-    # Get standardStarBand, standardStarRA and standardStarDec from the combined extracted standard star spectra headers
-    # Use SIMBAD to look up standardStarMagnitude and standardStarSpecTemperature
-    if (not standardStarMagnitude or not standardStarSpecTemperature) and (not standardStarBand or not standardStarRA or not standardStarDec):
-        telheader = astropy.io.fits.open('0_tel'+rawFrame+'.fits')
-        if not standardStarBand:
-            standardStarBand = telheader[0].header['GRATING'][0]
-        if not standardStarRA:
-            standardStarRA = telheader[0].header['RA']
-        if not standardStarDec:
-            standardStarDec = telheader[0].header['DEC']
-        # Make pretty Right Ascensions and Declinations, to pass to SIMBAD.
-        if '-' in str(standardStarDec):
-            coordinates = str(standardStarRA)+'d'+str(standardStarDec)+'d'
-        else:
-            coordinates = str(standardStarRA)+'d+'+str(standardStarDec)+'d'
-        std_exp_time = telheader[0].header['EXPTIME']
-        std_exp_time = str(std_exp_time)
-    else:
-        # Grab the exposure time anyways
-        telheader = astropy.io.fits.open('0_tel'+rawFrame+'.fits')
-        std_exp_time = telheader[0].header['EXPTIME']
-        std_exp_time = str(std_exp_time)
+    # If user didn't specify a standardStarBand, standardStarRA or standardStarDec
+    # get them from the combined extracted standard star spectra headers.
+    telheader = astropy.io.fits.open('0_tel'+rawFrame+'.fits')
+    if not standardStarBand:
+        standardStarBand = telheader[0].header['GRATING'][0]
+    if not standardStarRA:
+        standardStarRA = telheader[0].header['RA']
+    if not standardStarDec:
+        standardStarDec = telheader[0].header['DEC']
+    std_exp_time = telheader[0].header['EXPTIME']
+    std_exp_time = str(std_exp_time)
 
     # check to see if a spectral type or temperature has been given
     if standardStarSpecTemperature:
@@ -280,103 +620,30 @@ def getStandardInfo(rawFrame, standardStarMagnitude, standardStarSpecTemperature
         magfind = True
 
     if specfind or tempfind or magfind:
-        #Construct URL based on standard star coords, execute SIMBAD query to find spectral type
-        coordinates = coordinates.replace("+","%2b")
-        coordinates = coordinates.replace("-", "%2D")
-        start_name='http://simbad.u-strasbg.fr/simbad/sim-coo?Coord='
-        end_name = '&submit=submit%20query&Radius.unit=arcsec&Radius=10'
-        www_page = start_name+coordinates+end_name
-        #f = urllib.urlopen(www_page)
-        while True:
-            try:
-                html2 = urllib.urlopen(www_page)
-                html2 = html2.read()
-                break
-            except IOError:
-                logging.info("\nFailed to open SIMBAD; retrying.")
-                pass
-        html2 = html2.replace(' ','')
-        search_error = str(html2.split('\n'))
-        #Exit if the lookup found nothing.
-        if 'Noastronomicalobjectfound' in search_error:
-            logging.info("ERROR: no object was found at the coordinates you entered. You'll need to supply information in a file; see the manual for instructions.")
-        #If >1 object found, decrease search radius and try again
-        if 'Numberofrows:' in search_error:
-            start_name='http://simbad.u-strasbg.fr/simbad/sim-coo?Coord='
-            end_name = '&submit=submit%20query&Radius.unit=arcsec&Radius=1'
-            www_page = start_name+coordinates+end_name
-            f = urllib.urlopen(www_page)
-            html2 = f.read()
-            html2 = html2.replace(' ','')
-            search_error = str(html2.split('\n'))
-        #If that didn't return anything, exit and let the user sort it out
-        if 'Noastronomicalobjectfound' in search_error:
-            logging.info("ERROR: didn't find a star at your coordinates within a search radius of 10 or 1 arcsec. You'll need to supply information in a file; see the manual for instructions.")
-            return
-        # Split source by \n into a list
-        html2 = html2.split('\n')
-        if specfind:
-            count = 0
-            aux = 0
-            for line in html2:
-                if (line[0:13] == 'Spectraltype:') :
-                    numi = aux + 5
-                    count = 0
-                    break
-                else:
-                    count += 1
-                aux += 1
-            spectral_type = str(html2[numi][0:3])
-            if count > 0:
-                logging.info("ERROR: problem with SIMBAD output. You'll need to supply the spectral type or temperature in the command line prompt.")
-                return
-        if magfind:
-            for line in html2:
-                if 'Fluxes' in line:
-                    i = html2.index(line)
-                    break
-            while 'IMGSRC' not in html2[i]:
-                if all(s in html2[i] for s in ('K', '[', ']')):
-                    if 'C' in html2[i+2]:
-                        index = html2[i].index('[')
-                        Kmag = html2[i][1:index]
-                if all(s in html2[i] for s in ('H', '[', ']')):
-                    if 'C' in html2[i+2]:
-                        index = html2[i].index('[')
-                        Hmag = html2[i][1:index]
-                if all(s in html2[i] for s in ('J', '[', ']')):
-                    if 'C' in html2[i+2]:
-                        index = html2[i].index('[')
-                        Jmag = html2[i][1:index]
-                i+=1
-                if i>len(html2):
-                    logging.info("ERROR: problem with SIMBAD output. You'll need to supply the magniture in the command line prompt.")
-        if not Kmag:
-            Kmag = 'nothing'
-        if not Jmag:
-            Jmag = 'nothing'
-        if not Hmag:
-            Hmag = 'nothing'
-
-        if tempfind:
-            #Find temperature for this spectral type in kelvinfile
-            count = 0
-            for line in klf:
-                if '#' in line:
-                    continue
-                else:
-                    if	spectral_type in line.split()[0]:
-                        kelvin = line.split()[1]
-                        count = 0
-                        break
-                    else:
-                        count+=1
-            if count > 0:
-                logging.info("ERROR: can't find a temperature for spectral type"+ str(spectral_type)+". You'll need to supply information in a file; see the manual for instructions.")
-                return
+        # Use the standard star cache or SIMBAD to look up standardStarMagnitude and standardStarSpecTemperature.
+        star = lookupStandardStar(standardStarRA, standardStarDec, simbadRetries, simbadTimeout, cachePath)
+        if not star:
+            # Fall back to a relative flux calibration with a typical telluric standard temperature.
+            logging.info("WARNING: no information found for the standard star at " + str(standardStarRA) + " " + str(standardStarDec) + ". You can supply it in the config file.")
+            magfind = False
+            if tempfind:
+                logging.info("WARNING: using a temperature of 9700 K for the standard star.")
+                kelvin = '9700'
+        else:
+            if magfind:
+                Kmag = star['K'] or 'nothing'
+                Hmag = star['H'] or 'nothing'
+                Jmag = star['J'] or 'nothing'
+            if tempfind:
+                # Find temperature for this spectral type in kelvinfile
+                kelvin = getSpectralTypeTemperature(star['spectralType'])
+                if not kelvin:
+                    logging.info("WARNING: can't find a temperature for spectral type "+ str(star['spectralType'])+". Using 9700 K; you can supply it in the config file.")
+                    kelvin = '9700'
 
     kelvin = str(kelvin)
     # Write results to std_starRAWNAME.txt
+    sf = open(starfile,'w')
     if (Kmag or Jmag or Hmag) and Kmag!='x' and magfind:
         sf.write('k K '+Kmag+' '+kelvin+'\n')
         sf.write('h H '+Hmag+' '+kelvin+'\n')
@@ -403,7 +670,6 @@ def getStandardInfo(rawFrame, standardStarMagnitude, standardStarSpecTemperature
         sf.write('Exp time: '+std_exp_time+'\n')
 
     sf.close()
-    klf.close()
 
     with open(starfile,'r') as sf:
         lines = sf.readlines()
@@ -432,13 +698,13 @@ def hLineCorrection(rawFrame, grating, hLineInter, hLineMethod, tempInter, log,
     if os.path.exists("1_htel" + rawFrame + ".fits"):
         if over:
             os.remove("1_htel" + rawFrame + ".fits")
-            if hLineMethod == "vega":
-                vega(rawFrame, grating, hLineInter, log, over)
+            if hLineMethod == "vega" or hLineMethod == "vegaNative":
+                vega(rawFrame, grating, hLineInter, log, over, native=(hLineMethod == "vegaNative"))
         else:
             logging.info("Output file exists and -over- not set - skipping H line removal")
     else:
-        if hLineMethod == "vega":
-            vega(rawFrame, grating, hLineInter, log, over)
+        if hLineMethod == "vega" or hLineMethod == "vegaNative":
+            vega(rawFrame, grating, hLineInter, log, over, native=(hLineMethod == "vegaNative"))
 
     #if hLineMethod == "linefitAuto" and not no_hLine:
     #    linefitAuto(combined_extracted_1d_spectra, grating)
@@ -466,11 +732,13 @@ def hLineCorrection(rawFrame, grating, hLineInter, hLineMethod, tempInter, log,
         plt.plot(corrected)
         plt.show()
 
-def fitContinuum(rawFrame, grating, continuumInter, tempInter, log, over):
+def fitContinuum(rawFrame, grating, continuumInter, tempInter, log, over, method='iraf'):
     """
     Fit a continuum to the telluric correction spectrum to normalize it. The continuum
     fitting regions were derived by eye and can be improved.
 
+    The fit is done by iraf.continuum, or by nifsNative.fitContinua with method 'native'.
+
     Results are in fit<Grating>.fits
     """
     # These were found to fit the curves well by hand. You can probably improve them; feel free to fiddle around!
@@ -489,11 +757,11 @@ def fitContinuum(rawFrame, grating, continuumInter, tempInter, log, over):
     if os.path.exists('2_fit'+rawFrame+'.fits'):
         if over:
             os.remove('2_fit'+rawFrame+'.fits')
-            iraf.continuum(input='1_htel'+rawFrame,output='2_fit'+rawFrame,ask='yes',lines='*',bands='1',type="fit",replace='no',wavescale='yes',logscale='no',override='no',listonly='no',logfiles=log,inter=continuumInter,sample=sample,naverage=1,func='spline3',order=order,low_rej=1.0,high_rej=3.0,niterate=2,grow=1.0,markrej='yes',graphics='stdgraph',cursor='',mode='ql')
+            runContinuumFit(rawFrame, sample, order, continuumInter, method, log)
         else:
             logging.info("\nOutput exists and -over not set - skipping continuum fit to telluric correction")
     else:
-        iraf.continuum(input='1_htel'+rawFrame,output='2_fit'+rawFrame,ask='yes',lines='*',bands='1',type="fit",replace='no',wavescale='yes',logscale='no',override='no',listonly='no',logfiles=log,inter=continuumInter,sample=sample,naverage=1,func='spline3',order=order,low_rej=1.0,high_rej=3.0,niterate=2,grow=1.0,markrej='yes',graphics='stdgraph',cursor='',mode='ql')
+        runContinuumFit(rawFrame, sample, order, continuumInter, method, log)
     if os.path.exists('../products_fluxcal_AND_telluric_corrected/0_fit'+rawFrame+'.fits'):
         if over:
             os.remove('../products_fluxcal_AND_telluric_corrected/0_fit'+rawFrame+'.fits')
@@ -512,6 +780,24 @@ def fitContinuum(rawFrame, grating, continuumInter, tempInter, log, over):
         plt.plot(fit)
         plt.show()
 
+def runContinuumFit(rawFrame, sample, order, continuumInter, method, log):
+    """
+    Fit the continuum of 1_htel<rawFrame> with spline3 of order pieces, 1 and 3 sigma low and
+    high rejection, 2 iterations and a growing radius of 1. Interactive fits always use
+    iraf.continuum.
+
+    Writes:
+        2_fit + rawFrame + .fits : continuum fit
+    """
+    if method == 'native' and not continuumInter:
+        spectrum = astropy.io.fits.open('1_htel'+rawFrame+'.fits')
+        wavelengths = getSpectrumWavelengths(spectrum[0].header, len(spectrum[0].data))
+        fit = fitContinua(wavelengths, spectrum[0].data, sample, order, lowReject=1.0, highReject=3.0, niterate=2, grow=1.0)
+        output = astropy.io.fits.PrimaryHDU(fit.astype(np.float32), header=spectrum[0].header)
+        writeFits(output, '2_fit'+rawFrame+'.fits')
+        return
+    iraf.continuum(input='1_htel'+rawFrame,output='2_fit'+rawFrame,ask='yes',lines='*',bands='1',type="fit",replace='no',wavescale='yes',logscale='no',override='no',listonly='no',logfiles=log,inter=continuumInter,sample=sample,naverage=1,func='spline3',order=order,low_rej=1.0,high_rej=3.0,niterate=2,grow=1.0,markrej='yes',graphics='stdgraph',cursor='',mode='ql')
+
 def divideByContinuum(rawFrame, log, over):
     """
     Divide the standard star spectrum by the continuum to normalize it.
@@ -532,7 +818,7 @@ def divideByContinuum(rawFrame, log, over):
                     multiplied[i] = 0.0
             hdu = astropy.io.fits.PrimaryHDU(multiplied)
             hdu.header = header
-            hdu.writeto("3_chtel"+rawFrame+".fits")
+            writeFits(hdu, "3_chtel"+rawFrame+".fits")
             logging.info("\nDivided telluric correction by continuum")
         else:
             logging.info("\nOutput exists and -over not set - skipping division by continuum")
@@ -550,7 +836,7 @@ def divideByContinuum(rawFrame, log, over):
                 multiplied[i] = 0.0
         hdu = astropy.io.fits.PrimaryHDU(multiplied)
         hdu.header = header
-        hdu.writeto("3_chtel"+rawFrame+".fits")
+        writeFits(hdu, "3_chtel"+rawFrame+".fits")
         logging.info("\nDivided telluric correction by continuum")
 
 def get1dSpecFromCube(rawFrame, log, over):
@@ -558,9 +844,10 @@ def get1dSpecFromCube(rawFrame, log, over):
     Turn a cube into a 1D spec, used to find shift and scale values of telluric spectrum.
     Currently: Extracts 1D spectra from center of cube.
     """
-    cube = astropy.io.fits.open('ctfbrsn'+rawFrame+'.fits')
-    cubeheader = cube[1].header
-    cubeslice = cube[1].data[:,30,30]
+    # Only the spectrum of the spaxel is read from the cube.
+    with LazyCube('ctfbrsn'+rawFrame+'.fits') as cube:
+        cubeheader = cube.header.copy()
+        cubeslice = cube.spaxel(30, 30)
     # Create a PrimaryHDU object to encapsulate the data and header.
     hdu = astropy.io.fits.PrimaryHDU(cubeslice)
     # Modify the cd1_1 and CRVAL1 values; this adds the wavelength calibration to the correct cube dimension.
@@ -572,16 +859,18 @@ def get1dSpecFromCube(rawFrame, log, over):
         if over:
             os.remove('4_cubeslice'+rawFrame+'.fits')
             # Write the spectrum and header to a new .fits file.
-            hdu.writeto('4_cubeslice'+rawFrame+'.fits', output_verify="ignore")
+            writeFits(hdu, '4_cubeslice'+rawFrame+'.fits', output_verify="ignore")
         else:
             logging.info("\nOutput exists and -over not set - skipping extraction of single cube slice")
     else:
         # Write the spectrum and header to a new .fits file.
-        hdu.writeto('4_cubeslice'+rawFrame+'.fits', output_verify="ignore")
+        writeFits(hdu, '4_cubeslice'+rawFrame+'.fits', output_verify="ignore")
 
-def getShiftScale(rawFrame, telluricInter, log, over):
+def getShiftScale(rawFrame, telluricInter, log, over, method='iraf'):
     """
     Use iraf.telluric() to get the best shift and scale of a telluric correction spectrum.
+    With method 'native' they are found by nifsNative.findTelluricShiftScale instead, unless
+    telluricInter is set; interactive fits always use iraf.telluric().
 
     Writes:
         "6_shiftScale"+rawFrame+".txt" :
@@ -589,15 +878,22 @@ def getShiftScale(rawFrame, telluricInter, log, over):
     if os.path.exists('5_oneDCorrected'+rawFrame+'.fits') and os.path.exists("6_shiftScale"+rawFrame+".txt"):
         if over:
             os.remove('5_oneDCorrected'+rawFrame+'.fits')
-            # TODO(nat): implement logging for this
-            iraf.chdir(os.getcwd())
-            tell_info = iraf.telluric(input='4_cubeslice'+rawFrame+'.fits[0]',output='5_oneDCorrected'+rawFrame+'.fits',cal="3_chtel"+rawFrame+'.fits[0]',airmass=1.0,answer='yes',ignoreaps='yes',xcorr='yes',tweakrms='yes',inter=telluricInter,sample="*",threshold=0.1,lag=3,shift=0.,dshift=0.1,scale=1.0,dscale=0.1, offset=1,smooth=1,cursor='',mode='al',Stdout=1)
         else:
             logging.info("\nOutput exists and -over not set - skipping get shift scale of telluric correction and fit")
             return
-    else:
-        iraf.chdir(os.getcwd())
-        tell_info = iraf.telluric(input='4_cubeslice'+rawFrame+'.fits[0]',output='5_oneDCorrected'+rawFrame+'.fits',cal="3_chtel"+rawFrame+'.fits[0]',airmass=1.0,answer='yes',ignoreaps='yes',xcorr='yes',tweakrms='yes',inter=telluricInter,sample="*",threshold=0.1,lag=3,shift=0.,dshift=0.1,scale=1.0,dscale=0.1, offset=1,smooth=1,cursor='',mode='al',Stdout=1)
+    if method == 'native' and not telluricInter:
+        spectrum = astropy.io.fits.open('4_cubeslice'+rawFrame+'.fits')
+        calibration = astropy.io.fits.getdata("3_chtel"+rawFrame+'.fits')
+        tellshift, scale, corrected = findTelluricShiftScale(spectrum[0].data, calibration)
+        spectrum[0].data = corrected.astype(np.float32)
+        writeFits(spectrum, '5_oneDCorrected'+rawFrame+'.fits')
+        logging.info("\nFound a shift of " + str(tellshift) + " and a scale of " + str(scale) + " for the telluric correction of " + rawFrame)
+        with open("6_shiftScale"+rawFrame+".txt", "w") as text_file:
+            text_file.write("Shift: {} Scale: {} \n".format(tellshift, scale))
+        return
+    # TODO(nat): implement logging for this
+    iraf.chdir(os.getcwd())
+    tell_info = iraf.telluric(input='4_cubeslice'+rawFrame+'.fits[0]',output='5_oneDCorrected'+rawFrame+'.fits',cal="3_chtel"+rawFrame+'.fits[0]',airmass=1.0,answer='yes',ignoreaps='yes',xcorr='yes',tweakrms='yes',inter=telluricInter,sample="*",threshold=0.1,lag=3,shift=0.,dshift=0.1,scale=1.0,dscale=0.1, offset=1,smooth=1,cursor='',mode='al',Stdout=1)
     # Get shift and scale from the list of values iraf.telluric() returns.
     # Sample tell_info:
     # ['cubeslice.fits[0]: norm.fits[1]: cubeslice.fits[0]: dshift 5.', 'window:again:window:window:again:window:window:again:window:TELLURIC:',
@@ -624,10 +920,16 @@ def getShiftScale(rawFrame, telluricInter, log, over):
     with open("6_shiftScale"+rawFrame+".txt", "w") as text_file:
         text_file.write("Shift: {} Scale: {} \n".format(tellshift, scale))
 
-def shiftScaleSpec(rawFrame, inPrefix, outPrefix, log, over):
+def shiftScaleSpec(rawFrame, inPrefix, outPrefix, log, over, native=False, scaleSpectrum=True):
     """
     Shifts and scales a spectrum using scipy.
     Replaces overflow with 1.
+
+    By default the shift is rounded to whole pixels and the spectrum is multiplied by the
+    scale. With native set (the shiftScaleMethod 'native' solver), the shift is interpolated
+    to a fraction of a pixel and, as in iraf.telluric, the scale is an exponent (Beer's law)
+    of the normalised telluric correction; with scaleSpectrum False (Eg: for the continuum
+    fit) the spectrum is then only shifted.
     """
     spectrum = astropy.io.fits.open(inPrefix+rawFrame+'.fits')
     spectrumData = spectrum[0].data
@@ -646,16 +948,15 @@ def shiftScaleSpec(rawFrame, inPrefix, outPrefix, log, over):
     if os.path.exists(outPrefix+rawFrame+'.fits'):
         if over:
             os.remove(outPrefix+rawFrame+'.fits')
-            # Shift using SciPy, substituting 1 where data overflows.
-            # TODO(nat): doesn't look like interpolation is happening but could be tested more.
-            # Works but it's gross. The int(round(float())) is a funny way to turn "-0.02" into 0
-            spectrumData = scipy.ndimage.interpolation.shift(spectrumData, -1*int(round(float(tellshift))), cval=1.)
-            # Scale by simple multiplication; 1D spectrum times a scalar.
-            spectrumData = spectrumData * float(scale)
-            spectrum[0].data = spectrumData
-            spectrum.writeto(outPrefix+rawFrame+'.fits')
         else:
             logging.info("\nOutput exists and -over not set - skipping shift and scale of " + inPrefix)
+            return
+    if native:
+        # Shift using SciPy with cubic spline interpolation, substituting 1 where data overflows.
+        spectrumData = scipy.ndimage.interpolation.shift(spectrumData.astype(float), -1*float(tellshift), order=3, cval=1.)
+        if scaleSpectrum:
+            spectrumData = np.where(spectrumData > 0, np.abs(spectrumData)**float(scale), spectrumData)
+        spectrum[0].data = spectrumData.astype(np.float32)
     else:
         # Shift using SciPy, substituting 1 where data overflows.
         # TODO(nat): doesn't look like interpolation is happening but could be tested more.
@@ -664,32 +965,23 @@ def shiftScaleSpec(rawFrame, inPrefix, outPrefix, log, over):
         # Scale by simple multiplication; 1D spectrum times a scalar.
         spectrumData = spectrumData * float(scale)
         spectrum[0].data = spectrumData
-        spectrum.writeto(outPrefix+rawFrame+'.fits')
+    writeFits(spectrum, outPrefix+rawFrame+'.fits')
 
 def divideCubebyTel(rawFrame, log, over):
     """
     Divide every element of a data cube by the derived telluric correction spectrum.
     """
-    # Open the uncorrected data cube.
-    cube = astropy.io.fits.open('ctfbrsn'+rawFrame+'.fits')
     # Open the shifted, scaled telluric correction spectrum.
-    telluricSpec = astropy.io.fits.open('7_schtel'+rawFrame+'.fits')
+    telluricSpec = astropy.io.fits.getdata('7_schtel'+rawFrame+'.fits')
     if os.path.exists("actfbrsn"+rawFrame+'.fits'):
         if over:
             os.remove("actfbrsn"+rawFrame+'.fits')
-            # Divide each slice of cube by telluric correction spectrum.
-            for i in range(cube[1].header['NAXIS2']):         # NAXIS2 is the y axis of the final cube.
-                for j in range(cube[1].header['NAXIS1']):     # NAXIS1 is the x axis of the final cube.
-                    cube[1].data[:,i,j] /= (telluricSpec[0].data)
-            # Write the telluric corrected cube to a new file.
-            cube.writeto("actfbrsn"+rawFrame+'.fits', output_verify='ignore')
+            # Divide each spectrum of the cube by the telluric correction spectrum.
+            applySpectrumToCube('ctfbrsn'+rawFrame+'.fits', telluricSpec, 'divide', "actfbrsn"+rawFrame+'.fits')
         else:
             logging.info("\nOutput exists and -over not set - skipping application of telluric correction to cube")
     else:
-        for i in range(cube[1].header['NAXIS2']):         # NAXIS2 is the y axis of the final cube.
-            for j in range(cube[1].header['NAXIS1']):     # NAXIS1 is the x axis of the final cube.
-                cube[1].data[:,i,j] /= (telluricSpec[0].data)
-        cube.writeto("actfbrsn"+rawFrame+'.fits', output_verify='ignore')
+        applySpectrumToCube('ctfbrsn'+rawFrame+'.fits', telluricSpec, 'divide', "actfbrsn"+rawFrame+'.fits')
 
 def copyToFluxCalDirectory(rawFrame, log, over):
     """
@@ -706,7 +998,7 @@ def copyToFluxCalDirectory(rawFrame, log, over):
 
 # ---------------------------------------------------------------------------- #
 
-def vega(rawFrame, grating, hLineInter, log, over):
+def vega(rawFrame, grating, hLineInter, log, over, native=False):
     """
     Use iraf.telluric to remove H lines from standard star, then remove
     normalization added by telluric with iraf.imarith.
@@ -714,6 +1006,9 @@ def vega(rawFrame, grating, hLineInter, log, over):
     The extension for vega_ext.fits is specified from grating (from header of
     telluricfile.fits).
 
+    With native set (and hLineInter not set) the lines are removed by
+    nifsNative.removeVegaLines instead, which gives the same un-normalised result.
+
     Args:
 
 
@@ -738,16 +1033,24 @@ def vega(rawFrame, grating, hLineInter, log, over):
         logging.info("\nWARNING: invalid standard star band. Exiting this correction.")
         return
     if os.path.exists("1_htel" + rawFrame + ".fits"):
-            if over:
-                os.remove("1_htel" + rawFrame + ".fits")
-                iraf.chdir(os.getcwd())
-                tell_info = iraf.telluric(input="0_tel" + rawFrame + ".fits[1]", output="1_htel"+rawFrame, cal= RUNTIME_DATA_PATH+'vega_ext.fits['+ext+']', xcorr='yes', tweakrms='yes', airmass=1.0, inter=hLineInter, sample=sample, threshold=0.1, lag=3, shift=0., dshift=0.05, scale=scale, dscale=0.05, offset=0., smooth=1, cursor='', mode='al', Stdout=1)
-            else:
-                logging.info("Output file exists and -over not set - skipping H line correction")
-                return
-    else:
-        iraf.chdir(os.getcwd())
-        tell_info = iraf.telluric(input="0_tel" + rawFrame + ".fits[1]", output="1_htel"+rawFrame, cal= RUNTIME_DATA_PATH+'vega_ext.fits['+ext+']', xcorr='yes', tweakrms='yes', airmass=1.0, inter=hLineInter, sample=sample, threshold=0.1, lag=3, shift=0., dshift=0.05, scale=scale, dscale=0.05, offset=0., smooth=1, cursor='', mode='al', Stdout=1)
+        if over:
+            os.remove("1_htel" + rawFrame + ".fits")
+        else:
+            logging.info("Output file exists and -over not set - skipping H line correction")
+            return
+
+    if native and not hLineInter:
+        spectrum = astropy.io.fits.open("0_tel" + rawFrame + ".fits")
+        wavelengths = getSpectrumWavelengths(spectrum[1].header, len(spectrum[1].data))
+        corrected, vegaShift, vegaScale = removeVegaLines(wavelengths, spectrum[1].data, RUNTIME_DATA_PATH+'vega_ext.fits', int(ext), sample)
+        logging.info("\nRemoved H lines with a Vega shift of " + str(vegaShift) + " and scale of " + str(vegaScale))
+        header = spectrum[0].header.copy()
+        header.extend([card for card in spectrum[1].header.cards if card.keyword not in ('XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'PCOUNT', 'GCOUNT', 'EXTNAME', 'EXTVER', 'INHERIT')], update=True)
+        writeFits(astropy.io.fits.PrimaryHDU(corrected.astype(np.float32), header=header), "1_htel" + rawFrame + ".fits")
+        return
+
+    iraf.chdir(os.getcwd())
+    tell_info = iraf.telluric(input="0_tel" + rawFrame + ".fits[1]", output="1_htel"+rawFrame, cal= RUNTIME_DATA_PATH+'vega_ext.fits['+ext+']', xcorr='yes', tweakrms='yes', airmass=1.0, inter=hLineInter, sample=sample, threshold=0.1, lag=3, shift=0., dshift=0.05, scale=scale, dscale=0.05, offset=0., smooth=1, cursor='', mode='al', Stdout=1)
 
     # need this loop to identify telluric output containing warning about pix outside calibration limits (different formatting)
     if "limits" in tell_info[-1].split()[-1]:
@@ -757,41 +1060,25 @@ def vega(rawFrame, grating, hLineInter, log, over):
 
     if os.path.exists("final_tel_no_hLines_no_norm.fits"):
         if over:
-            # Subtle bugs in iraf mean imarith doesn't work. So we use an astropy/numpy solution.
-            # Open the image and the scalar we will be dividing it by.
-            operand1 = astropy.io.fits.open("1_htel" + rawFrame+'.fits')[0].data
-            operand2 = float(norm)
-            # Create a new data array
-            multiplied = np.array(operand1, copy=True)
-            # Don't forget to include the original header! If you don't later IRAF tasks get confused.
-            header = astropy.io.fits.open("1_htel" + rawFrame+'.fits')[0].header
-            for i in range(len(multiplied)):
-                if operand2 != 0:
-                    multiplied[i] = operand1[i] / operand2
-                else:
-                    multiplied[i] = 1
-            # Set the data and header of the in-memory image
-            hdu = astropy.io.fits.PrimaryHDU(multiplied)
-            hdu.header = header
-            # Finally, write the new image to a new .fits file. It only has one extension; zero, with a header and data.
-            hdu.writeto('final_tel_no_hLines_no_norm.fits')
-            #iraf.imarith(operand1="1_htel" + rawFrame, op='/', operand2=norm, result='final_tel_no_hLines_no_norm', title='', divzero=0.0, hparams='', pixtype='', calctype='', verbose='yes', noact='no', mode='al')
+            os.remove("final_tel_no_hLines_no_norm.fits")
         else:
             logging.info("Output file exists and -over not set - skipping H line normalization correction")
-    else:
+    if not os.path.exists("final_tel_no_hLines_no_norm.fits"):
+        # Subtle bugs in iraf mean imarith doesn't work. So we use an astropy/numpy solution.
         #iraf.imarith(operand1="1_htel" + rawFrame, op='/', operand2=norm, result='final_tel_no_hLines_no_norm', title='', divzero=0.0, hparams='', pixtype='', calctype='', verbose='yes', noact='no', mode='al')
-        operand1 = astropy.io.fits.open("1_htel" + rawFrame+'.fits')[0].data
+        # Open the image and the scalar we will be dividing it by.
+        operand1 = astropy.io.fits.open("1_htel" + rawFrame+'.fits')[0]
         operand2 = float(norm)
-        multiplied = np.array(operand1, copy=True)
-        header = astropy.io.fits.open("1_htel" + rawFrame+'.fits')[0].header
-        for i in range(len(multiplied)):
-            if operand2 != 0:
-                multiplied[i] = operand1[i] / operand2
-            else:
-                multiplied[i] = 1
+        # Remove the normalization; a zero normalization gives a spectrum of ones.
+        if operand2 != 0:
+            multiplied = operand1.data / operand2
+        else:
+            multiplied = np.ones_like(operand1.data)
+        # Don't forget to include the original header! If you don't later IRAF tasks get confused.
         hdu = astropy.io.fits.PrimaryHDU(multiplied)
-        hdu.header = header
-        hdu.writeto('final_tel_no_hLines_no_norm.fits')
+        hdu.header = operand1.header
+        # Finally, write the new image to a new .fits file. It only has one extension; zero, with a header and data.
+        writeFits(hdu, 'final_tel_no_hLines_no_norm.fits')
 
     if os.path.exists('final_tel_no_hLines_no_norm.fits'):
         os.remove("1_htel" + rawFrame + ".fits")
@@ -18,6 +18,9 @@ from ..configobj.configobj import ConfigObj
 from ..nifsUtils import datefmt, listit, writeList, checkLists, makeSkyList, MEFarith, convertRAdec
 # Import Nifty python data cube merging script.
 from .nifsMerge import mergeCubes
+# Import the numpy versions of iraf tasks.
+from ...nifsNative import fitContinua, getSpectrumWavelengths
+from ...nifsUtils import writeFits
 
 # Define constants
 # Paths to Nifty data.
@@ -225,10 +228,11 @@ def linefitManual(spectrum, band):
             logging.info("It looks as if you didn't use the i key to write out the lineless spectrum. We'll have to try again. --> Re-entering splot")
             iraf.splot(images=spectrum, new_image='final_tel_no_hlines_no_norm', save_file='../PRODUCTS/lorentz_hlines.txt', overwrite='yes')
 
-def fitContinuum(continuuminter, tempInter, grating):
+def fitContinuum(continuuminter, tempInter, grating, method='iraf'):
     """
     Fit a continuum to the telluric correction spectrum to normalize it. The continuum
-    fitting regions were derived by eye and can be improved.
+    fitting regions were derived by eye and can be improved. If method is 'native' (see
+    continuumMethod in the telluric correction config), non-interactive fits use numpy.
 
     Results are in fit<Grating>.fits
     """
@@ -247,7 +251,13 @@ def fitContinuum(continuuminter, tempInter, grating):
         sample = "9453:10015,10106:10893,10993:11553"
     if os.path.exists("fit.fits"):
         os.remove("fit.fits")
-    iraf.continuum(input='final_tel_no_hlines_no_norm',output='fit',ask='yes',lines='*',bands='1',type="fit",replace='no',wavescale='yes',logscale='no',override='no',listonly='no',logfiles='',inter=continuuminter,sample=sample,naverage=1,func='spline3',order=order,low_rej=1.0,high_rej=3.0,niterate=2,grow=1.0,markrej='yes',graphics='stdgraph',cursor='',mode='ql')
+    if method == 'native' and not continuuminter:
+        spectrum = astropy.io.fits.open('final_tel_no_hlines_no_norm.fits')
+        wavelengths = getSpectrumWavelengths(spectrum[0].header, len(spectrum[0].data))
+        fit = fitContinua(wavelengths, spectrum[0].data, sample, order, lowReject=1.0, highReject=3.0, niterate=2, grow=1.0)
+        writeFits(astropy.io.fits.PrimaryHDU(fit.astype(np.float32), header=spectrum[0].header), 'fit.fits')
+    else:
+        iraf.continuum(input='final_tel_no_hlines_no_norm',output='fit',ask='yes',lines='*',bands='1',type="fit",replace='no',wavescale='yes',logscale='no',override='no',listonly='no',logfiles='',inter=continuuminter,sample=sample,naverage=1,func='spline3',order=order,low_rej=1.0,high_rej=3.0,niterate=2,grow=1.0,markrej='yes',graphics='stdgraph',cursor='',mode='ql')
     # Plot the telluric correction spectrum with the continuum fit.
     final_tel_no_hlines_no_norm = astropy.io.fits.open('final_tel_no_hlines_no_norm.fits')[0].data
     fit = astropy.io.fits.open('fit.fits')[0].data
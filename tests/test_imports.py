@@ -0,0 +1,18 @@
+"""
+Check that importing nifty stays quick: the pipeline steps, and pyraf and astropy with
+them, are only imported when a reduction uses them. benchmarks/importTime.py times it.
+"""
+import subprocess, sys
+
+CODE = """
+import sys
+import nifty
+from nifty.pipeline import nifsPipeline
+nifsPipeline.start
+print(','.join(name for name in ('pyraf', 'astropy', 'astroquery', 'scipy', 'matplotlib') if name in sys.modules))
+"""
+
+def testImportDoesNotLoadHeavyModules():
+    # A new process, so nothing is already imported.
+    loaded = subprocess.check_output([sys.executable, '-c', CODE]).decode().strip()
+    assert loaded == ''
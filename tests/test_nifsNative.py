@@ -0,0 +1,185 @@
+"""
+Checks of the numpy versions of IRAF tasks in nifsNative on small synthetic data.
+
+They don't need IRAF. Run them with:
+
+    python -m pytest tests
+"""
+import os
+import numpy as np
+import astropy.io.fits
+
+from nifty.pipeline import nifsNative
+
+
+def writeMef(filename, sci, var, dq):
+    """Write a small Gemini-like MEF with an MDF table and SCI, VAR and DQ extensions of version 1 and 2."""
+    mdf = astropy.io.fits.BinTableHDU.from_columns([astropy.io.fits.Column(name='SLITID', format='J', array=np.arange(2))], name='MDF')
+    hdulist = astropy.io.fits.HDUList([astropy.io.fits.PrimaryHDU(), mdf])
+    for ver in (1, 2):
+        hdulist.append(astropy.io.fits.ImageHDU(sci * ver, name='SCI', ver=ver))
+        hdulist.append(astropy.io.fits.ImageHDU(var * ver, name='VAR', ver=ver))
+        hdulist.append(astropy.io.fits.ImageHDU(dq, name='DQ', ver=ver))
+    hdulist.writeto(filename)
+
+#-----------------------------------------------------------------------------#
+
+def testSubtractSky(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    rng = np.random.RandomState(0)
+    objectSci = rng.normal(10., 1., (8, 6)).astype(np.float32)
+    skySci = rng.normal(3., 1., (8, 6)).astype(np.float32)
+    objectDq = np.zeros((8, 6), dtype=np.int16)
+    objectDq[0, 0] = 1
+    skyDq = np.zeros((8, 6), dtype=np.int16)
+    skyDq[1, 1] = 4
+    writeMef('nN1.fits', objectSci, np.ones((8, 6), dtype=np.float32), objectDq)
+    writeMef('nsky.fits', skySci, 2. * np.ones((8, 6), dtype=np.float32), skyDq)
+
+    nifsNative.subtractSky(['N1'], ['nsky'], False)
+
+    with astropy.io.fits.open('snN1.fits') as output:
+        assert [hdu.name for hdu in output] == ['PRIMARY', 'MDF', 'SCI', 'VAR', 'DQ', 'SCI', 'VAR', 'DQ']
+        assert np.array_equal(output['MDF'].data['SLITID'], np.arange(2))
+        for ver in (1, 2):
+            assert np.allclose(output['SCI', ver].data, ver * (objectSci - skySci))
+            assert np.allclose(output['VAR', ver].data, ver * 3.)
+            assert output['SCI', ver].data.dtype.name == 'float32'
+            assert output['DQ', ver].data[0, 0] == 1
+            assert output['DQ', ver].data[1, 1] == 4
+            assert output['DQ', ver].data.sum() == 5
+
+#-----------------------------------------------------------------------------#
+
+def writeFitCoordsSurface(filename, xmax, ymax, constant, xCoefficient, yCoefficient):
+    """Write an iraf fitcoords database file holding a first order polynomial surface without cross terms."""
+    values = [3., 2., 2., 0., 1., xmax, 1., ymax, constant, xCoefficient, yCoefficient]
+    with open(filename, 'w') as f:
+        f.write('begin\t' + os.path.basename(filename) + '\n\tsurface\t' + str(len(values)) + '\n')
+        for value in values:
+            f.write('\t\t' + repr(value) + '\n')
+
+def testMakeCubeOperator(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    os.mkdir('database')
+    shapes = [(20, 101), (20, 101)]
+    for n in range(len(shapes)):
+        # Wavelength is 20000 + 2 * (x - 1) Angstroms; the position along the slice is y pixels.
+        writeFitCoordsSurface('database/fcfbrsnN1_SCI_'+str(n+1)+'_lamp', 101., 20., 20100., 100., 0.)
+        writeFitCoordsSurface('database/fcfbrsnN1_SCI_'+str(n+1)+'_sdist', 101., 20., 10.5, 0., 9.5)
+
+    cube = nifsNative.makeCubeOperator('N1', shapes)
+
+    assert np.isclose(cube['crval'], 20000.)
+    assert np.isclose(cube['cdelt'], 2.)
+    assert cube['shape'][0] == 101
+    assert cube['operator'].shape == (np.prod(cube['shape']), 2 * 20 * 101)
+    covered = cube['coverage'] > 0
+    assert covered.any()
+    # Each voxel is the weighted mean of its pixels, so the weights of a voxel add up to 1.
+    assert np.allclose(cube['coverage'][covered], 1.)
+    # A flat frame gives a flat cube, and a frame equal to the wavelength gives the wavelength of each plane.
+    flat = cube['operator'].dot(5. * np.ones(2 * 20 * 101))
+    assert np.allclose(flat[covered], 5.)
+    x = np.tile(np.arange(1., 102.), 2 * 20)
+    planes = cube['operator'].dot(20000. + 2. * (x - 1.)).reshape(cube['shape'])
+    planeWavelengths = cube['crval'] + cube['cdelt'] * np.arange(cube['shape'][0])
+    coveredPlanes = covered.reshape(cube['shape'])
+    for plane in range(cube['shape'][0]):
+        assert np.allclose(planes[plane][coveredPlanes[plane]], planeWavelengths[plane])
+
+#-----------------------------------------------------------------------------#
+
+def testExtractSpectra(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    wavelengths, ny, nx = 30, 40, 50
+    sci = np.ones((wavelengths, ny, nx), dtype=np.float32) * np.arange(1., wavelengths + 1.)[:, np.newaxis, np.newaxis]
+    var = 0.5 * np.ones((wavelengths, ny, nx), dtype=np.float32)
+    dq = np.zeros((wavelengths, ny, nx), dtype=np.int16)
+    # A bad spaxel inside the first aperture, with a value that must be left out.
+    sci[:, 19, 24] = 1000.
+    dq[:, 19, 24] = 1
+    header = astropy.io.fits.Header()
+    header['CRVAL3'] = 20000.
+    header['CD3_3'] = 2.
+    hdulist = astropy.io.fits.HDUList([astropy.io.fits.PrimaryHDU()])
+    for name, data in (('SCI', sci), ('VAR', var), ('DQ', dq)):
+        hdulist.append(astropy.io.fits.ImageHDU(data, header=header.copy(), name=name))
+    hdulist.writeto('ctfbrsnN1.fits')
+
+    apertures = [(25., 20., 5.), (10., 10., 3.)]
+    spectra, variances, cubeHeader = nifsNative.extractSpectra(['ctfbrsnN1.fits'], apertures)
+
+    assert spectra.shape == (1, 2, wavelengths)
+    assert cubeHeader['CRVAL3'] == 20000.
+    weights = nifsNative.apertureWeights((ny, nx), apertures)
+    # Apertures cover about pi r**2 spaxels.
+    assert np.allclose(weights.sum(axis=(1, 2)), [np.pi * 25., np.pi * 9.], rtol=0.02)
+    # The sum over the aperture is scaled up for the bad spaxel, so it is the value times the area.
+    for k in range(2):
+        assert np.allclose(spectra[0, k], weights[k].sum() * np.arange(1., wavelengths + 1.), rtol=1e-5)
+    assert np.all(variances > 0)
+
+#-----------------------------------------------------------------------------#
+
+def makeAbsorptionSpectrum(x, lines, depth=0.5, width=2.):
+    """Unit continuum with gaussian absorption lines at lines (in pixels)."""
+    spectrum = np.ones(len(x))
+    for line in lines:
+        spectrum *= 1. - depth * np.exp(-0.5 * ((x - line) / width)**2)
+    return spectrum
+
+def testFindTelluricShiftScale():
+    x = np.arange(1000.)
+    lines = np.random.RandomState(1).uniform(50., 950., 25)
+    calibration = makeAbsorptionSpectrum(x, lines)
+    continuum = 100. + 0.05 * x
+    # The spectrum has the absorption of the calibration at x + 1.3, and 0.8 times as deep (in log).
+    spectrum = continuum * makeAbsorptionSpectrum(x + 1.3, lines)**0.8
+
+    shift, scale, corrected = nifsNative.findTelluricShiftScale(spectrum, calibration)
+
+    assert abs(shift - 1.3) < 0.06
+    assert abs(scale - 0.8) < 0.05
+    # Away from the edges, dividing out the shifted and scaled calibration leaves the continuum.
+    assert np.allclose(corrected[20:-20], continuum[20:-20], rtol=0.02)
+
+#-----------------------------------------------------------------------------#
+
+def testFitContinua():
+    x = np.linspace(20000., 24000., 800)
+    continuum = 1000. + 0.05 * (x - 20000.) - 1e-5 * (x - 22000.)**2
+    rng = np.random.RandomState(2)
+    spectra = np.array([scale * continuum * makeAbsorptionSpectrum(np.arange(800.), rng.uniform(0., 800., 10), depth=0.3) + rng.normal(0., 1., 800) for scale in (1., 2.)])
+    # Outside the sample a spike that must not pull the fit.
+    spectra[:, :20] = 1e6
+
+    fits = nifsNative.fitContinua(x, spectra, sample="20150:24000", order=5)
+
+    assert fits.shape == spectra.shape
+    # Rejecting the absorption lines leaves the continuum.
+    assert np.allclose(fits[0, 20:], continuum[20:], rtol=0.01)
+    assert np.allclose(fits[1, 20:], 2. * continuum[20:], rtol=0.01)
+    # Fitting many spectra at once gives the fits of each one on its own.
+    assert np.allclose(nifsNative.fitContinua(x, spectra[1], sample="20150:24000", order=5), fits[1])
+
+#-----------------------------------------------------------------------------#
+
+def testMakePlanckSpectrum():
+    temperature = 9700.
+    blackBody = nifsNative.makePlanckSpectrum(temperature, 20000., 2., 2040)
+
+    assert blackBody.shape == (2040,)
+    # Like mk1dspec, scaled to the continuum level at the first pixel.
+    assert np.isclose(blackBody[0], 1000.)
+    # B_lambda is proportional to lambda**-5 / (exp(hc / lambda k T) - 1).
+    h, c, k = 6.62607015e-34, 2.99792458e8, 1.380649e-23
+    wavelengths = (20000. + 2. * np.arange(2040)) * 1e-10
+    planck = wavelengths**-5 / np.expm1(h * c / (wavelengths * k * temperature))
+    assert np.allclose(blackBody, 1000. * planck / planck[0], rtol=1e-6)
+    # Changing a returned spectrum doesn't change the ones made later.
+    blackBody *= 2.
+    assert np.isclose(nifsNative.makePlanckSpectrum(temperature, 20000., 2., 2040)[0], 1000.)
+    # Wien's law: a 5000 K blackbody peaks near 5796 Angstroms.
+    visible = nifsNative.makePlanckSpectrum(5000., 3000., 1., 6000)
+    assert abs(3000. + np.argmax(visible) - 2.8977719e7 / 5000.) < 2.